@@ -4,7 +4,7 @@ from functools import reduce
 
 from pony.orm import db_session, Database, PrimaryKey, Required, Optional, Set, CacheIndexError, commit
 from flaskProject import app
-from flaskProject.Tests.UnitTests import initiate_database
+from flaskProject.Tests.UnitTests import initiate_database, clear_database
 from flaskProject.app import User, DB, teacherCont, studentCont, Cls, Unit
 
 import json
@@ -27,13 +27,7 @@ class AcceptanceTests(unittest.TestCase):
         app.app.testing = False
 
     def tearDown(self) -> None:
-        with db_session:
-            DB.execute('DELETE FROM ActiveUnit WHERE 1=1;')
-            DB.execute('DELETE FROM Question WHERE 1=1;')
-            DB.execute('DELETE FROM Unit WHERE 1=1;')
-            DB.execute('DELETE FROM Cls_User WHERE 1=1;')
-            DB.execute('DELETE FROM Cls WHERE 1=1;')
-            DB.execute('DELETE FROM User WHERE 1=1;')
+        clear_database()
 
     @staticmethod
     def create_request(route, **kwargs):
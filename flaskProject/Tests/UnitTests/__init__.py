@@ -1,69 +1,21 @@
-from pony.orm import db_session, Database, PrimaryKey, Required, Optional, Set, CacheIndexError, commit
+import os
 
+from pony.orm import db_session
 
-def initiate_database(db):
-    db.bind(provider='sqlite', filename='..\\..\\dbtest.sqlite', create_db=True)
-
-    class User(db.Entity):
-        name = PrimaryKey(str)
-        password = Required(str)
-        type = Required(int)
-        teaching = Set('Cls', reverse='teacher', cascade_delete=False)
-        inClass = Set('Cls_User', cascade_delete=False)
-        activeUnits = Set("ActiveUnit", reverse='student')
+from flaskProject.app import bind_database, User, Cls, Cls_User, Unit, Question, ActiveUnit, LessonProgress, Lesson, \
+    LessonUnit
 
-    class Cls(db.Entity):
-        name = PrimaryKey(str)
-        teacher = Required(User, reverse='teaching')
-        students = Set('Cls_User')
-        hasUnits = Set('Unit', reverse='cls', cascade_delete=False)
+TEST_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'dbtest.sqlite')
 
-    class Cls_User(db.Entity):
-        cls = Required(Cls)
-        user = Required(User)
-        approved = Required(bool)
-        PrimaryKey(cls, user)
 
-    class Unit(db.Entity):
-        name = Required(str)
-        cls = Required(Cls, reverse='hasUnits')
-        desc = Optional(str)
-        template = Required(str)
-        Qnum = Required(str)
-        maxTime = Required(str)
-        subDate = Required(str)
-        instances = Set('ActiveUnit', reverse='unit')
-        order = Required(int)
-        next = Optional(str)
-        PrimaryKey(name, cls)
-
-    class Question(db.Entity):
-        id = Required(int)
-        question_preamble = Required(str)
-        question = Required(str)
-        answer1 = Required(str)
-        answer2 = Required(str)
-        answer3 = Required(str)
-        answer4 = Required(str)
-        correct_ans = Required(int)
-        active_unit = Required('ActiveUnit', reverse='questions')
-        solved_correctly = Optional(bool)
-        solve_time = Optional(str)
-        PrimaryKey(active_unit, id)
+# binds db to a sqlite file of its own, standing in locally for whatever provider the app runs on
+def initiate_database(db):
+    bind_database(db, 'sqlite', filename=TEST_DB_PATH)
 
-    class ActiveUnit(db.Entity):
-        inProgress = Required(bool)
-        attempt = Required(int)
-        questions = Set('Question', reverse='active_unit')
-        unit = Required(Unit, reverse='instances')
-        student = Required(User, reverse='activeUnits')
-        grade = Optional(int)
-        consecQues = Required(int)
-        quesAmount = Required(int)
-        currentQuestion = Required(int)
-        totalCorrect = Required(int)
-        lastTimeAnswered = Optional(str)
-        PrimaryKey(unit, student, attempt)
 
-    # Generate mapping and create tables
-    db.generate_mapping(create_tables=True)
+# empties every table of the app, the children before their parents (foreign keys are enforced). Goes through
+# Pony so the table names are the ones of the provider the app runs on.
+def clear_database():
+    with db_session:
+        for entity in (LessonProgress, LessonUnit, Lesson, Question, ActiveUnit, Unit, Cls_User, Cls, User):
+            entity.select().delete(bulk=True)
@@ -1,7 +1,8 @@
+import threading
 import unittest
 from pony.orm import db_session, Database
 from flaskProject import app
-from flaskProject.Tests.UnitTests import initiate_database
+from flaskProject.Tests.UnitTests import initiate_database, clear_database
 from flaskProject.app import User, DB, Cls, Unit, QUESTIONS_TO_GENERATE
 
 
@@ -23,13 +24,7 @@ class TestGetMaxUnit(unittest.TestCase):
     def tearDown(self) -> None:
         with app.app.app_context():
             app.activeControllers = {}
-        with db_session:
-            DB.execute('DELETE FROM ActiveUnit WHERE 1=1;')
-            DB.execute('DELETE FROM Question WHERE 1=1;')
-            DB.execute('DELETE FROM Unit WHERE 1=1;')
-            DB.execute('DELETE FROM Cls_User WHERE 1=1;')
-            DB.execute('DELETE FROM Cls WHERE 1=1;')
-            DB.execute('DELETE FROM User WHERE 1=1;')
+        clear_database()
 
     def test_get_max_unit_success(self):
         with app.app.app_context():
@@ -117,6 +112,48 @@ class TestGetMaxUnit(unittest.TestCase):
                 active = app.ActiveUnit.select(lambda au: au.student.name == 'student1')[:].to_list()[0]
                 self.assertEqual(10, active.quesAmount, 'question not added')
 
+    def test_addQuestions_inserts_batch(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.addQuestions_buisness('class1', 'unit1', 'student1')
+            with db_session:
+                active = app.ActiveUnit[Unit['unit1', Cls['class1']], User['student1'], 1]
+                active.currentQuestion = 10
+            app.addQuestions_buisness('class1', 'unit1', 'student1')
+            with db_session:
+                active = app.ActiveUnit[Unit['unit1', Cls['class1']], User['student1'], 1]
+                questions = sorted(active.questions, key=lambda q: q.id)
+                self.assertEqual(list(range(1, 2 * QUESTIONS_TO_GENERATE + 1)), [q.id for q in questions])
+                for q in questions:
+                    self.assertIn(q.correct_ans, [1, 2, 3, 4])
+                    self.assertEqual('', q.solve_time)
+                    self.assertIsNone(q.solved_correctly)
+                    self.assertTrue(q.question and q.answer1)
+
+    def test_get_max_unit_reads_latest_attempt(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.register_buisness('student2', 'password', 2)
+            with db_session:
+                unit = Unit['unit1', Cls['class1']]
+                self.assertEqual(0, app.get_max_unit(unit, 'student1'))
+                for attempt in [1, 3, 2]:
+                    app.ActiveUnit(inProgress=False, attempt=attempt, unit=unit, student=User['student1'],
+                                   consecQues=0, quesAmount=0, currentQuestion=0, totalCorrect=0)
+                app.ActiveUnit(inProgress=False, attempt=7, unit=unit, student=User['student2'], consecQues=0,
+                               quesAmount=0, currentQuestion=0, totalCorrect=0)
+                self.assertEqual(3, app.get_max_unit(unit, 'student1'))
+                self.assertEqual(3, app.get_max_unit(unit, User['student1']))
+                self.assertEqual(7, app.get_max_unit(unit, 'student2'))
+
     def test_individualStats_successful(self):
         with app.app.app_context():
             # Create teacher account and open a class and a unit
@@ -191,6 +228,142 @@ class TestGetMaxUnit(unittest.TestCase):
             self.assertEqual([1, 0], res.json['correctIncorrect'])
             self.assertEqual([100, 66, 0, 0, 0], res.json['L5'])  # 100 == 1/1, correct/total for unit1
 
+    def test_lessonProgress_follows_submissions(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            # the lesson is the chain of units opened one after the other, whatever their names
+            app.teacherOpenUnit('practice', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60',
+                                '2023-07-01', 'false', 'unit1', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.registerClass_buisness('student1', 'class1')
+            app.approveStudentToClass_buisness('teacher1', 'student1', 'class1', 'True')
+            app.startUnit_buisness('class1', 'unit1', 'student1')
+            res = app.getQuestion_buisness('student1', 'unit1', 'class1', '1')
+            self.assertEqual((1, 1), (res.json[0]['currentUnit'], res.json[0]['totalUnits']))
+            app.submitQuestion_buisness('student1', 'unit1', 'class1', '1', res.json[0]['correct_ans'])
+            app.submitQuestion_buisness('student1', 'unit1', 'class1', '2', -1)
+            app.startUnit_buisness('class1', 'practice', 'student1')
+            res = app.getQuestion_buisness('student1', 'practice', 'class1', '1')
+            self.assertEqual((2, 2), (res.json[0]['currentUnit'], res.json[0]['totalUnits']))
+            app.submitQuestion_buisness('student1', 'practice', 'class1', '1', res.json[0]['correct_ans'])
+            with db_session:
+                progress = app.LessonProgress.select()[:].to_list()
+                self.assertEqual(1, len(progress))
+                lesson = app.lesson_entry(Unit['unit1', app.Cls['class1']]).lesson
+                self.assertEqual((lesson, 1, 2, 2, 3), (progress[0].lesson, progress[0].first, progress[0].units,
+                                                        progress[0].correct, progress[0].solved))
+            # the sums are the ones of the unit asked about and the lesson units after it
+            self.assertEqual((2, 1), app.getLessonCorrectIncorrect('student1', 'unit1', 'class1'))
+            self.assertEqual((1, 0), app.getLessonCorrectIncorrect('student1', 'practice', 'class1'))
+            self.assertEqual(66, app.getLessonGrade('student1', 'unit1', 'class1'))
+            self.assertEqual(100, app.getLessonGrade('student1', 'practice', 'class1'))
+            # rows missing (e.g. progress from before the table) are counted from the active units by the readers,
+            # and only stored again by the next answer
+            with db_session:
+                app.LessonProgress.select().delete(bulk=True)
+            self.assertEqual((2, 2), app.getLessonIndex('student1', 'practice', 'class1'))
+            self.assertEqual((2, 1), app.getLessonCorrectIncorrect('student1', 'unit1', 'class1'))
+            self.assertEqual(2, app.getQuestion_buisness('student1', 'practice', 'class1', '2').json[0]['currentUnit'])
+            with db_session:
+                self.assertEqual(0, app.LessonProgress.select().count())
+            app.submitQuestion_buisness('student1', 'practice', 'class1', '2', -1)
+            with db_session:
+                progress = app.LessonProgress.select().first()
+                self.assertEqual((1, 2, 2, 4), (progress.first, progress.units, progress.correct, progress.solved))
+            res = app.app.test_client().get('/getLessonCorrect?usernameS=student1&unitName=unit1&className=class1'
+                                            '&correct=Correct')
+            self.assertEqual([1, 2], [question['id'] for question in res.json])
+            # deleting a unit moves the ones after it up, the lesson's progress is counted again
+            app.deleteUnit_buisness('unit1', 'class1', 'teacher1')
+            with db_session:
+                self.assertEqual(0, app.LessonProgress.select().count())
+            self.assertEqual((1, 1), app.getLessonIndex('student1', 'practice', 'class1'))
+            self.assertEqual((1, 1), app.getLessonCorrectIncorrect('student1', 'practice', 'class1'))
+
+    def test_submitQuestion_counts_an_answer_once_and_refills_ahead(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.registerClass_buisness('student1', 'class1')
+            app.approveStudentToClass_buisness('teacher1', 'student1', 'class1', 'True')
+            app.startUnit_buisness('class1', 'unit1', 'student1')
+            res = app.getQuestion_buisness('student1', 'unit1', 'class1', '1')
+            correct_ans = res.json[0]['correct_ans']
+            self.assertEqual('correct', app.submitQuestion_buisness('student1', 'unit1', 'class1', '1', correct_ans))
+            # a resent answer gets the same response but isn't counted again
+            self.assertEqual('correct', app.submitQuestion_buisness('student1', 'unit1', 'class1', '1', -1))
+            stalls = app.QUESTION_REFILLER.stats()['stalls']
+            for qnum in range(2, 8):
+                res = app.submitQuestion_buisness('student1', 'unit1', 'class1', str(qnum), -1)
+                self.assertEqual(2, len(res), 'Wrong return value for submitQuestion')
+            # 3 questions from the end of the first batch the second one is added in the background
+            self.assertTrue(app.QUESTION_REFILLER.wait('class1', 'unit1', 'student1', 1, 1, timeout=10))
+            with db_session:
+                active = app.ActiveUnit[Unit['unit1', Cls['class1']], 'student1', 1]
+                self.assertEqual((7, 1, 0, 14, 20), (active.currentQuestion, active.totalCorrect, active.consecQues,
+                                                     active.grade, active.quesAmount))
+                self.assertEqual(20, active.questions.count())
+            for qnum in range(8, 11):
+                app.submitQuestion_buisness('student1', 'unit1', 'class1', str(qnum), -1)
+            res = app.getQuestion_buisness('student1', 'unit1', 'class1', '11')
+            self.assertEqual(11, res.json[0]['id'])
+            self.assertEqual(stalls, app.QUESTION_REFILLER.stats()['stalls'])
+            # refilling a batch that was refilled already adds nothing
+            self.assertEqual(0, app.refillActiveUnit_buisness('class1', 'unit1', 'student1', 1, 1))
+
+    def test_insert_questions_shows_up_in_a_loaded_collection(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.startUnit_buisness('class1', 'unit1', 'student1')
+            with db_session:
+                active = app.ActiveUnit[Unit['unit1', Cls['class1']], 'student1', 1]
+                self.assertEqual(10, len(active.questions))
+                app.insert_questions(active, 11, [('preamble', 'question', '1', '2', '3', '4', 1)] * 2)
+                self.assertEqual(12, len(active.questions))
+                self.assertEqual(12, active.questions.count())
+
+    def test_getQuestion_answers_pending_while_the_refill_runs(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '20', '60',
+                                '2023-07-01', 'true', 'new', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.registerClass_buisness('student1', 'class1')
+            app.approveStudentToClass_buisness('teacher1', 'student1', 'class1', 'True')
+            app.startUnit_buisness('class1', 'unit1', 'student1')
+            release = threading.Event()
+
+            def slow_refill(*key):
+                release.wait(10)
+                return app.refillActiveUnit_buisness(*key)
+
+            refiller, wait = app.QUESTION_REFILLER, app.QUESTION_REFILL_WAIT
+            app.QUESTION_REFILLER, app.QUESTION_REFILL_WAIT = app.QuestionRefiller(slow_refill, 1), 0.1
+            try:
+                for qnum in range(1, 11):
+                    app.submitQuestion_buisness('student1', 'unit1', 'class1', str(qnum), -1)
+                res = app.getQuestion_buisness('student1', 'unit1', 'class1', '11')
+                self.assertEqual(202, res[1])
+                self.assertEqual(1, app.QUESTION_REFILLER.stats()['stalls'])
+                release.set()
+                self.assertTrue(app.QUESTION_REFILLER.wait('class1', 'unit1', 'student1', 1, 1, timeout=10))
+                self.assertEqual(11, app.getQuestion_buisness('student1', 'unit1', 'class1', '11').json[0]['id'])
+                self.assertEqual(1, app.QUESTION_REFILLER.stats()['stalls'])
+            finally:
+                release.set()
+                app.QUESTION_REFILLER, app.QUESTION_REFILL_WAIT = refiller, wait
+
     def test_quitActiveUnit_successful(self):
         with app.app.app_context():
             # Create teacher account and open a class and a unit
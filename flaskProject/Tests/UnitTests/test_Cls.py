@@ -1,8 +1,8 @@
 import unittest
 from pony.orm import db_session, Database
 from flaskProject import app
-from flaskProject.Tests.UnitTests import initiate_database
-from flaskProject.app import DB, Cls
+from flaskProject.Tests.UnitTests import initiate_database, clear_database
+from flaskProject.app import DB, Cls, User
 
 
 
@@ -23,13 +23,7 @@ class MyTestCase(unittest.TestCase):
     def tearDown(self) -> None:
         with app.app.app_context():
             app.activeControllers = {}
-        with db_session:
-            DB.execute('DELETE FROM ActiveUnit WHERE 1=1;')
-            DB.execute('DELETE FROM Question WHERE 1=1;')
-            DB.execute('DELETE FROM Unit WHERE 1=1;')
-            DB.execute('DELETE FROM Cls_User WHERE 1=1;')
-            DB.execute('DELETE FROM Cls WHERE 1=1;')
-            DB.execute('DELETE FROM User WHERE 1=1;')
+        clear_database()
 
     def test_openClass_successful(self):
         # Add test data
@@ -457,6 +451,46 @@ class MyTestCase(unittest.TestCase):
             self.assertEqual(0, len(res.json), 'wrong classes returned')
 
 
+    def test_presenceIndex_follows_logins_and_approvals(self):
+        app.PRESENCE_INDEX.clear()
+        with db_session:
+            with app.app.app_context():
+                app.register_buisness('teacher1', 'password', 1)
+                app.login_buisness('teacher1', 'password')
+                app.openClass_buisness('teacher1', 'class1')
+                for student in ['student1', 'student2']:
+                    app.register_buisness(student, 'password', 2)
+                    app.login_buisness(student, 'password')
+                    app.registerClass_buisness(student, 'class1')
+                app.approveStudentToClass_buisness('teacher1', 'student1', 'class1', 'True')
+                online = app.getOnlineStudentsOfTeacher_business('teacher1')
+                self.assertEqual([{'id': 0, 'username': 'student1', 'isLoggedIn': True}], online)
+                # from here on the index is updated without reading the db again
+                app.logout_buisness('student1')
+                app.approveStudentToClass_buisness('teacher1', 'student2', 'class1', 'True')
+                online = app.getOnlineStudentsOfTeacher_business('teacher1')
+                self.assertEqual({'student1': False, 'student2': True},
+                                 {student['username']: student['isLoggedIn'] for student in online})
+                # removing the class drops its roster, it is read again on the next request
+                app.removeClass_buisness('teacher1', 'class1')
+                self.assertEqual([], app.getOnlineStudentsOfTeacher_business('teacher1'))
+        app.PRESENCE_INDEX.clear()
+
+    def test_presenceIndex_reads_rosters_again_after_their_ttl(self):
+        index = app.PresenceIndex(roster_ttl=60)
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.register_buisness('student1', 'password', 2)
+            app.registerClass_buisness('student1', 'class1')
+            self.assertEqual([], index.students('teacher1'))
+            # approved by another worker process, this index isn't told
+            with db_session:
+                app.Cls_User[Cls['class1'], User['student1']].approved = True
+            self.assertEqual([], index.students('teacher1'))
+            index.loaded['teacher1'] -= 60
+            self.assertEqual([('student1', False)], index.students('teacher1'))
+
 
 
 if __name__ == '__main__':
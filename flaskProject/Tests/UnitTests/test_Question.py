@@ -1,10 +1,46 @@
+import asyncio
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from urllib.parse import urlencode
 from pony.orm import db_session, Database
 from flaskProject import app
-from flaskProject.Tests.UnitTests import initiate_database
+from flaskProject.Tests.UnitTests import initiate_database, clear_database
 from flaskProject.app import DB
 
 
+# a generation task that never finishes, for the executor's timeout handling
+def hang_generation(template):
+    time.sleep(60)
+
+
+# a generation task that takes a while, returning its template
+def slow_generation(template):
+    time.sleep(0.4)
+    return template, []
+
+
+# sends a GET through the ASGI entry point, returns the status and the body
+def asgi_get(path, **args):
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': urlencode(args).encode(),
+             'headers': [(b'host', b'localhost')], 'server': ('localhost', 80), 'client': ('127.0.0.1', 1234)}
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    messages = []
+
+    async def receive():
+        return requests.pop() if requests else {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app.asgi_app(scope, receive, send))
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
 
 class MyTestCase(unittest.TestCase):
     DB = None
@@ -23,13 +59,7 @@ class MyTestCase(unittest.TestCase):
     def tearDown(self) -> None:
         with app.app.app_context():
             app.activeControllers = {}
-        with db_session:
-            DB.execute('DELETE FROM ActiveUnit WHERE 1=1;')
-            DB.execute('DELETE FROM Question WHERE 1=1;')
-            DB.execute('DELETE FROM Unit WHERE 1=1;')
-            DB.execute('DELETE FROM Cls_User WHERE 1=1;')
-            DB.execute('DELETE FROM Cls WHERE 1=1;')
-            DB.execute('DELETE FROM User WHERE 1=1;')
+        clear_database()
 
 
 
@@ -181,6 +211,39 @@ class MyTestCase(unittest.TestCase):
             self.assertEqual(2, len(res), 'Wrong return value for getQuestion')
             self.assertEqual(200 + int(correct_ans), res[1], 'Failed submitQuestion request')
 
+    @unittest.skipUnless(importlib.util.find_spec('a2wsgi'), 'a2wsgi is not installed')
+    def test_asgi_serves_the_same_responses(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.login_buisness('teacher1', 'password')
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.login_buisness('student1', 'password')
+            app.registerClass_buisness('student1', 'class1')
+            app.approveStudentToClass_buisness('teacher1', 'student1', 'class1', 'True')
+        served = app.asgi_app.stats()['served']
+        status, _ = asgi_get('/startUnit', className='class1', unitName='unit1', username='student1')
+        self.assertEqual(200, status)
+        status, body = asgi_get('/getQuestion', username='student1', unitName='unit1', className='class1', qnum='1')
+        self.assertEqual(200, status)
+        correct_ans = json.loads(body)[0]['correct_ans']
+        status, _ = asgi_get('/submitQuestion', username='student1', unitName='unit1', className='class1', qnum='1',
+                             ans='-1')
+        self.assertEqual(200 + correct_ans, status)
+        status, body = asgi_get('/getQuestion', username='student1', unitName='unit1', className='class1', qnum='2')
+        status, _ = asgi_get('/submitQuestion', username='student1', unitName='unit1', className='class1', qnum='2',
+                             ans=json.loads(body)[0]['correct_ans'])
+        self.assertEqual(205, status)
+        status, _ = asgi_get('/getQuestion', username='nobody', unitName='unit1', className='class1', qnum='1')
+        self.assertEqual(400, status)
+        status, body = asgi_get('/servingStats')
+        self.assertEqual('asgi', json.loads(body)['mode'])
+        stats = app.asgi_app.stats()
+        self.assertEqual(served['generation'] + 1, stats['served']['generation'])
+        self.assertEqual(served['read'] + 6, stats['served']['read'])
+
     def test_submitQuestion_before_start_unit_failure(self):
         with app.app.app_context():
             # Create teacher account and open a class
@@ -199,9 +262,235 @@ class MyTestCase(unittest.TestCase):
             self.assertEqual(2, len(res), 'Wrong return value for getQuestion')
             self.assertEqual(400, res[1], 'Succeeded getQuestion request')
 
+    def test_questionPool_refills_in_background(self):
+        calls = []
+
+        def generate(template):
+            calls.append(template)
+            return [(template, len(calls), i) for i in range(10)]
+
+        pool = app.QuestionPool(generate, depth=30, low_watermark=10, max_per_template=40, max_templates=2)
+        # Empty pool falls back to generating synchronously
+        self.assertEqual(10, len(pool.take('t1', 10)))
+        self.assertEqual(1, pool.stats()['misses'])
+        # The background worker fills the template up to its depth
+        for _ in range(100):
+            if pool.size('t1') >= 30 and not pool.stats()['pending']:
+                break
+            time.sleep(0.01)
+        self.assertGreaterEqual(pool.size('t1'), 30)
+        self.assertLessEqual(pool.size('t1'), 40)
+        # Now a request is served from the pool
+        self.assertEqual(10, len(pool.take('t1', 10)))
+        self.assertEqual(1, pool.stats()['hits'])
+
+    def test_generationExecutor_uses_worker_processes(self):
+        executor = app.GenerationExecutor(workers=2, timeout=30, retries=0)
+        try:
+            questions = executor.generate('intersection_linear_-10,0,1,6', 4)
+        finally:
+            executor.reset()
+        self.assertEqual(4, len(questions))
+        for question in questions:
+            self.assertEqual('מצא את נקודות החיתוך עם הצירים:', question[0])
 
+    def test_generationExecutor_kills_hung_workers(self):
+        executor = app.GenerationExecutor(workers=1, timeout=1, retries=1, task=hang_generation)
+        try:
+            with self.assertRaises(TimeoutError):
+                executor.generate('intersection_linear_-10,0,1,6', 2)
+        finally:
+            executor.reset()
+        self.assertEqual(2, executor.restarts)
+        self.assertIsNone(executor.pool)
 
+    def test_generationExecutor_times_tasks_from_their_start(self):
+        executor = app.GenerationExecutor(workers=1, timeout=1, retries=0, task=slow_generation)
+        results = {}
+        first = threading.Thread(target=lambda: results.update(first=executor.generate('t1', 5)))
+        try:
+            first.start()
+            time.sleep(0.1)
+            # queued behind the 2 seconds of the first batch, but its own task takes 0.4
+            results['second'] = executor.generate('t2', 1)
+            first.join()
+        finally:
+            executor.reset()
+        self.assertEqual(['t1'] * 5, results['first'])
+        self.assertEqual(['t2'], results['second'])
+        self.assertEqual(0, executor.restarts)
 
+    def test_answerCache_stats_count_the_builds_of_the_workers(self):
+        cache = app.ANSWER_CACHE
+        app.ANSWER_CACHE = app.AnswerCache(16)
+        executor = app.GenerationExecutor(workers=1, timeout=30, retries=0)
+        try:
+            executor.generate('intersection_linear_-2,0,1,2', 30)
+            stats = app.app.test_client().get('/answerCacheStats').json
+        finally:
+            executor.reset()
+            app.ANSWER_CACHE = cache
+        # the parameters only allow 6 different functions
+        self.assertEqual(30, stats['hits'] + stats['misses'])
+        self.assertLessEqual(stats['misses'], 6)
+        self.assertEqual(0, stats['size'])
+
+    def test_generation_budget_redraws_then_falls_back_to_numeric(self):
+        make_inflection_question = app.make_inflection_question
+
+        def slow_inflection_question(b, c, p, numeric=False):
+            if not numeric:
+                time.sleep(5)
+            return make_inflection_question(b, c, p, numeric)
+
+        budget, redraws = app.GENERATION_BUDGET, app.GENERATION_REDRAWS
+        # the numeric build runs under the budget as well, so it has to fit in
+        app.GENERATION_BUDGET, app.GENERATION_REDRAWS = 1, 1
+        app.make_inflection_question = slow_inflection_question
+        timeouts = []
+        try:
+            question = app.generate_question('inflection_polynomial_1,1,0,0,-3,-3,0,0,2,2', timeouts)
+        finally:
+            app.GENERATION_BUDGET, app.GENERATION_REDRAWS = budget, redraws
+            app.make_inflection_question = make_inflection_question
+        self.assertEqual(['redraw', 'numeric'], [timeout['action'] for timeout in timeouts])
+        self.assertEqual('inflection_polynomial_1,1,0,0,-3,-3,0,0,2,2', timeouts[0]['template'])
+        self.assertEqual([1, 0, -3, 0, 2], timeouts[0]['p'])
+        self.assertEqual('בחר בנקודת פיתול אפשרית של הפונקציה', question[0])
+        self.assertIn(question[2][0], [-0.707, 0.707])
+
+    def test_generation_budget_skips_a_numeric_build_that_runs_over(self):
+        make_inflection_question = app.make_inflection_question
+
+        def stuck_inflection_question(b, c, p, numeric=False):
+            time.sleep(5)
+            return make_inflection_question(b, c, p, numeric)
+
+        budget, redraws = app.GENERATION_BUDGET, app.GENERATION_REDRAWS
+        app.GENERATION_BUDGET, app.GENERATION_REDRAWS = 0.1, 0
+        app.make_inflection_question = stuck_inflection_question
+        timeouts = []
+        try:
+            question = app.generate_question('inflection_polynomial_1,1,0,0,-3,-3,0,0,2,2', timeouts)
+        finally:
+            app.GENERATION_BUDGET, app.GENERATION_REDRAWS = budget, redraws
+            app.make_inflection_question = make_inflection_question
+        self.assertIsNone(question)
+        self.assertEqual(['numeric', 'skipped'], [timeout['action'] for timeout in timeouts])
+
+    def test_precomputed_template_draws_from_table(self):
+        template = 'minMaxPoints,intersection_linear_1,2,0,1'
+        self.assertEqual(8, app.template_size(template))
+        table = app.PrecomputedTemplate(template)
+        table.compute()
+        report = table.report()
+        self.assertTrue(report['done'])
+        self.assertEqual(8, report['questions'] + len(report['degenerate']))
+        app.PRECOMPUTED_TEMPLATES[template] = table
+        try:
+            questions = app.generate_questions(template)
+        finally:
+            del app.PRECOMPUTED_TEMPLATES[template]
+        self.assertEqual(app.QUESTIONS_TO_GENERATE, len(questions))
+        for question in questions:
+            self.assertIn(question[1], ['y=x', 'y=x+1', 'y=2x', 'y=2x+1'])
+
+    def test_precomputed_template_keeps_its_questions_in_the_store(self):
+        template = 'minMaxPoints,intersection_linear_1,2,0,1'
+        with tempfile.TemporaryDirectory() as directory:
+            store = app.AnswerStore(os.path.join(directory, 'answers.sqlite'), app.ANSWER_STORE_VERSION)
+            table = app.PrecomputedTemplate(template, store)
+            table.compute()
+            self.assertTrue(table.done)
+            self.assertEqual([], table.questions)
+            self.assertEqual(table.size, store.question_count(template))
+            for _ in range(10):
+                self.assertIn(table.draw()[1], ['y=x', 'y=x+1', 'y=2x', 'y=2x+1'])
+            # another process finds the rows and builds nothing
+            app.PRECOMPUTE_EXECUTOR.map = None
+            try:
+                other = app.PrecomputedTemplate(template, store)
+                other.compute()
+            finally:
+                del app.PRECOMPUTE_EXECUTOR.map
+            self.assertTrue(other.done)
+            self.assertEqual(table.size, other.size)
+            self.assertIn(other.draw(), [store.question(template, position) for position in range(other.size)])
+            store.connection.close()
+
+    def test_precompute_template_queues_a_template_once_off_the_generation_workers(self):
+        template = 'minMaxPoints,intersection_linear_1,2,0,2'
+        queued = []
+        put = app.PRECOMPUTE_QUEUE.put
+        app.PRECOMPUTE_QUEUE.put = lambda table: (queued.append(table), put(table))
+        # the students' workers are not used
+        app.GENERATION_EXECUTOR.map = None
+        try:
+            threads = [threading.Thread(target=app.precompute_template, args=(template,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            table = app.PRECOMPUTED_TEMPLATES[template]
+            deadline = time.monotonic() + 60
+            while not table.done and time.monotonic() < deadline:
+                time.sleep(0.1)
+        finally:
+            del app.PRECOMPUTE_QUEUE.put
+            del app.GENERATION_EXECUTOR.map
+            app.PRECOMPUTED_TEMPLATES.pop(template, None)
+        self.assertEqual([table], queued)
+        self.assertTrue(table.done)
+        self.assertEqual(12, table.size + len(table.degenerate))
+
+    def test_warm_answers_stops_at_the_limit(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+        runner = app.app.test_cli_runner()
+        cache = app.ANSWER_CACHE
+        try:
+            app.ANSWER_CACHE = app.AnswerCache(16)
+            self.assertNotEqual(0, runner.invoke(app.warm_answers, ['--limit', '3']).exit_code)
+            with tempfile.TemporaryDirectory() as directory:
+                store = app.AnswerStore(os.path.join(directory, 'answers.sqlite'), app.ANSWER_STORE_VERSION)
+                app.ANSWER_CACHE = app.AnswerCache(16, store)
+                result = runner.invoke(app.warm_answers, ['--limit', '3'])
+                self.assertEqual(0, result.exit_code, result.output)
+                self.assertRegex(result.output, r': 3 questions\n')
+                self.assertEqual(3, app.ANSWER_CACHE.stats()['misses'])
+                store.connection.close()
+        finally:
+            app.ANSWER_CACHE = cache
+
+    def test_getQuestion_fast_path_matches_slow_path(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.teacherOpenUnit('unit1n', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60',
+                                '2023-07-01', 'false', 'unit1', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.startUnit_buisness('class1', 'unit1', 'student1')
+            app.startUnit_buisness('class1', 'unit1n', 'student1')
+            res = app.getQuestion_buisness('student1', 'unit1n', 'class1', '1')
+            app.submitQuestion_buisness('student1', 'unit1n', 'class1', '1', res.json[0]['correct_ans'])
+            with db_session:
+                self.assertIsNotNone(app.current_question('student1', 'unit1n', 'class1'))
+            fast = app.getQuestion_buisness('student1', 'unit1n', 'class1', '2').json
+            current_question = app.current_question
+            app.current_question = lambda user, unit_name, class_name: None
+            try:
+                slow = app.getQuestion_buisness('student1', 'unit1n', 'class1', '2').json
+            finally:
+                app.current_question = current_question
+            self.assertEqual(slow, fast)
+            self.assertEqual((2, 2, 1, 2), (fast[0]['id'], fast[0]['currentUnit'], fast[0]['currentQuestion'],
+                                            fast[0]['totalUnits']))
+            self.assertEqual(400, app.getQuestion_buisness('student1', 'missing', 'class1', '1')[1])
 
 
 
@@ -1,8 +1,8 @@
 import json
 import unittest
-from pony.orm import db_session, Database
+from pony.orm import db_session, Database, set_sql_debug
 from flaskProject import app
-from flaskProject.Tests.UnitTests import initiate_database
+from flaskProject.Tests.UnitTests import initiate_database, clear_database
 from flaskProject.app import DB
 
 
@@ -24,13 +24,7 @@ class MyTestCase(unittest.TestCase):
     def tearDown(self) -> None:
         with app.app.app_context():
             app.activeControllers = {}
-        with db_session:
-            DB.execute('DELETE FROM ActiveUnit WHERE 1=1;')
-            DB.execute('DELETE FROM Question WHERE 1=1;')
-            DB.execute('DELETE FROM Unit WHERE 1=1;')
-            DB.execute('DELETE FROM Cls_User WHERE 1=1;')
-            DB.execute('DELETE FROM Cls WHERE 1=1;')
-            DB.execute('DELETE FROM User WHERE 1=1;')
+        clear_database()
 
 
     def test_1good_1bad_successful(self):
@@ -179,8 +173,53 @@ class MyTestCase(unittest.TestCase):
             self.assertEqual(data3[0]['answer' + str(data3[0]['correct_ans'])], stats[0]['student1'][2]['answer' + str(data3[0]['correct_ans'])])
             self.assertEqual(data4[0]['answer' + str(data4[0]['correct_ans'])], stats[0]['student1'][3]['answer' + str(data4[0]['correct_ans'])])
 
-
-
+    # the query plans of the SELECTs call() runs, by statement
+    def query_plans(self, call):
+        set_sql_debug(True, show_values=False)
+        try:
+            with self.assertLogs('pony.orm.sql', level='INFO') as logs:
+                call()
+        finally:
+            set_sql_debug(False)
+        plans = {}
+        with db_session:
+            connection = DB.get_connection()
+            for record in logs.records:
+                sql = record.getMessage()
+                if sql.startswith('SELECT'):
+                    rows = connection.execute('EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?')).fetchall()
+                    plans[sql] = [row[-1] for row in rows]
+        return plans
+
+    def test_hot_lookups_use_indexes(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '5', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.registerClass_buisness('student1', 'class1')
+            app.approveStudentToClass_buisness('teacher1', 'student1', 'class1', 'True')
+            app.register_buisness('student2', 'password', 2)
+            app.registerClass_buisness('student2', 'class1')
+            app.startUnit_buisness('class1', 'unit1', 'student1')
+            ques = app.getQuestion_buisness('student1', 'unit1', 'class1', '1')
+            app.submitQuestion_buisness('student1', 'unit1', 'class1', '1', ques.json[0]['correct_ans'])
+            client = app.app.test_client()
+            calls = {
+                'individualStats': lambda: app.individualStats_buisness('class1', 'unit1', 'teacher1', 'student1'),
+                'getClassesStudent': lambda: app.getClassesStudent_buisness('student1'),
+                'getUnapprovedStudents': lambda: app.getUnapprovedStudents_buisness('teacher1'),
+                'getLessonCorrect': lambda: client.get('/getLessonCorrect?usernameS=student1&unitName=unit1'
+                                                       '&className=class1&correct=Correct'),
+            }
+            for name, call in calls.items():
+                plans = self.query_plans(call)
+                self.assertTrue(plans, name)
+                for sql, plan in plans.items():
+                    scans = [step for step in plan if step.startswith('SCAN')]
+                    self.assertEqual([], scans, '%s falls back to a table scan in\n%s' % (name, sql))
+            self.assertEqual(['student2'], [r['primary'] for r in app.getUnapprovedStudents_buisness('teacher1').json])
 
 
 
@@ -1,9 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 from pony.orm import db_session, Database
 from flaskProject import app
-from flaskProject.Tests.UnitTests import initiate_database
+from flaskProject.Tests.UnitTests import initiate_database, clear_database
 from flaskProject.app import DB, Unit
 
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+# a unit started, answered twice and summed up, all through the raw SQL paths, on a database of its own
+SMOKE_SCRIPT = """
+import json
+from flaskProject import app
+with app.app.app_context():
+    app.register_buisness('teacher1', 'password', 1)
+    app.openClass_buisness('teacher1', 'class1')
+    app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '2', '60', '2023-07-01',
+                        'true', 'new', 'desc')
+    app.register_buisness('student1', 'password', 2)
+    app.registerClass_buisness('student1', 'class1')
+    app.approveStudentToClass_buisness('teacher1', 'student1', 'class1', 'True')
+    app.startUnit_buisness('class1', 'unit1', 'student1')
+    question = app.getQuestion_buisness('student1', 'unit1', 'class1', '1').json[0]
+    results = [app.submitQuestion_buisness('student1', 'unit1', 'class1', '1', question['correct_ans']),
+               app.submitQuestion_buisness('student1', 'unit1', 'class1', '1', -1),
+               app.getAllActiveUnits('class1', 'unit1'),
+               app.getLessonCorrectIncorrect('student1', 'unit1', 'class1')]
+app.DB.drop_all_tables(with_all_data=True)
+print('smoke result: ' + json.dumps(results))
+"""
 
 
 
@@ -24,13 +51,7 @@ class MyTestCase(unittest.TestCase):
     def tearDown(self) -> None:
         with app.app.app_context():
             app.activeControllers = {}
-        with db_session:
-            DB.execute('DELETE FROM ActiveUnit WHERE 1=1;')
-            DB.execute('DELETE FROM Question WHERE 1=1;')
-            DB.execute('DELETE FROM Unit WHERE 1=1;')
-            DB.execute('DELETE FROM Cls_User WHERE 1=1;')
-            DB.execute('DELETE FROM Cls WHERE 1=1;')
-            DB.execute('DELETE FROM User WHERE 1=1;')
+        clear_database()
 
     def test_editUnit_incorrect_teacher(self):
         # Add test data
@@ -246,6 +267,24 @@ class MyTestCase(unittest.TestCase):
             # Assert that the correct response was returned
             self.assertEqual(result, "deleted successfully")
 
+    def test_deleteUnit_repoints_the_previous_unit(self):
+        with db_session:
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.teacherOpenUnit('unit2', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60', '2023-07-01',
+                                'false', 'unit1', 'desc')
+            app.teacherOpenUnit('unit3', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60', '2023-07-01',
+                                'false', 'unit2', 'desc')
+
+            self.assertEqual("deleted successfully", app.deleteUnit_buisness('unit2', 'class1', 'teacher1'))
+        with db_session:
+            first = Unit['unit1', app.Cls['class1']]
+            self.assertEqual('unit3', first.next)
+            self.assertEqual(['unit1', 'unit3'], [u.name for u in app.lesson_units(first)])
+            self.assertEqual(2, app.lesson_entry(Unit['unit3', app.Cls['class1']]).position)
+
     def test_deleteUnit_incorrect_unit_name(self):
         with db_session:
             # Create teacher account and open a class and a unit
@@ -424,6 +463,107 @@ class MyTestCase(unittest.TestCase):
                     self.assertEqual(1, dic['bad'], 'Not 1 mistakes for student1')
                     self.assertEqual(0, dic['correct'], 'Not 0 correct for student1')
 
+    def test_getAllActiveUnits_sums_over_unit_chain(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            app.teacherOpenUnit('unit2', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60', '2023-07-01',
+                                'false', 'unit1', 'desc')
+            app.register_buisness('student1', 'password', 2)
+            app.register_buisness('student2', 'password', 2)
+            with db_session:
+                unit1 = Unit['unit1', app.Cls['class1']]
+                unit2 = Unit['unit2', app.Cls['class1']]
+                for unit, student, attempt, current, correct in [(unit1, 'student2', 1, 3, 1),
+                                                                 (unit1, 'student2', 2, 4, 4),
+                                                                 (unit2, 'student2', 1, 2, 0),
+                                                                 (unit2, 'student1', 1, 5, 3)]:
+                    app.ActiveUnit(inProgress=False, attempt=attempt, unit=unit, student=app.User[student],
+                                   consecQues=0, quesAmount=0, currentQuestion=current, totalCorrect=correct)
+            self.assertEqual([{'name': 'student2', 'correct': 5, 'bad': 4},
+                              {'name': 'student1', 'correct': 3, 'bad': 2}],
+                             app.getAllActiveUnits('class1', 'unit1'))
+            self.assertEqual([{'name': 'student2', 'correct': 0, 'bad': 2},
+                              {'name': 'student1', 'correct': 3, 'bad': 2}],
+                             sorted(app.getAllActiveUnits('class1', 'unit2'), key=lambda d: d['name'], reverse=True))
+            self.assertEqual([{'name': 'student1', 'correct': 3, 'bad': 2}],
+                             app.getAllActiveUnits('class1', 'unit1', 'student1'))
+            self.assertEqual(400, app.getAllActiveUnits('class1', 'missing')[1])
+
+    def test_lesson_keeps_units_in_order(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            app.teacherOpenUnit('unit1', 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60', '2023-07-01',
+                                'true', 'new', 'desc')
+            for prev, name in [('unit1', 'unit2'), ('unit2', 'unit3'), ('unit3', 'unit4')]:
+                app.teacherOpenUnit(name, 'teacher1', 'class1', 'intersection_linear_-10,0,1,6', '1', '60',
+                                    '2023-07-01', 'false', prev, 'desc')
+            with db_session:
+                names = [u.name for u in app.lesson_units(Unit['unit2', app.Cls['class1']])]
+            self.assertEqual(['unit2', 'unit3', 'unit4'], names)
+            app.editUnit_buisness('unit2', 'class1', 'unit2b', '1', '60', '2023-07-01', 'desc', 'teacher1')
+            app.removeUnit_buisness('unit4', 'class1', 'teacher1')
+            with db_session:
+                names = [u.name for u in app.lesson_units(Unit['unit1', app.Cls['class1']])]
+                self.assertEqual(['unit1', 'unit2b', 'unit3'], names)
+                self.assertEqual('unit2b', Unit['unit1', app.Cls['class1']].next)
+                self.assertEqual('', Unit['unit3', app.Cls['class1']].next)
+
+    def test_lesson_migrated_from_next_links(self):
+        with app.app.app_context():
+            app.register_buisness('teacher1', 'password', 1)
+            app.openClass_buisness('teacher1', 'class1')
+            with db_session:
+                cls = app.Cls['class1']
+                for name, order, nxt in [('c', 3, ''), ('a', 1, 'b'), ('b', 2, 'c'), ('x', 1, '')]:
+                    Unit(cls=cls, name=name, desc='', template='intersection_linear_-10,0,1,6', Qnum='1',
+                         maxTime='60', subDate='2023-07-01', order=order, next=nxt)
+            result = app.app.test_cli_runner().invoke(app.index_lessons_command)
+            self.assertEqual(0, result.exit_code)
+            self.assertIn('2 lessons, 4 units', result.output)
+            with db_session:
+                self.assertEqual(['a', 'b', 'c'], [u.name for u in app.lesson_units(Unit['a', app.Cls['class1']])])
+                self.assertEqual(['x'], [u.name for u in app.lesson_units(Unit['x', app.Cls['class1']])])
+                self.assertEqual(2, app.Lesson.select().count())
+
+    def test_dbProfile_reports_sqlite_pragmas(self):
+        res = app.app.test_client().get('/dbProfile')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('wal', res.json['journal_mode'])
+        self.assertEqual(app.SQLITE_PROFILE['busy_timeout'], res.json['busy_timeout'])
+        self.assertEqual(app.SQLITE_PROFILE['cache_size'], res.json['cache_size'])
+
+    def test_bind_database_builds_the_same_schema(self):
+        with tempfile.TemporaryDirectory() as folder:
+            db = Database()
+            app.bind_database(db, 'sqlite', filename=os.path.join(folder, 'other.sqlite'))
+            self.assertEqual(sorted(app.DB.entities), sorted(db.entities))
+            with db_session:
+                self.assertEqual('wal', db.execute('PRAGMA journal_mode').fetchone()[0])
+            db.disconnect()
+
+    def test_raw_sql_smoke_per_provider(self):
+        with tempfile.TemporaryDirectory() as folder:
+            providers = {
+                'sqlite': {'MATHEMATIX_SQLITE_PATH': os.path.join(folder, 'smoke.sqlite')},
+                'postgres': {'MATHEMATIX_DATABASE_URL': os.environ.get('MATHEMATIX_TEST_DATABASE_URL', '')}
+            }
+            for provider, settings in providers.items():
+                with self.subTest(provider=provider):
+                    if not all(settings.values()):
+                        self.skipTest('set MATHEMATIX_TEST_DATABASE_URL to an empty database to run on ' + provider)
+                    env = dict(os.environ, MATHEMATIX_DB_PROVIDER=provider, **settings)
+                    run = subprocess.run([sys.executable, '-c', SMOKE_SCRIPT], cwd=REPO_ROOT, env=env,
+                                         capture_output=True, text=True, timeout=300)
+                    self.assertEqual(0, run.returncode, run.stderr)
+                    # the generation workers print to the same stdout, possibly right after the result
+                    result, _ = json.JSONDecoder().raw_decode(run.stdout.split('smoke result: ')[-1])
+                    self.assertEqual(['correct', 'correct', [{'name': 'student1', 'correct': 1, 'bad': 0}], [1, 0]],
+                                     result)
+
     def test_getAllActiveUnits_no_class_failure(self):
         with app.app.app_context():
             # Create teacher account and open a class and a unit
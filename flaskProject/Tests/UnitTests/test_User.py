@@ -1,7 +1,9 @@
+import os
+import tempfile
 import unittest
 from pony.orm import db_session, Database
 from flaskProject import app
-from flaskProject.Tests.UnitTests import initiate_database
+from flaskProject.Tests.UnitTests import initiate_database, clear_database
 from flaskProject.app import User, DB, studentCont
 from unittest.mock import patch, MagicMock
 
@@ -23,13 +25,7 @@ class MyTestCase(unittest.TestCase):
     def tearDown(self) -> None:
         with app.app.app_context():
             app.activeControllers = {}
-        with db_session:
-            DB.execute('DELETE FROM ActiveUnit WHERE 1=1;')
-            DB.execute('DELETE FROM Question WHERE 1=1;')
-            DB.execute('DELETE FROM Unit WHERE 1=1;')
-            DB.execute('DELETE FROM Cls_User WHERE 1=1;')
-            DB.execute('DELETE FROM Cls WHERE 1=1;')
-            DB.execute('DELETE FROM User WHERE 1=1;')
+        clear_database()
 
     def test_valid_username(self):
         # Test that a valid username returns True
@@ -196,6 +192,61 @@ class MyTestCase(unittest.TestCase):
         # Assert that activeControllers has not been modified
         self.assertEqual(len(app.activeControllers), 1)
 
+    def test_sqlite_session_store_is_shared_between_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sessions.sqlite')
+            worker_a = app.SQLiteSessionStore(path, ttl=60)
+            worker_b = app.SQLiteSessionStore(path, ttl=60)
+            worker_a['teacher1'] = app.teacherCont('teacher1')
+            worker_a['student1'] = app.userCont('student1')
+            self.assertIn('teacher1', worker_b)
+            self.assertIsInstance(worker_b['teacher1'], app.teacherCont)
+            self.assertEqual({'student1'}, worker_b.online(['student1', 'student2']))
+            self.assertIsInstance(worker_b.pop('student1'), app.userCont)
+            self.assertNotIn('student1', worker_a)
+            self.assertEqual(1, len(worker_a))
+            # sessions expire after their ttl
+            short = app.SQLiteSessionStore(path, ttl=-1)
+            short['student2'] = app.userCont('student2')
+            self.assertNotIn('student2', worker_a)
+            self.assertEqual(1, worker_a.purge())
+            for store in (worker_a, worker_b, short):
+                store.connection.close()
+
+    def test_sqlite_session_store_gives_back_the_controllers_of_loadController(self):
+        app.register_buisness('teacher1', 'password', 1)
+        app.register_buisness('student1', 'password', 2)
+        with tempfile.TemporaryDirectory() as directory:
+            store = app.SQLiteSessionStore(os.path.join(directory, 'sessions.sqlite'), ttl=60)
+            memory = {}
+            for sessions in (store, memory):
+                with patch.object(app, 'activeControllers', sessions):
+                    app.loadController('teacher1')
+                    app.loadController('student1')
+            for username in ('teacher1', 'student1'):
+                self.assertIs(type(memory[username]), type(store[username]))
+            store.connection.close()
+
+    def test_session_sweeper_evicts_idle_users(self):
+        sweeper = app.SessionSweeper(idle_timeout=60, interval=3600)
+        self.addCleanup(sweeper.stop)
+        reports = []
+        sweeper.hooks.append(reports.append)
+        sessions = {'student1': app.userCont('student1'), 'student2': app.userCont('student2')}
+        with patch.object(app, 'activeControllers', sessions):
+            sweeper.touch('student1')
+            sweeper.touch('student2')
+            # student2 has not sent a request for more than idle_timeout seconds
+            sweeper.last_seen['student2'] -= 120
+            self.assertEqual(1, sweeper.sweep())
+            self.assertEqual(['student1'], list(app.activeControllers))
+            self.assertEqual({'student1'}, app.online_users(['student1', 'student2']))
+            self.assertEqual(1, reports[-1]['active_sessions'])
+            self.assertEqual(1, reports[-1]['evicted'])
+            self.assertNotIn('student2', sweeper.last_seen)
+        sweeper.stop(timeout=5)
+        self.assertFalse(sweeper.worker.is_alive())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,26 @@
+import concurrent.futures
+import copy
+import functools
+import itertools
 import logging
 import math
+import multiprocessing
+import os
+import pickle
+import queue
 import random
+import signal
+import sqlite3
+import threading
+import time
 import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime
+
+import click
 from flask import Flask, request, jsonify, make_response
 from collections.abc import Iterable
 from flask_pony import Pony
@@ -18,7 +36,7 @@ from math import inf, e
 # import time
 #
 from sympy import symbols, Poly, Pow, ln, sin, cos, tan, cot, degree, diff, solve, log, N, pi, Add, Rational, Mul, sign, \
-    I, Union, Interval, root, S, sympify
+    I, Union, Interval, root, S, sympify, lambdify
 from sympy.calculus.util import continuous_domain
 
 app = Flask(__name__)
@@ -27,85 +45,522 @@ CORS(app)
 DB = pony.Database()
 Pony(app)
 
-DB.bind(provider='sqlite', filename='dbtest.sqlite', create_db=True)
+# Pragmas every connection to the database gets. WAL lets readers go on while a writer commits, the busy timeout
+# makes writers wait for the lock instead of failing right away under concurrent requests.
+SQLITE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # negative is in KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,  # milliseconds
+}
+
+
+# sqlite for development and the tests, postgres in production. Pony keeps one connection per worker thread
+# open and reuses it. Raw SQL goes through sql() so it uses the names each provider gives the tables.
+DB_PROVIDER = os.environ.get('MATHEMATIX_DB_PROVIDER', 'sqlite')
+# DB.bind arguments per provider, an empty postgres dsn takes the connection from the PGHOST, PGUSER, ... variables
+DB_SETTINGS = {
+    'sqlite': {'filename': os.environ.get('MATHEMATIX_SQLITE_PATH', 'dbtest.sqlite'), 'create_db': True,
+               'timeout': SQLITE_PROFILE['busy_timeout'] / 1000},
+    'postgres': {'dsn': os.environ.get('MATHEMATIX_DATABASE_URL', '')},
+}
+
+
+def apply_sqlite_profile(db, connection):
+    cursor = connection.cursor()
+    for pragma, value in SQLITE_PROFILE.items():
+        cursor.execute('PRAGMA %s = %s' % (pragma, value))
+
 
 DATATYPE_SIZE = 3
 QUESTIONTYPE_SIZE = 4
 QUESTIONS_TO_GENERATE = 10
 MAX_RANGE = 10
 MIN_RANGE = -10
+# processes building questions (see GenerationExecutor), MATHEMATIX_GENERATION_WORKERS or else one per core
+GENERATION_WORKERS = int(os.environ.get('MATHEMATIX_GENERATION_WORKERS', 0)) or os.cpu_count() or 1
+GENERATION_TIMEOUT = 10
+GENERATION_RETRIES = 2
+GENERATION_BUDGET = 2
+GENERATION_REDRAWS = 2
+GENERATION_TIMEOUT_LOG_SIZE = 200
+# 'memory' keeps the logged in users in this process, 'sqlite' in SESSION_STORE_PATH for every worker process
+SESSION_BACKEND = os.environ.get('MATHEMATIX_SESSION_BACKEND', 'memory')
+SESSION_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.sqlite')
+SESSION_TTL = 30 * 60
+SESSION_TOUCH_INTERVAL = 60
+SESSION_SWEEP_INTERVAL = 60
+# seconds a teacher's roster in PRESENCE_INDEX is kept before it is read from the db again
+PRESENCE_ROSTER_TTL = 30
+PRECOMPUTE_ENABLED = True
+PRECOMPUTE_MAX_QUESTIONS = 500
+PRECOMPUTE_WORKERS = 1
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_SIZE = 4096
+# the answer store is off unless MATHEMATIX_ANSWER_STORE names its file (e.g. flaskProject/answers.sqlite)
+ANSWER_STORE_PATH = os.environ.get('MATHEMATIX_ANSWER_STORE', '')
+ANSWER_STORE_ENABLED = bool(ANSWER_STORE_PATH)
+# bump whenever a change to the math code changes the answers, older stored answers are then ignored
+ANSWER_STORE_VERSION = 3
+QUESTION_POOL_ENABLED = True
+QUESTION_POOL_DEPTH = 30
+QUESTION_POOL_LOW_WATERMARK = 10
+QUESTION_POOL_MAX_PER_TEMPLATE = 100
+QUESTION_POOL_MAX_TEMPLATES = 256
+# the next batch of an attempt is generated once the student is this many questions (or fewer) from its end
+QUESTION_REFILL_AHEAD = 3
+QUESTION_REFILL_WORKERS = 4
+# how long /getQuestion waits for a refill that is still running before it answers that the questions are pending
+QUESTION_REFILL_WAIT = 2
+# 'wsgi' runs app (the flask dev server, or any WSGI server), 'asgi' runs asgi_app (see AsgiApp) under uvicorn
+SERVING_MODE = os.environ.get('MATHEMATIX_SERVING_MODE', 'wsgi')
+ASGI_READ_WORKERS = 32
+ASGI_GENERATION_WORKERS = GENERATION_WORKERS
+# the routes that may generate questions while the client waits
+ASGI_GENERATION_ROUTES = ('/startUnit',)
+
+
+# The whole schema, declared on db. The app and the tests both bind their database through bind_database so
+# there is only this one definition.
+def define_entities(db):
+    class User(db.Entity):
+        name = PrimaryKey(str)
+        password = Required(str)
+        type = Required(int)
+        teaching = Set('Cls', reverse='teacher', cascade_delete=False)
+        inClass = Set('Cls_User', cascade_delete=False)
+        activeUnits = Set("ActiveUnit", reverse='student')
+        lessonProgress = Set('LessonProgress', reverse='student')
+
+
+    class Cls(db.Entity):
+        name = PrimaryKey(str)
+        teacher = Required(User, reverse='teaching')
+        students = Set('Cls_User')
+        hasUnits = Set('Unit', reverse='cls', cascade_delete=False)
+        lessons = Set('Lesson', reverse='cls')
+
+
+    class Cls_User(db.Entity):
+        cls = Required(Cls)
+        user = Required(User)
+        approved = Required(bool)
+        PrimaryKey(cls, user)
+        composite_index(user, approved)
+
+
+    class Unit(db.Entity):
+        name = Required(str)
+        cls = Required(Cls, reverse='hasUnits')
+        desc = Optional(str)
+        template = Required(str)
+        Qnum = Required(str)
+        maxTime = Required(str)
+        subDate = Required(str)
+        instances = Set('ActiveUnit', reverse='unit')
+        order = Required(int)
+        next = Optional(str)
+        lesson_unit = Optional('LessonUnit', reverse='unit', cascade_delete=True)
+        PrimaryKey(name, cls)
+
+
+    class Question(db.Entity):
+        id = Required(int)
+        question_preamble = Required(str)
+        question = Required(str)
+        answer1 = Required(str)
+        answer2 = Required(str)
+        answer3 = Required(str)
+        answer4 = Required(str)
+        correct_ans = Required(int)
+        active_unit = Required('ActiveUnit', reverse='questions')
+        solved_correctly = Optional(bool)
+        solve_time = Optional(str)
+        PrimaryKey(active_unit, id)
+        composite_index(active_unit, solved_correctly)
+
+
+    class ActiveUnit(db.Entity):
+        inProgress = Required(bool)
+        attempt = Required(int)
+        questions = Set('Question', reverse='active_unit')
+        unit = Required(Unit, reverse='instances')
+        student = Required(User, reverse='activeUnits')
+        grade = Optional(int)
+        consecQues = Required(int)
+        quesAmount = Required(int)
+        currentQuestion = Required(int)
+        totalCorrect = Required(int)
+        lastTimeAnswered = Optional(str)
+        PrimaryKey(unit, student, attempt)
+
+
+    # The sums of the first attempts of a run of units of a lesson the student started one after the other, the
+    # units at positions first .. first + units - 1 (see LessonUnit), so they don't have to be walked unit by unit.
+    # One row per student and lesson.
+    class LessonProgress(db.Entity):
+        student = Required(User, reverse='lessonProgress')
+        lesson = Required('Lesson', reverse='progress')
+        first = Required(int)
+        units = Required(int)
+        correct = Required(int)
+        solved = Required(int)
+        PrimaryKey(student, lesson)
+
+
+    # The units chained with Unit.next, in order. Unit.next and Unit.order are still kept up to date for the
+    # clients, but the server walks lessons with a range query over (lesson, position) instead of unit by unit.
+    class Lesson(db.Entity):
+        cls = Required(Cls, reverse='lessons')
+        units = Set('LessonUnit', reverse='lesson')
+        progress = Set(LessonProgress, reverse='lesson')
+
+
+    class LessonUnit(db.Entity):
+        unit = PrimaryKey(Unit, reverse='lesson_unit')
+        lesson = Required(Lesson, reverse='units')
+        position = Required(int)
+        composite_index(lesson, position)
+
+    return User, Cls, Cls_User, Unit, Question, ActiveUnit, LessonProgress, Lesson, LessonUnit
+
+
+# Indexes that can't be declared on the entities: a composite_index makes its Optional attributes nullable, and
+# ActiveUnit.lastTimeAnswered is NOT NULL in the existing databases. (unit, student) lookups are covered by the
+# ActiveUnit primary key, and Pony indexes every foreign key (Cls.teacher, ActiveUnit.student, ...) on its own.
+EXTRA_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_activeunit__student_lasttimeanswered '
+    'ON {ActiveUnit} ({ActiveUnit.student}, {ActiveUnit.lastTimeAnswered})',
+]
+
+
+# Quoted table and column names of an entity as the provider maps them (postgres lowercases them), for the raw
+# SQL Pony queries can't express: the atomic counter updates, the bulk inserts and the single /getQuestion query.
+# str() of it is the table, every attribute the column of the attribute, or the list of its columns for
+# composite foreign keys. See sql().
+class SqlNames:
+
+    def __init__(self, db, entity):
+        self.table = db.provider.quote_name(entity._table_)
+        for attr in entity._attrs_:
+            if attr.columns:
+                columns = [db.provider.quote_name(column) for column in attr.columns]
+                setattr(self, attr.name, columns[0] if len(columns) == 1 else columns)
+
+    def __str__(self):
+        return self.table
+
+
+def sql_names(db, entities):
+    return {entity.__name__: SqlNames(db, entity) for entity in entities}
+
+
+def bind_database(db, provider, create_tables=True, **settings):
+    if provider == 'sqlite':
+        db.on_connect(provider='sqlite')(apply_sqlite_profile)
+    db.bind(provider=provider, **dict(DB_SETTINGS[provider], **settings))
+    entities = define_entities(db)
+    db.generate_mapping(create_tables=create_tables, check_tables=create_tables)
+    if create_tables:
+        names = sql_names(db, entities)
+        with db_session:
+            for index in EXTRA_INDEXES:
+                db.execute(index.format(**names))
+    return entities
+
+
+# True while a generation worker (see GENERATION_CONTEXT) imports this module to unpickle its task, the same flag
+# multiprocessing itself checks before re-importing __main__. The workers never query the database, and creating
+# the tables would wait on the write lock of the request that waits on them.
+GENERATION_WORKER = getattr(multiprocessing.current_process(), '_inheriting', False)
+
+User, Cls, Cls_User, Unit, Question, ActiveUnit, LessonProgress, Lesson, LessonUnit = bind_database(
+    DB, DB_PROVIDER, create_tables=not GENERATION_WORKER)
+SQL_NAMES = sql_names(DB, (User, Cls, Cls_User, Unit, Question, ActiveUnit, LessonProgress, Lesson, LessonUnit))
+
+
+# statement with every {Entity}, {Entity.attribute} and {Entity.attribute[i]} replaced by the name the provider
+# gave it, e.g. sql('SELECT {Unit.Qnum} FROM {Unit}')
+@functools.lru_cache(maxsize=None)
+def sql(statement):
+    return statement.format(**SQL_NAMES)
+
+
+# Puts the units of cls that are not in a lesson yet into lessons, following Unit.next from the units no other
+# unit points to (and then from whatever is left, for broken chains). This is the migration from the old
+# next/order columns, and also indexes units created without going through teacherOpenUnit.
+def index_lessons(cls):
+    units = {u.name: u for u in cls.hasUnits}
+    indexed = set(select(e.unit.name for e in LessonUnit if e.unit.cls == cls))
+    following = {u.next for u in units.values() if u.next}
+    heads = sorted(units.values(), key=lambda u: (u.name in following, u.order, u.name))
+    for head in heads:
+        if head.name in indexed:
+            continue
+        lesson = Lesson(cls=cls)
+        unit = head
+        position = 1
+        while unit and unit.name not in indexed:
+            LessonUnit(unit=unit, lesson=lesson, position=position)
+            indexed.add(unit.name)
+            position += 1
+            unit = units.get(unit.next)
 
 
-class User(DB.Entity):
-    name = PrimaryKey(str)
-    password = Required(str)
-    type = Required(int)
-    teaching = Set('Cls', reverse='teacher', cascade_delete=False)
-    inClass = Set('Cls_User', cascade_delete=False)
-    activeUnits = Set("ActiveUnit", reverse='student')
-
-
-class Cls(DB.Entity):
-    name = PrimaryKey(str)
-    teacher = Required(User, reverse='teaching')
-    students = Set('Cls_User')
-    hasUnits = Set('Unit', reverse='cls', cascade_delete=False)
-
-
-class Cls_User(DB.Entity):
-    cls = Required(Cls)
-    user = Required(User)
-    approved = Required(bool)
-    PrimaryKey(cls, user)
-
-
-class Unit(DB.Entity):
-    name = Required(str)
-    cls = Required(Cls, reverse='hasUnits')
-    desc = Optional(str)
-    template = Required(str)
-    Qnum = Required(str)
-    maxTime = Required(str)
-    subDate = Required(str)
-    instances = Set('ActiveUnit', reverse='unit')
-    order = Required(int)
-    next = Optional(str)
-    PrimaryKey(name, cls)
-
-
-class Question(DB.Entity):
-    id = Required(int)
-    question_preamble = Required(str)
-    question = Required(str)
-    answer1 = Required(str)
-    answer2 = Required(str)
-    answer3 = Required(str)
-    answer4 = Required(str)
-    correct_ans = Required(int)
-    active_unit = Required('ActiveUnit', reverse='questions')
-    solved_correctly = Optional(bool)
-    solve_time = Optional(str)
-    PrimaryKey(active_unit, id)
-
-
-class ActiveUnit(DB.Entity):
-    inProgress = Required(bool)
-    attempt = Required(int)
-    questions = Set('Question', reverse='active_unit')
-    unit = Required(Unit, reverse='instances')
-    student = Required(User, reverse='activeUnits')
-    grade = Optional(int)
-    consecQues = Required(int)
-    quesAmount = Required(int)
-    currentQuestion = Required(int)
-    totalCorrect = Required(int)
-    lastTimeAnswered = Optional(str)
-    PrimaryKey(unit, student, attempt)
-
-
-DB.generate_mapping(create_tables=True)
-
-activeControllers = {}
+def index_all_lessons():
+    with db_session:
+        for cls in select(u.cls for u in Unit if u.lesson_unit is None)[:]:
+            index_lessons(cls)
+
+
+# Indexes the lessons of every class that has units outside of one, once after upgrading from the next/order
+# columns. Classes left out are indexed the first time one of their units is used (see lesson_entry).
+# Run with: flask --app app index-lessons
+@app.cli.command('index-lessons')
+def index_lessons_command():
+    index_all_lessons()
+    with db_session:
+        click.echo("%d lessons, %d units in them" % (Lesson.select().count(), LessonUnit.select().count()))
+
+
+# the LessonUnit of unit, indexing its class first if it has none yet
+def lesson_entry(unit):
+    if unit.lesson_unit is None:
+        index_lessons(unit.cls)
+    return unit.lesson_unit
+
+
+# unit and the units after it in its lesson, in order
+def lesson_units(unit):
+    entry = lesson_entry(unit)
+    return Unit.select(lambda u: u.lesson_unit.lesson == entry.lesson and u.lesson_unit.position >= entry.position) \
+        .order_by(lambda u: u.lesson_unit.position)[:]
+
+
+# the unit before unit in its lesson, None for the first one
+def previous_unit(unit):
+    entry = lesson_entry(unit)
+    return Unit.get(lambda u: u.lesson_unit.lesson == entry.lesson and u.lesson_unit.position == entry.position - 1)
+
+# Logged in users in a SQLite file, so every worker process sees the same sessions. Works like the
+# activeControllers dict (username -> controller) and adds a bulk online() query. Only the controller type is
+# stored, the controller is rebuilt on every lookup: a teacherCont for typ 1, else the userCont loadController
+# logs students in with. A session expires ttl seconds after its last request
+# (see touch).
+class SQLiteSessionStore:
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # a forked worker process must not use its parent's connection
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sessions (username TEXT PRIMARY KEY, typ INTEGER, '
+                                    'expires REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)')
+            self.pid = os.getpid()
+        return self.connection
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connect().execute(sql, parameters).fetchall()
+
+    def delete(self, where, parameters=()):
+        with self.lock:
+            return self.connect().execute('DELETE FROM sessions WHERE ' + where, parameters).rowcount
+
+    def __setitem__(self, username, controller):
+        self.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                     (username, controller.typ, time.time() + self.ttl))
+
+    def __getitem__(self, username):
+        rows = self.execute('SELECT typ FROM sessions WHERE username = ? AND expires > ?', (username, time.time()))
+        if not rows:
+            raise KeyError(username)
+        return (teacherCont if rows[0][0] == 1 else userCont)(username)
+
+    def __contains__(self, username):
+        return bool(self.execute('SELECT 1 FROM sessions WHERE username = ? AND expires > ?',
+                                 (username, time.time())))
+
+    def __delitem__(self, username):
+        if not self.delete('username = ?', (username,)):
+            raise KeyError(username)
+
+    def pop(self, username, *default):
+        try:
+            controller = self[username]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self.delete('username = ?', (username,))
+        return controller
+
+    def keys(self):
+        return [row[0] for row in self.execute('SELECT username FROM sessions WHERE expires > ?', (time.time(),))]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.execute('SELECT COUNT(*) FROM sessions WHERE expires > ?', (time.time(),))[0][0]
+
+    # The usernames of the given users that are logged in, in one query per 500 users
+    def online(self, usernames):
+        usernames = list(usernames)
+        now = time.time()
+        online = set()
+        for i in range(0, len(usernames), 500):
+            chunk = usernames[i:i + 500]
+            online.update(row[0] for row in self.execute(
+                'SELECT username FROM sessions WHERE expires > ? AND username IN (%s)' % ','.join('?' * len(chunk)),
+                [now] + chunk))
+        return online
+
+    # Moves the expiry of a live session to ttl seconds from now. Skipped while the session was refreshed less
+    # than SESSION_TOUCH_INTERVAL seconds ago, so not every request writes.
+    def touch(self, username):
+        now = time.time()
+        with self.lock:
+            self.connect().execute('UPDATE sessions SET expires = ? WHERE username = ? AND expires > ? AND expires < ?',
+                                   (now + self.ttl, username, now, now + self.ttl - SESSION_TOUCH_INTERVAL))
+
+    # Deletes the expired sessions, returns how many were deleted
+    def purge(self):
+        return self.delete('expires <= ?', (time.time(),))
+
+
+def make_session_store(backend):
+    if backend == 'sqlite':
+        return SQLiteSessionStore(SESSION_STORE_PATH, SESSION_TTL)
+    return {}
+
+
+activeControllers = make_session_store(SESSION_BACKEND)
+
+
+# Expires idle sessions. Every authenticated request touches its user, a daemon thread started with the first
+# touch sweeps every interval seconds and logs out the users that were idle for more than idle_timeout seconds.
+# The SQLite store keeps the last request time itself (its expiry), for the dict it is kept here.
+# stats() reports the active sessions and the evictions, and is passed to every hook after a sweep.
+# stop() ends the thread (it is started again by the next touch).
+class SessionSweeper:
+
+    def __init__(self, idle_timeout, interval):
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_seen = {}
+        self.recent = deque()
+        self.evicted = 0
+        self.sweeps = 0
+        self.hooks = []
+        self.worker = None
+        self.stopped = threading.Event()
+
+    def touch(self, username):
+        if hasattr(activeControllers, 'touch'):
+            activeControllers.touch(username)
+        with self.lock:
+            if not hasattr(activeControllers, 'touch'):
+                self.last_seen[username] = time.monotonic()
+            if self.worker is None or not self.worker.is_alive():
+                self.stopped.clear()
+                self.worker = threading.Thread(target=self.run, name='session-sweeper', daemon=True)
+                self.worker.start()
+
+    def forget(self, username):
+        with self.lock:
+            self.last_seen.pop(username, None)
+
+    def sweep(self):
+        now = time.monotonic()
+        sessions = activeControllers
+        if hasattr(sessions, 'purge'):
+            evicted = sessions.purge()
+        else:
+            evicted = 0
+            for username in list(sessions.keys()):
+                with self.lock:
+                    seen = self.last_seen.setdefault(username, now)
+                if now - seen > self.idle_timeout and sessions.pop(username, None) is not None:
+                    PRESENCE_INDEX.logout(username)
+                    evicted += 1
+            with self.lock:
+                for username in [username for username in self.last_seen if username not in sessions]:
+                    del self.last_seen[username]
+        with self.lock:
+            self.evicted += evicted
+            self.sweeps += 1
+            self.recent.append((now, evicted))
+            while self.recent[0][0] < now - 3600:
+                self.recent.popleft()
+        stats = self.stats()
+        for hook in self.hooks:
+            try:
+                hook(stats)
+            except Exception:
+                app.logger.exception("session metrics hook failed")
+        return evicted
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                app.logger.exception("session sweep failed")
+
+    def stop(self, timeout=None):
+        with self.lock:
+            self.stopped.set()
+            worker = self.worker
+        if worker is not None:
+            worker.join(timeout)
+
+    def stats(self):
+        active = len(activeControllers)
+        with self.lock:
+            minutes = max(1.0, (time.monotonic() - self.recent[0][0]) / 60) if self.recent else 1.0
+            return {
+                "active_sessions": active,
+                "evicted": self.evicted,
+                "evictions_per_minute": round(sum(evicted for _, evicted in self.recent) / minutes, 3),
+                "sweeps": self.sweeps
+            }
+
+
+SESSION_SWEEPER = SessionSweeper(SESSION_TTL, SESSION_SWEEP_INTERVAL)
+
+
+@app.route('/sessionStats')
+def sessionStats():
+    return jsonify(SESSION_SWEEPER.stats())
+
+
+# The pragmas the database connections actually run with, so load test reports show the profile they ran against
+@app.route('/dbProfile')
+def dbProfile():
+    if DB.provider_name != 'sqlite':
+        return jsonify({'provider': DB.provider_name})
+    with db_session:
+        profile = {pragma: DB.execute('PRAGMA ' + pragma).fetchone()[0] for pragma in SQLITE_PROFILE}
+    profile['provider'] = DB.provider_name
+    return jsonify(profile)
+
+
+# The usernames of the given users that are logged in
+def online_users(usernames):
+    if hasattr(activeControllers, 'online'):
+        return activeControllers.online(usernames)
+    return {username for username in usernames if username in activeControllers}
 
 
 @app.route('/')
@@ -114,8 +569,9 @@ def hello_world():  # put application's code here
 
 
 def isLogin(username):
-    if username not in activeControllers.keys():
+    if username not in activeControllers:
         return False
+    SESSION_SWEEPER.touch(username)
     return True
 
 
@@ -205,6 +661,8 @@ def loadController(username):
         activeControllers[username] = teacherCont(username)
     elif type == 2:
         activeControllers[username] = userCont(username)
+    SESSION_SWEEPER.touch(username)
+    PRESENCE_INDEX.login(username)
     return
 
 
@@ -254,8 +712,10 @@ def logout():
 
 @app.route('/logout')
 def logout_buisness(username):
-    if username in activeControllers.keys():
-        activeControllers.pop(username)
+    if username in activeControllers:
+        activeControllers.pop(username, None)
+    SESSION_SWEEPER.forget(username)
+    PRESENCE_INDEX.logout(username)
     return username + " " + str(len(activeControllers))
 
 
@@ -274,35 +734,132 @@ def getOnlineStudentsOfTeacher():
 # For example: {'john': ['class1', 'class2'], 'doe': []}
 # (Both john and doe are online, and have been approved to the class)
 def getOnlineStudentsOfTeacher_business(teacher):
-    with db_session:
-        classes = Cls.select(lambda c: c.teacher.name == teacher)[:].to_list()
-        classes_users = []
-        for cls in classes:
-            cls_users = Cls_User.select(lambda cu: (cu.cls == cls) and cu.approved)[:].to_list()
-            classes_users.extend(cls_users)
-
-        ret_dic = {}
-        for cls_user in classes_users:
-            if cls_user.user.name not in ret_dic:
-                ret_dic[cls_user.user.name] = []
-            if cls_user.user.name in activeControllers:
-                ret_dic[cls_user.user.name].append(cls_user.cls.name)
-
-        ret = []
-        i = 0
-        for name in ret_dic:
-            single_obj = dict()
-            single_obj["id"] = i
-            single_obj["username"] = name
-            # single_obj["secondary"] = ret_dic[name]
-            single_obj["isLoggedIn"] = len(ret_dic[name]) > 0
-            ret.append(single_obj)
-            # ret.append({'id': i, 'primary': name, 'secondary': ret_dic[name], 'online': len(ret_dic[name]) > 0})
-            i += 1
-
+    ret = []
+    i = 0
+    for name, online in PRESENCE_INDEX.students(teacher):
+        single_obj = dict()
+        single_obj["id"] = i
+        single_obj["username"] = name
+        single_obj["isLoggedIn"] = online
+        ret.append(single_obj)
+        i += 1
     return ret
 
 
+# For every teacher, the approved students of their classes and which of them are online, so the online
+# students screen is answered from memory. A teacher's roster is read from the db (one query) when it is asked
+# for and then kept up to date by approve/remove, which are called once the change is committed. Another worker
+# process may approve or remove a student too, so a roster is only kept for roster_ttl seconds and then read
+# again. The online students are kept up to date by login/logout. With a shared session store (several worker
+# processes) another process may log a student in, so there the online students are asked from the store instead.
+class PresenceIndex:
+
+    def __init__(self, roster_ttl):
+        self.roster_ttl = roster_ttl
+        self.lock = threading.Lock()
+        self.loaded = {}
+        self.rosters = {}
+        self.class_teacher = {}
+        self.teachers_of = {}
+        self.online = {}
+
+    def load(self, teacher):
+        with db_session:
+            rows = select((cu.user.name, cu.cls.name) for cu in Cls_User
+                          if cu.cls.teacher.name == teacher and cu.approved)[:]
+            classes = select(c.name for c in Cls if c.teacher.name == teacher)[:]
+        roster = {}
+        for student, className in rows:
+            roster.setdefault(student, set()).add(className)
+        online = online_users(roster)
+        with self.lock:
+            for student in self.rosters.get(teacher, {}):
+                self.teachers_of[student].discard(teacher)
+            self.loaded[teacher] = time.monotonic()
+            self.rosters[teacher] = roster
+            self.online[teacher] = set(online)
+            for className in classes:
+                self.class_teacher[className] = teacher
+            for student in roster:
+                self.teachers_of.setdefault(student, set()).add(teacher)
+
+    # (student, is online) for every approved student of teacher's classes
+    def students(self, teacher):
+        with self.lock:
+            loaded = teacher in self.rosters and time.monotonic() - self.loaded[teacher] < self.roster_ttl
+        if not loaded:
+            self.load(teacher)
+        with self.lock:
+            roster = list(self.rosters[teacher])
+            online = self.online[teacher]
+            if hasattr(activeControllers, 'online'):
+                online = None
+        if online is None:
+            online = online_users(roster)
+        return [(student, student in online) for student in roster]
+
+    def login(self, username):
+        with self.lock:
+            for teacher in self.teachers_of.get(username, ()):
+                self.online[teacher].add(username)
+
+    def logout(self, username):
+        with self.lock:
+            for teacher in self.teachers_of.get(username, ()):
+                self.online[teacher].discard(username)
+
+    def add_class(self, className, teacher):
+        with self.lock:
+            if teacher in self.rosters:
+                self.class_teacher[className] = teacher
+
+    def approve(self, className, student):
+        with self.lock:
+            teacher = self.class_teacher.get(className)
+            if teacher is None:
+                return
+            self.rosters[teacher].setdefault(student, set()).add(className)
+            self.teachers_of.setdefault(student, set()).add(teacher)
+            if student in activeControllers:
+                self.online[teacher].add(student)
+
+    def remove(self, className, student):
+        with self.lock:
+            teacher = self.class_teacher.get(className)
+            if teacher is None or student not in self.rosters[teacher]:
+                return
+            classes = self.rosters[teacher][student]
+            classes.discard(className)
+            if not classes:
+                del self.rosters[teacher][student]
+                self.online[teacher].discard(student)
+                self.teachers_of[student].discard(teacher)
+
+    # Forgets the roster of the class's teacher, it is read again on the next request (class removed or renamed)
+    def invalidate(self, className):
+        with self.lock:
+            teacher = self.class_teacher.get(className)
+            if teacher is None:
+                return
+            for student in self.rosters.pop(teacher, {}):
+                self.teachers_of[student].discard(teacher)
+            self.loaded.pop(teacher, None)
+            self.online.pop(teacher, None)
+            for name in [name for name, owner in self.class_teacher.items() if owner == teacher]:
+                del self.class_teacher[name]
+
+    def clear(self):
+        with self.lock:
+            self.loaded.clear()
+            self.rosters.clear()
+            self.class_teacher.clear()
+            self.teachers_of.clear()
+            self.online.clear()
+
+
+PRESENCE_INDEX = PresenceIndex(PRESENCE_ROSTER_TTL)
+
+
 @app.route('/openClass')
 def openClass():
     teacherName = request.args.get('teacher')
@@ -321,6 +878,8 @@ def openClass_buisness(teacherName, className):
             t = User[teacherName]
             if t.type == 1:
                 Cls(name=className, teacher=User[teacherName])
+                commit()
+                PRESENCE_INDEX.add_class(className, teacherName)
                 return "successful", 200
             return "failed wrong type", 400
     except Exception as e:
@@ -332,6 +891,8 @@ def makeClass(teacherName, className):
         t = User[teacherName]
         if t.type == 1:
             Cls(name=className, teacher=User[teacherName])
+            commit()
+            PRESENCE_INDEX.add_class(className, teacherName)
             return "successful", 200
         return "failed wrong type", 400
 
@@ -357,6 +918,8 @@ def removeClass_buisness(teacherName, className):
             c = Cls[className]
             if c.teacher == t:
                 c.delete()
+                commit()
+                PRESENCE_INDEX.invalidate(className)
                 return "successful", 200
             return "failed", 400
     except Exception as e:
@@ -384,8 +947,11 @@ def editClass_buisness(teacherName, className, newClassName):
             t = User[teacherName]
             c = Cls[className]
             if c.teacher == t:
-                Cls(name=newClassName, teacher=User[teacherName], students=c.students, hasUnits=c.hasUnits)
+                Cls(name=newClassName, teacher=User[teacherName], students=c.students, hasUnits=c.hasUnits,
+                    lessons=c.lessons)
                 c.delete()
+                commit()
+                PRESENCE_INDEX.invalidate(className)
                 return "successful", 200
             return "failed", 400
     except Exception as e:
@@ -413,9 +979,15 @@ def quickEditUnit():
             maxTime = u.maxTime
             subDate = u.subDate
             if newUnitName != unitName:
-                Unit(cls=c, name=newUnitName, desc=newDesc, template=temp, Qnum=Qnum, maxTime=maxTime, subDate=subDate,
-                     instances=ins, order=order, next=nex)
+                entry = lesson_entry(u)
+                lesson, position = entry.lesson, entry.position
+                prev = previous_unit(u)
+                renamed = Unit(cls=c, name=newUnitName, desc=newDesc, template=temp, Qnum=Qnum, maxTime=maxTime,
+                               subDate=subDate, instances=ins, order=order, next=nex)
                 Unit[unitName, c].delete()
+                LessonUnit(unit=renamed, lesson=lesson, position=position)
+                if prev:
+                    prev.next = newUnitName
             else:
                 u.set(desc=newDesc)
             commit()
@@ -455,9 +1027,15 @@ def editUnit_buisness(unitName, className, newUnitName, Qnum, maxTime, subDate,
             if not isTeacher(teacherName):
                 return "user " + str(teacherName) + " is not a teacher", 400
             if newUnitName != unitName:
-                Unit(cls=c, name=newUnitName, desc=newDesc, template=temp, Qnum=Qnum, maxTime=maxTime, subDate=subDate,
-                     instances=ins, order=order, next=nex)
+                entry = lesson_entry(u)
+                lesson, position = entry.lesson, entry.position
+                prev = previous_unit(u)
+                renamed = Unit(cls=c, name=newUnitName, desc=newDesc, template=temp, Qnum=Qnum, maxTime=maxTime,
+                               subDate=subDate, instances=ins, order=order, next=nex)
                 Unit[unitName, c].delete()
+                LessonUnit(unit=renamed, lesson=lesson, position=position)
+                if prev:
+                    prev.next = newUnitName
             else:
                 u.set(desc=newDesc, Qnum=Qnum, maxTime=maxTime, subDate=subDate)
             return {"message": "successful"}, 200
@@ -483,11 +1061,16 @@ def removeUnit_buisness(unitName, className, teacherName):
     try:
         with db_session:
             u = Unit[unitName, Cls[className]]
-            while u.next:
-                t = Unit[u.next, Cls[className]]
-                u.delete()
-                u = t
-            u.delete()
+            lesson = lesson_entry(u).lesson
+            prev = previous_unit(u)
+            if prev:
+                prev.next = ''
+            for t in lesson_units(u):
+                t.delete()
+            if prev:
+                forget_lesson_progress(lesson)
+            else:
+                lesson.delete()
             commit()
             return "successful", 200
     except Exception as e:
@@ -614,6 +1197,7 @@ def removeRegistrationClass_Buisness(studentName, className):
         u = User[studentName]
         Cls_User.select(cls=c, user=u).delete(bulk=True)
         commit()
+        PRESENCE_INDEX.remove(className, studentName)
         return "successful", 200
 
 
@@ -633,16 +1217,15 @@ def getUnapprovedStudents_buisness(teacher):
     id = 0
     try:
         with db_session:
-
-            for singleClass in Cls.select(teacher=teacher):
-                for unapproveRequest in Cls_User.select(cls=singleClass):
-                    if (unapproveRequest.approved == False):
-                        single_obj = dict()
-                        id += 1
-                        single_obj["id"] = id
-                        single_obj["secondary"] = singleClass.name
-                        single_obj["primary"] = unapproveRequest.user.name
-                        ret.append(single_obj)
+            requests = select((cu.cls.name, cu.user.name) for cu in Cls_User
+                              if cu.cls.teacher.name == teacher and not cu.approved).order_by(1, 2)
+            for className, studentName in requests:
+                single_obj = dict()
+                id += 1
+                single_obj["id"] = id
+                single_obj["secondary"] = className
+                single_obj["primary"] = studentName
+                ret.append(single_obj)
         return jsonify(ret)
     except Exception as e:
         return str(e), 400
@@ -675,7 +1258,12 @@ def approveStudentToClass_buisness(teacherName, studentName, className, approve)
                 c.students.add(b)
             else:
                 Cls_User[c, u].delete()
-            return "successful", 200
+            commit()
+        if approve == "True":
+            PRESENCE_INDEX.approve(className, studentName)
+        else:
+            PRESENCE_INDEX.remove(className, studentName)
+        return "successful", 200
     except Exception as e:
         print(e)
         return str(e), 400
@@ -694,7 +1282,8 @@ def removeFromClass():
             u.inClass.remove(c)
             c.students.remove(u)
             commit()
-            return "successful", 200
+        PRESENCE_INDEX.remove(className, studentName)
+        return "successful", 200
     except Exception as e:
         return str(e), 400
 
@@ -705,13 +1294,26 @@ def teacherOpenUnit(unitName, teacherName, className, template, Qnum, maxTime, s
     try:
         with db_session:
             ord = 1
+            lesson = None
+            position = 1
             if first != 'true':
                 p = Unit[prev, Cls[className]]
+                entry = lesson_entry(p)
+                # the units that came after prev lose their link to it, they go on as a lesson of their own
+                followers = LessonUnit.select(lambda e: e.lesson == entry.lesson and e.position > entry.position)[:]
+                if followers:
+                    rest = Lesson(cls=p.cls)
+                    for follower in followers:
+                        follower.set(lesson=rest, position=follower.position - entry.position)
+                    forget_lesson_progress(entry.lesson)
+                lesson = entry.lesson
+                position = entry.position + 1
                 p.next = unitName
                 ord = p.order + 1
-            Unit(cls=Cls[className], name=unitName, desc=desc, template=template, Qnum=Qnum, maxTime=maxTime,
-                 subDate=subDate,
-                 order=ord)
+            unit = Unit(cls=Cls[className], name=unitName, desc=desc, template=template, Qnum=Qnum, maxTime=maxTime,
+                        subDate=subDate,
+                        order=ord)
+            LessonUnit(unit=unit, lesson=lesson or Lesson(cls=unit.cls), position=position)
             commit()
             return "success"
     except Exception as e:
@@ -736,6 +1338,8 @@ def openUnit():
         return "user " + str(teacherName) + "not logged in.", 400
 
     result = teacherOpenUnit(unitName, teacherName, className, template, Qnum, maxTime, subDate, first, prev, desc)
+    if result == "success":
+        precompute_template(template)
     return result
 
 
@@ -786,7 +1390,19 @@ def deleteUnit():
 def deleteUnit_buisness(unitName, className, teacherName):
     try:
         with db_session:
-            Unit[unitName, Cls[className]].delete()
+            unit = Unit[unitName, Cls[className]]
+            entry = lesson_entry(unit)
+            lesson, position = entry.lesson, entry.position
+            prev = previous_unit(unit)
+            if prev:
+                prev.next = unit.next
+            unit.delete()
+            for follower in LessonUnit.select(lambda e: e.lesson == lesson and e.position > position):
+                follower.position -= 1
+            if lesson.units.is_empty():
+                lesson.delete()
+            else:
+                forget_lesson_progress(lesson)
             commit()
             return "deleted successfully"
     except Exception as e:
@@ -953,32 +1569,58 @@ def parse_template(template):
     return questions, parts[1], params, integral_range
 
 
-def integrate(f: callable, a: float, b: float, n: int) -> np.float32:
-    if n == 1:
-        h = float(b - a)
-        x0 = (a + b) / 2.0
-        return np.float32(h * f(x0))
-    elif n == 2:
-        return np.float32(((float(b - a)) / 2.0) * (f(a) + f(b)))
-
-    if n % 2 == 0:
-        n -= 2
-    else:
-        n -= 1
+GAUSS_NODES_10, GAUSS_WEIGHTS_10 = np.polynomial.legendre.leggauss(10)
+GAUSS_NODES_20, GAUSS_WEIGHTS_20 = np.polynomial.legendre.leggauss(20)
+
+
+def integrate(f: callable, a: float, b: float, tol=1e-10) -> float:
+    return integrateWithError(f, a, b, tol)[0]
+
+
+# Integrates f over [a, b] and returns (integral, error estimate).
+# Polynomials use their antiderivative. Anything else is split into panels that are integrated with 10 and
+# 20 point Gauss-Legendre, all panels of a round in a single evaluation of f. Panels where the two rules
+# disagree by more than their share of tol are halved and done again in the next round, so the panels
+# only get small where f needs it (next to the domain ends of log, root and rational functions).
+# The error estimate is the sum of |G20 - G10| over the accepted panels.
+def integrateWithError(f: callable, a: float, b: float, tol=1e-10, max_rounds=40, max_panels=4096):
+    a, b = float(a), float(b)
+    if a == b:
+        return 0.0, 0.0
+    if isinstance(f, CompiledFunc) and f.c == 0:
+        antiderivative = np.polyint(np.asarray(f.p, dtype=float)) if len(f.p) else np.zeros(1)
+        return float(np.polyval(antiderivative, b) - np.polyval(antiderivative, a)), 0.0
+    edges = np.linspace(a, b, max(1, int(math.ceil(abs(b - a)))) + 1)
+    left, right = edges[:-1], edges[1:]
+    total = 0.0
+    error = 0.0
+    for i in range(max_rounds):
+        coarse, fine = gaussPanels(f, left, right)
+        panel_error = np.abs(fine - coarse)
+        done = panel_error <= np.maximum(tol, 1e-14 * np.abs(fine)) * np.abs(right - left) / abs(b - a)
+        if i == max_rounds - 1 or 2 * np.count_nonzero(~done) > max_panels:
+            done[:] = True
+        total += float(np.sum(fine[done]))
+        error += float(np.sum(panel_error[done]))
+        if done.all():
+            break
+        left, right = left[~done], right[~done]
+        middle = (left + right) / 2
+        left, right = np.concatenate((left, middle)), np.concatenate((middle, right))
+    return total, error
 
-    h = (b - a) / float(n)
-    # result = f(a) + f(b)
-    result_of_even = 0
-    result_of_odds = 0
 
-    for i in range(1, n, 1):
-        if i % 2 == 0:
-            result_of_even += f(a + i * h)
-        else:
-            result_of_odds += f(a + i * h)
-    result = 2 * result_of_even + 4 * result_of_odds + f(a) + f(b)
-    result *= (h / 3.0)
-    return np.float32(result)
+# The 10 and 20 point Gauss-Legendre integrals of f on every panel [left[i], right[i]]
+def gaussPanels(f: callable, left: np.ndarray, right: np.ndarray):
+    center = ((left + right) / 2)[:, None]
+    half = ((right - left) / 2)[:, None]
+    values = evaluateMany(f, np.concatenate(((center + half * GAUSS_NODES_10).ravel(),
+                                             (center + half * GAUSS_NODES_20).ravel())))
+    if np.isnan(values).any():
+        raise ValueError("function is not defined on the whole range [{}, {}]".format(left.min(), right.max()))
+    values_10 = values[:10 * len(left)].reshape(len(left), 10)
+    values_20 = values[10 * len(left):].reshape(len(left), 20)
+    return (half[:, 0] * (values_10 @ GAUSS_WEIGHTS_10)), (half[:, 0] * (values_20 @ GAUSS_WEIGHTS_20))
 
 
 def func_value_question(domain, f, fString):
@@ -1270,7 +1912,9 @@ def generate_answers_symmetry_special_cases(frequency, point, jumps, check_in_ra
 # domains: A list of domain ranges for checking if values are in range.
 # output: The first element is a list of answers that satisfy the conditions specified by the logic inside the function.
 # The second element is a string indicating the type of symmetry or the absence of symmetry.
-def get_answers_for_symmetry_asymmetry(expr, x, c, domains):
+# With numeric=True (the generation budget ran out, see generate_question) the general solve() based search is
+# replaced by numeric_symmetry_centers.
+def get_answers_for_symmetry_asymmetry(expr, x, c, domains, numeric=False):
     if len(domains) == 0:
         return [], 'אין סימטריה'
 
@@ -1306,6 +1950,15 @@ def get_answers_for_symmetry_asymmetry(expr, x, c, domains):
         else:
             return special_case
 
+    if numeric:
+        symmetries = numeric_symmetry_centers(expr, x, domains, 1)
+        if len(symmetries) > 0:
+            return symmetries, 'סימטריה'
+        asymmetries = numeric_symmetry_centers(expr, x, domains, -1)
+        if len(asymmetries) > 0:
+            return asymmetries, 'אסימטריה'
+        return [], 'אין סימטריה'
+
     expr_x = expr.subs(x, x + c)
     expr_neg_x = expr.subs(x, -x + c)
     neg_expr_neg_x = -expr.subs(x, -x + c)
@@ -1331,6 +1984,53 @@ def get_answers_for_symmetry_asymmetry(expr, x, c, domains):
             return list(map(lambda x: round(float(N(x)), 3), asymmetries)), 'אסימטריה'
 
     return [], 'אין סימטריה'
+
+
+# Numeric stand-in for the solve() calls above: the centers c inside the domains (infinite ends cut at +-100) with
+# f(c + t) = sign * f(c - t) for every sampled offset t that keeps both points in the domains, i.e. the vertical
+# symmetry axes for sign 1 and the symmetry points on the x axis for sign -1. The mismatch is computed on a grid of
+# candidate centers with a lambdified f, every local minimum of it is refined by ternary search and kept if the
+# mismatch there is (relatively) 0. Rounded to 3 digits like the exact answers. The domains come sorted.
+def numeric_symmetry_centers(expr, x, domains, sign, candidates=401, tolerance=1e-6):
+    f = SympyFunc(expr, x)
+    pieces = [(max(float(left), -100), min(float(right), 100)) for (left, right) in domains]
+    pieces = [(left, right) for (left, right) in pieces if left < right]
+    offsets = np.linspace(0.05, 3, 60)
+
+    def inside(points):
+        return np.any([(points >= left) & (points <= right) for (left, right) in pieces], axis=0)
+
+    def mismatch(centers):
+        centers = np.asarray(centers, dtype=float)[:, None]
+        right, left = centers + offsets, centers - offsets
+        y_right, y_left = f.evaluate(right), f.evaluate(left)
+        valid = inside(right) & inside(left) & np.isfinite(y_right) & np.isfinite(y_left)
+        with np.errstate(all='ignore'):
+            error = np.abs(y_right - sign * y_left) / (1 + np.abs(y_right) + np.abs(y_left))
+        error = np.where(valid, error, 0).max(axis=1)
+        return np.where(valid.sum(axis=1) >= 10, error, np.inf)
+
+    found = []
+    if len(pieces) == 0:
+        return found
+    # a center doesn't have to be in the domains itself (1 / (x - 1) around 1), so the grid spans all of them
+    centers = np.linspace(pieces[0][0] - 0.5, pieces[-1][1] + 0.5, candidates)
+    errors = mismatch(centers)
+    minima = np.flatnonzero(np.isfinite(errors[1:-1]) & (errors[1:-1] <= errors[:-2])
+                            & (errors[1:-1] <= errors[2:])) + 1
+    low, high = centers[minima - 1], centers[minima + 1]
+    for _ in range(60):
+        third = (high - low) / 3
+        closer = mismatch(low + third) <= mismatch(high - third)
+        high, low = np.where(closer, high - third, high), np.where(closer, low, low + third)
+    centers = (low + high) / 2
+    for center in centers[mismatch(centers) < tolerance]:
+        center = round(float(center), 3) + 0.0
+        if center not in found:
+            found.append(center)
+    return found
+
+
 # input:
 # ans: A list of answers to be filtered and processed.
 # expr_tagtag: The expression for which inflection answers are generated.
@@ -1402,8 +2102,11 @@ def filter_and_generate_answers_for_inflection(ans, expr_tagtag, x, domains):
 # expr_tagtag: The expression for which possible inflection points are determined.
 # x: The variable used in the expressions.
 # domains: A list of domain ranges for checking if values are in range.
+# numeric: find the zeros of expr_tagtag by scanning the domains instead of solve() (see generate_question).
 # output: a list of possible inflection points
-def get_possible_inflection_points(expr_tagtag, x, domains):
+def get_possible_inflection_points(expr_tagtag, x, domains, numeric=False):
+    if numeric:
+        return numeric_possible_inflection_points(expr_tagtag, x, domains)
     ans = []
     try:
         ans = solve(expr_tagtag)
@@ -1422,6 +2125,46 @@ def get_possible_inflection_points(expr_tagtag, x, domains):
 
     return filter_and_generate_answers_for_inflection(ans, expr_tagtag, x, domains)
 
+
+# Numeric stand-in for the solve() above: the zeros of expr_tagtag inside every domain piece (infinite ends cut
+# at +-100) found with scanRoots on a lambdified expr_tagtag. Only zeros where expr_tagtag changes sign are kept,
+# so a tail that is merely close to 0 (e^x near -100) is not reported.
+def numeric_possible_inflection_points(expr_tagtag, x, domains):
+    ans = []
+    if expr_tagtag.is_number:
+        return ans
+    epsilon = 0.0001
+    f = SympyFunc(expr_tagtag, x)
+    for (left, right) in domains:
+        left, right = max(float(left), -100), min(float(right), 100)
+        if left < right:
+            roots = scanRoots(f, ZERO_FUNC, left, right)
+            roots = roots[(roots > left) & (roots < right)]
+            changes = f.evaluate(roots - epsilon) * f.evaluate(roots + epsilon) < 0
+            ans += [float(r) for r in roots[changes]]
+    return ans
+
+
+# A sympy expression of x lambdified to numpy, so evaluateMany evaluates it on a whole grid in one call.
+# evaluate returns NaN where the expression is not defined (or not real).
+class SympyFunc:
+
+    def __init__(self, expr, x):
+        self.expr = expr
+        self.func = lambdify(x, expr, 'numpy')
+
+    def __call__(self, x):
+        y = self.evaluate(np.array([x], dtype=float))[0]
+        return None if np.isnan(y) else float(y)
+
+    def evaluate(self, xs):
+        xs = np.asarray(xs, dtype=float)
+        with np.errstate(all='ignore'):
+            ys = np.asarray(self.func(xs))
+            if np.iscomplexobj(ys):
+                ys = np.where(np.abs(ys.imag) > 1e-12, np.nan, ys.real)
+            return np.broadcast_to(ys.astype(float), xs.shape).copy()
+
 #the main function
 # input: possible_inflection_points: A list of possible inflection points obtained from a previous step.
 # domains: A list of domain ranges.
@@ -1638,7 +2381,7 @@ def odd_even_special_cases(expr, x):
 # domains: A list of domain intervals.
 # output: The output of the function is a string representing the nature of the function:
 # even, odd, both even and odd, or neither even nor odd.
-def get_answers_for_odd_even(expr, x, domains):
+def get_answers_for_odd_even(expr, x, domains, numeric=False):
     if len(domains) == 0:
         return 'לא זוגית ולא אי זוגית'
 
@@ -1646,6 +2389,9 @@ def get_answers_for_odd_even(expr, x, domains):
     if special_cases is not None:
         return special_cases
 
+    if numeric:
+        return numeric_odd_even(expr, x, domains)
+
     rand_value = (domains[0][0] + domains[0][1]) / 2
     is_even = len(solve(expr - expr.subs(x, -x))) == 0 and \
               expr.subs(x, rand_value) == expr.subs(x, -rand_value)
@@ -1661,6 +2407,28 @@ def get_answers_for_odd_even(expr, x, domains):
         return 'לא זוגית ולא אי זוגית'
 
 
+# Numeric stand-in for the solve() calls above: compares f(x) with f(-x) on a grid over the domains.
+# A point where f is defined but f(-x) is not makes the function neither even nor odd.
+def numeric_odd_even(expr, x, domains):
+    f = SympyFunc(expr, x)
+    xs = np.concatenate([np.linspace(float(left), float(right), 101)[1:-1] for (left, right) in domains])
+    y = f.evaluate(xs)
+    y_neg = f.evaluate(-xs)
+    defined = np.isfinite(y)
+    if not defined.any() or not np.isfinite(y_neg[defined]).all():
+        return 'לא זוגית ולא אי זוגית'
+    is_even = np.allclose(y[defined], y_neg[defined], rtol=1e-9, atol=1e-9)
+    is_odd = np.allclose(y[defined], -y_neg[defined], rtol=1e-9, atol=1e-9)
+    if is_even and is_odd:
+        return 'גם זוגית וגם אי זוגית'
+    elif is_even:
+        return 'זוגית'
+    elif is_odd:
+        return 'אי זוגית'
+    else:
+        return 'לא זוגית ולא אי זוגית'
+
+
 # input:  a mathematical expression as input and recursively evaluates and formats the expression.
 # The function handles different types of expressions, including multiplication (Mul), exponentiation (Pow),
 # addition (Add), rational numbers (Rational), and other types.
@@ -1697,13 +2465,11 @@ def rec_calc_evaluation(to_calc):
 
 # Input:
 # options: A list of answer options.
-# expr: The expression.
-# x: The variable.
 # Output:
 # The function returns a tuple (fake_ans, symmetry), where:
 # fake_ans is a randomly generated fake answer. It is a number obtained by adding a random value between -3 and 3 to one of the options from the list. The fake answer is rounded to three decimal places.
 # symmetry is a randomly chosen string indicating whether the answer corresponds to "סימטריה" (symmetry) or "אסימטריה" (asymmetry).
-def generate_random_answer_symmetry(options, expr, x):
+def generate_random_answer_symmetry(options):
     fake_ans = random.choice(options)
     too_long_trigger = 5
     while fake_ans in options:
@@ -1719,8 +2485,6 @@ def generate_random_answer_symmetry(options, expr, x):
 # Input:
 # real_options: A tuple containing the real answer options and their description.
 # The options are provided as a list, and the description is a string.
-# expr: The expression.
-# x: The variable.
 # Output:
 # The function returns a tuple (real_ans, answer_1, answer_2, answer_3), where:
 # real_ans is a tuple (real_value, desc) representing the real answer.
@@ -1729,25 +2493,24 @@ def generate_random_answer_symmetry(options, expr, x):
 # answer_1, answer_2, and answer_3 are tuples (fake_value, symmetry) representing the fake answers.
 # They are generated using the generate_random_answer_symmetry function. The fake_value is a rounded fake answer,
 # and symmetry is a randomly chosen string indicating symmetry or asymmetry.
-def generate_fake_answers_symmetry(real_options, expr, x):
+def generate_fake_answers_symmetry(real_options):
     options, desc = real_options
     real_ans = round(random.choice(options), 3) if len(options) > 0 else None, desc
     if len(options) != 0:
         answer_1 = None, 'אין סימטריה'
-        answer_2 = generate_random_answer_symmetry(options, expr, x)
-        answer_3 = generate_random_answer_symmetry(options, expr, x)
+        answer_2 = generate_random_answer_symmetry(options)
+        answer_3 = generate_random_answer_symmetry(options)
         return real_ans, answer_1, answer_2, answer_3
     else:
         options = [round(random.uniform(-20, 20), 3) for _ in range(20)]
-        answer_1 = generate_random_answer_symmetry(options, expr, x)
-        answer_2 = generate_random_answer_symmetry(options, expr, x)
-        answer_3 = generate_random_answer_symmetry(options, expr, x)
+        answer_1 = generate_random_answer_symmetry(options)
+        answer_2 = generate_random_answer_symmetry(options)
+        answer_3 = generate_random_answer_symmetry(options)
         return real_ans, answer_1, answer_2, answer_3
 
 # Input:
 # real_points: A list of real inflection points.
-# expr: The expression.
-# x: The variable.
+# f: The function, as returned by makeFunc.
 # domains: A list of domains for x. Each domain is represented as a tuple (start, end).
 # Output:
 # The function returns a tuple (fake_x, fake_y), where:
@@ -1755,9 +2518,9 @@ def generate_fake_answers_symmetry(real_options, expr, x):
 # It is a rounded value that is not present in the real_points list and falls within one of the domains
 # specified in domains.
 # fake_y is the fake y-coordinate of the inflection point.
-# It is calculated by evaluating the expression expr at the fake x-coordinate.
+# It is calculated by evaluating f at the fake x-coordinate.
 # It is rounded to three decimal places.
-def generate_random_answer_inflection(real_points, expr, x, domains):
+def generate_random_answer_inflection(real_points, f, domains):
     def check_in_range(val):
         for dom in domains:
             if dom[0] < val < dom[1]:
@@ -1772,31 +2535,30 @@ def generate_random_answer_inflection(real_points, expr, x, domains):
         if too_long_trigger == 0:
             return round(fake_ans, 3), round(choice * fake_ans, 3)
         too_long_trigger -= 1
-    try:
-        y_val = round(float(N(expr.subs(x, fake_ans))), 3)
-        return round(fake_ans, 3), y_val
-    except:
+    y_val = safeValue(f, fake_ans)
+    if not np.isfinite(y_val):
         return round(fake_ans, 3), round(random.uniform(-2, 2) * fake_ans, 3)
+    return round(fake_ans, 3), round(float(y_val), 3)
 
 # the function generates fake inflection points based on the presence or absence of real inflection points.
 # If real inflection points exist, the function selects one as the real answer and generates fake answers.
 # If no real inflection points exist, the function generates fake answers using a list of randomly generated options.
-def generate_fake_answers_inflection(real_points, expr, x, domains):
+def generate_fake_answers_inflection(real_points, f, domains):
     real_ans = random.choice(real_points) if len(real_points) > 0 else None
     if real_ans is not None:
-        real_ans = (real_ans, round(float(N(expr.subs(x, real_ans))), 3))
+        real_ans = (real_ans, round(float(f(real_ans)), 3))
     else:
         real_ans = 'אין נקודות פיתול'
     if len(real_points) != 0:
         answer_1 = 'אין נקודות פיתול'
-        answer_2 = generate_random_answer_inflection(real_points, expr, x, domains)
-        answer_3 = generate_random_answer_inflection(real_points, expr, x, domains)
+        answer_2 = generate_random_answer_inflection(real_points, f, domains)
+        answer_3 = generate_random_answer_inflection(real_points, f, domains)
         return real_ans, answer_1, answer_2, answer_3
     else:
         options = [round(random.uniform(-20, 20), 3) for _ in range(20)]
-        answer_1 = generate_random_answer_inflection(options, expr, x, domains)
-        answer_2 = generate_random_answer_inflection(options, expr, x, domains)
-        answer_3 = generate_random_answer_inflection(options, expr, x, domains)
+        answer_1 = generate_random_answer_inflection(options, f, domains)
+        answer_2 = generate_random_answer_inflection(options, f, domains)
+        answer_3 = generate_random_answer_inflection(options, f, domains)
         return real_ans, answer_1, answer_2, answer_3
 
 # Input:
@@ -1896,93 +2658,879 @@ def generate_fake_answers_odd_even(ans):
 
 
 def get_questions(unit):
+    return generate_questions(unit.template)
+
+
+# Raised by generation_budget when a question builder runs over its time. Not an Exception subclass, so the
+# builders' own "except Exception" around solve() can not swallow it.
+class GenerationTimeout(BaseException):
+    pass
+
+
+# Interrupts the block with GenerationTimeout after seconds of wall-clock time. The budget only applies in the
+# main thread of a process, SIGALRM can't be used anywhere else: in any other thread (request threads, the
+# QuestionPool and QuestionRefiller workers) the block is not interrupted and generate_question can only record
+# the overrun afterwards. This is why GenerationExecutor runs every build in a worker process, whose tasks run
+# in its main thread.
+@contextmanager
+def generation_budget(seconds):
+    if not seconds or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def expire(signum, frame):
+        raise GenerationTimeout()
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+GENERATION_TIMEOUTS = deque(maxlen=GENERATION_TIMEOUT_LOG_SIZE)
+
+
+# Logs a question build that ran over GENERATION_BUDGET with its template and parameters. The entry goes to
+# timeouts if given (a worker process sends them back with the question), otherwise to GENERATION_TIMEOUTS.
+def record_generation_timeout(template, details, seconds, action, timeouts=None):
+    entry = dict(details, template=template, seconds=round(seconds, 3), action=action)
+    app.logger.warning("question generation over budget: %s", entry)
+    (GENERATION_TIMEOUTS if timeouts is None else timeouts).append(entry)
+
+
+# Builds a single question tuple (correct answer first) for a unit template, or None if the template's
+# function type is unknown. Only needs the template string, so it can run outside of a db_session and in
+# the generation worker processes.
+# Every build gets GENERATION_BUDGET seconds (see generation_budget for where it is enforced). A build that runs
+# over is recorded and redrawn with new parameters, after GENERATION_REDRAWS redraws the question is built with
+# the numeric answer path instead of solve(). If that runs over as well the question is skipped (None), the
+# callers drop those.
+def generate_question(template, timeouts=None):
+    for attempt in range(GENERATION_REDRAWS + 2):
+        details = {}
+        numeric = attempt > GENERATION_REDRAWS
+        start = time.monotonic()
+        try:
+            with generation_budget(GENERATION_BUDGET):
+                q = build_question(template, details, numeric)
+        except GenerationTimeout:
+            action = 'redraw' if attempt < GENERATION_REDRAWS else ('numeric' if not numeric else 'skipped')
+            record_generation_timeout(template, details, time.monotonic() - start, action, timeouts)
+            continue
+        if GENERATION_BUDGET and time.monotonic() - start > GENERATION_BUDGET:
+            record_generation_timeout(template, details, time.monotonic() - start, 'overrun', timeouts)
+        return q
+    return None
+
+
+# generate_question for the worker processes, also returns the timeouts recorded on the way
+def generate_question_reporting(template):
+    timeouts = []
+    return generate_question(template, timeouts), timeouts
+
+
+# Builds the question of one (question, p) pair of a precomputed template in a worker process, under the
+# generation budget like generate_question: with numeric answers once the exact build runs over, left out once
+# that runs over too. Returns ((question tuple, None) or (None, why it is left out), timeouts).
+def precompute_question(template, question, b, c, p, integral_range):
+    timeouts = []
+    details = dict(question=question, c=c, b=b, p=p)
+    for numeric in (False, True):
+        start = time.monotonic()
+        try:
+            with generation_budget(GENERATION_BUDGET):
+                q = make_question(question, b, c, p, integral_range, numeric)
+        except GenerationTimeout:
+            record_generation_timeout(template, details, time.monotonic() - start,
+                                      'skipped' if numeric else 'numeric', timeouts)
+            continue
+        except Exception as e:
+            return (None, repr(e)), timeouts
+        if not q:
+            return (None, "no question"), timeouts
+        if q[2] in q[3:6]:
+            return (None, "correct answer is also a distractor"), timeouts
+        return (q, None), timeouts
+    return (None, "over the generation budget"), timeouts
+
+
+# details is filled with the drawn question type and parameters, numeric is passed on to the builders that
+# call solve()
+def build_question(template, details, numeric=False):
+    integral_range = []
+    if "definiteIntegral" in template:
+        question_type, function_types, params, integral_range = parse_template(template)
+    else:
+        question_type, function_types, params = parse_template(template)
+    question = random.choice(question_type)
+    function_type = function_type_params(function_types)
+    if function_type is None:
+        return None
+    c, b = function_type
+    p = [random.randint(low, high) for low, high in parameter_ranges(question, c, params)]
+    details.update(question=question, c=c, b=b, p=p)
+    return make_question(question, b, c, p, integral_range, numeric)
+
+
+# Returns (c, b) of a template's function type, or None if the type is unknown
+def function_type_params(function_types):
     intMap = {'linear': 0, 'quadratic': 0, 'polynomial': 0, '2exp': 1, '3exp': 1, 'eexp': 1, 'log': 2, 'sin': 3,
               'cos': 4, 'tan': 5, 'cot': 6, 'rational': 7, 'root': 8, '3root': 8}
-    questions = list()
-    for i in range(QUESTIONS_TO_GENERATE):
-        question_type = []
-        function_types = ""
-        params = []
-        integral_range = []
-
-        if "definiteIntegral" in unit.template:
-            question_type, function_types, params, integral_range = parse_template(unit.template)
-        else:
-            question_type, function_types, params = parse_template(unit.template)
-        question = random.choice(question_type)
-        if function_types in ['linear', 'quadratic', 'polynomial', '2exp', '3exp', 'eexp', 'log', 'sin', 'cos', 'tan',
-                              'cot', 'rational', 'root', '3root']:
-            c = intMap[function_types]
-            b = 2 if function_types == '2exp' else (3 if function_types == '3exp' else math.e)
-            if function_types == 'root':
-                b = 2
-            elif function_types == '3root':
-                b = 3
-            elif function_types == 'log':
-                b = math.e
-            p = [random.randint(int(params[2 * i]), int(params[2 * i + 1])) for i in range(int(len(params) / 2))]
-            f = makeFunc(p, c, b)
-            q = ""
-            if ('definiteIntegral' in question):
-                q = definite_integral_question(b, c, f, integral_range, p)
+    if function_types not in intMap:
+        return None
+    c = intMap[function_types]
+    b = 2 if function_types == '2exp' else (3 if function_types == '3exp' else math.e)
+    if function_types == 'root':
+        b = 2
+    elif function_types == '3root':
+        b = 3
+    elif function_types == 'log':
+        b = math.e
+    return c, b
+
+
+# The (low, high) range of every parameter of p for a question type. The trigonometric inflection and
+# convexConcave questions only use the first three parameters.
+def parameter_ranges(question, c, params):
+    count = int(len(params) / 2)
+    if ('inflection' in question or 'convexConcave' in question) and (c == 3 or c == 4 or c == 5 or c == 6):
+        count = 3
+    return [(int(params[2 * i]), int(params[2 * i + 1])) for i in range(count)]
+
+
+# Builds the question tuple for an already drawn question type and parameters p
+def make_question(question, b, c, p, integral_range, numeric=False):
+    f = makeFunc(p, c, b)
+    q = ""
+    if ('definiteIntegral' in question):
+        q = definite_integral_question(b, c, f, integral_range, p)
+    elif ('intersection' in question):
+        q = make_intersection_question(b, c, f, p)
+    elif ('minMaxPoints' in question):
+        q = make_extreme_question(b, c, p)
+    elif ('incDec' in question):
+        q = make_incDec_question(b, c, p)
+    elif ('deriveFunc' in question):
+        q = make_derive_question(b, c, p)
+    elif ('funcValue' in question):
+        domain = makeDomain(p, c)
+        q = func_value_question(domain, f, funcString(p, c, b))
+    elif ('domain' in question):
+        q = make_domain_question(b, c, p)
+    elif ('posNeg' in question):
+        q = make_pos_neg_question(b, c, p)
+    elif ('asym' in question):
+        preamble = "חשב מה האסימפטוטות של הפונקציה"
+        result1 = cached_answer('asym', p, c, b, lambda: makeAsym(p, c, b))
+        if not len(result1[0]):
+            result1[0] = "אין אסימפטוטות אנכיות"
+        if not len(result1[1]):
+            result1[1] = "אין אסימפטוטות אופקיות"
+        result2 = randFillPair(2)
+        result3 = randFillPair(2)
+        result4 = randFillPair(2)
+        q = (
+            preamble, funcString(p, c, b), result1, result2,
+            result3,
+            result4, 0)
+    elif ('symmetry' in question):
+        if c == 2:
+            b = e
+        q = make_symmetry_question(b, c, p, numeric)
+    elif ('inflection' in question):
+        if c == 2:
+            b = e
+        q = make_inflection_question(b, c, p, numeric)
+    elif ('convexConcave' in question):
+        if c == 2:
+            b = e
+        q = make_convex_concave_question(b, c, p, numeric)
+    elif ('oddEven' in question):
+        if c == 2:
+            b = e
+        q = make_odd_even_question(b, c, p, numeric)
+    return q
+
+
+# Builds QUESTIONS_TO_GENERATE question tuples for a unit template (see GenerationExecutor and QuestionPool).
+# Precomputed templates are drawn from their table instead.
+def generate_questions(template):
+    table = PRECOMPUTED_TEMPLATES.get(template)
+    if table is not None and table.done and table.size:
+        questions = [table.draw() for _ in range(QUESTIONS_TO_GENERATE)]
+    else:
+        questions = GENERATION_EXECUTOR.generate(template, QUESTIONS_TO_GENERATE)
+    return change_order([q for q in questions if q is not None])
+
+
+# the queue a generation worker reports the tasks it starts on (see GenerationExecutor), set by its initializer
+GENERATION_STARTS = None
+
+
+def seed_generation_worker(starts=None):
+    global GENERATION_STARTS
+    GENERATION_STARTS = starts
+    # workers forked from the same fork server start with its random state, without a new seed they would all
+    # draw the same p
+    random.seed()
+    np.random.seed()
+
+
+# Runs task(*args) in a generation worker after reporting token as started, so the timeout of a task does not
+# count the time it waited in the queue. Returns what task returned and the hits, store hits and misses it had
+# in the worker's ANSWER_CACHE.
+def run_generation_task(token, task, *args):
+    if GENERATION_STARTS is not None:
+        GENERATION_STARTS.put(token)
+    before = ANSWER_CACHE.counts()
+    result = task(*args)
+    return result, tuple(after - before for after, before in zip(ANSWER_CACHE.counts(), before))
+
+
+# How the generation workers are started. Not fork: this process already runs threads (the question pool, the
+# session sweeper, the refiller), a forked worker could inherit a lock one of them holds.
+GENERATION_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+# Fans the questions of a batch out over a ProcessPoolExecutor with GENERATION_WORKERS processes, so the
+# CPU-bound SymPy builders run on all cores instead of one after another in the request thread.
+# Results come back in submission order. A question that does not finish within timeout seconds of starting
+# (the workers report when they start a task, the time it waits behind other batches does not count) is replaced
+# by a newly drawn one, up to retries times: a running task can't be cancelled, so the workers are killed and the
+# unfinished questions of the batch go to new ones. Batches of other requests that lose their workers or their
+# queued tasks that way are submitted again. When a question runs out of retries generate raises TimeoutError,
+# which the routes answer like any other error. Builds always run in a worker process (one at least), the only
+# place the generation budget can interrupt them.
+class GenerationExecutor:
+
+    def __init__(self, workers, timeout, retries, task=generate_question_reporting):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.retries = retries
+        self.task = task
+        self.lock = threading.Lock()
+        self.pool = None
+        self.starts = {}
+        self.started = {}
+        self.tokens = itertools.count()
+        self.restarts = 0
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                starts = GENERATION_CONTEXT.SimpleQueue()
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=GENERATION_CONTEXT,
+                                                initializer=seed_generation_worker, initargs=(starts,))
+                self.starts[self.pool] = starts
+                threading.Thread(target=self.record_starts, args=(starts,), name='generation-starts',
+                                 daemon=True).start()
+            return self.pool
+
+    def record_starts(self, starts):
+        while True:
+            token = starts.get()
+            if token is None:
+                return
+            with self.lock:
+                self.started[token] = time.monotonic()
+
+    # Shuts down pool (the current one if None). Another request may already have replaced it, the current pool is
+    # then left alone.
+    def reset(self, kill=False, pool=None):
+        with self.lock:
+            if pool is None:
+                pool = self.pool
+            if pool is None:
+                return
+            if pool is self.pool:
+                self.pool = None
+            starts = self.starts.pop(pool, None)
+            if starts is None:
+                return
+            if kill:
+                self.restarts += 1
+        starts.put(None)
+        # shutdown() leaves a task that is already running alone, its worker is terminated instead
+        processes = list((pool._processes or {}).values()) if kill else []
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=1)
+
+    # the result of the task submitted as token, raising concurrent.futures.TimeoutError once it ran for more than
+    # timeout seconds
+    def result(self, token, future):
+        while True:
+            with self.lock:
+                started = self.started.get(token)
+            wait = 0.05 if started is None else max(0.0, started + self.timeout - time.monotonic())
+            try:
+                return future.result(timeout=wait)
+            except concurrent.futures.TimeoutError:
+                if started is not None:
+                    raise
+
+    # keeps the timeouts and the answer cache counts a task sent back, returns its result
+    def collect(self, reported):
+        (result, timeouts), counts = reported
+        GENERATION_TIMEOUTS.extend(timeouts)
+        ANSWER_CACHE.record(*counts)
+        return result
+
+    def generate(self, template, count):
+        return self.map(self.task, [(template,)] * count, template)
+
+    # task(*args) for every args of calls in the workers, with the same timeout and retries as the questions of a
+    # batch. task returns (result, timeouts). label names the calls in the log.
+    def map(self, task, calls, label):
+        count = len(calls)
+        questions = [None] * count
+        attempts = [0] * count
+        todo = list(range(count))
+        tokens = []
+        try:
+            while todo:
+                try:
+                    executor = self.executor()
+                    futures = []
+                    for i in todo:
+                        token = next(self.tokens)
+                        tokens.append(token)
+                        futures.append((i, token, executor.submit(run_generation_task, token, task, *calls[i])))
+                except BrokenProcessPool:
+                    self.reset(pool=executor)
+                    continue
+                todo = []
+                replaced = False
+                for i, token, future in futures:
+                    if replaced:
+                        # the workers were replaced, keep what they finished and queue the rest again
+                        if future.done() and not future.cancelled() and future.exception() is None:
+                            questions[i] = self.collect(future.result())
+                        else:
+                            todo.append(i)
+                        continue
+                    try:
+                        questions[i] = self.collect(self.result(token, future))
+                        continue
+                    except concurrent.futures.TimeoutError:
+                        self.reset(kill=True, pool=executor)
+                        failure = 'timed out'
+                    except (BrokenProcessPool, concurrent.futures.CancelledError):
+                        # another request killed the workers, or they died
+                        self.reset(pool=executor)
+                        failure = 'lost its worker'
+                    replaced = True
+                    attempts[i] += 1
+                    app.logger.warning("question generation for template %s %s (attempt %d)", label, failure,
+                                       attempts[i])
+                    if attempts[i] > self.retries:
+                        raise TimeoutError("question generation for template %s %s %d times" %
+                                           (label, failure, attempts[i]))
+                    todo.append(i)
+        finally:
+            with self.lock:
+                for token in tokens:
+                    self.started.pop(token, None)
+        return questions
+
+
+GENERATION_EXECUTOR = GenerationExecutor(GENERATION_WORKERS, GENERATION_TIMEOUT, GENERATION_RETRIES)
+# Precomputed templates (see PrecomputedTemplate) are built on their own processes, so the hundreds of builds of a
+# newly opened unit never queue in front of the questions students are waiting for.
+PRECOMPUTE_EXECUTOR = GenerationExecutor(PRECOMPUTE_WORKERS, GENERATION_TIMEOUT, GENERATION_RETRIES)
+
+
+# Keeps a pool of ready questions for every unit template, so a request only pops ready tuples instead of
+# building them. When a template drops below low_watermark questions a background thread refills it up to
+# depth (never above max_per_template). Only the max_templates most recently used templates are kept.
+# If the pool can not serve a whole request the missing questions are generated synchronously.
+class QuestionPool:
+
+    def __init__(self, generate, depth, low_watermark, max_per_template, max_templates):
+        self.generate = generate
+        self.depth = min(depth, max_per_template)
+        self.low_watermark = low_watermark
+        self.max_per_template = max_per_template
+        self.max_templates = max_templates
+        self.lock = threading.Lock()
+        self.pools = OrderedDict()
+        self.pending = set()
+        self.requests = queue.Queue()
+        self.worker = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.failures = 0
+
+    def take(self, template, count):
+        with self.lock:
+            pool = self.pools.get(template)
+            taken = [pool.popleft() for _ in range(min(count, len(pool)))] if pool else []
+            if len(taken) == count:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.request_refill(template)
+        while len(taken) < count:
+            batch = self.generate(template)
+            if not batch:
+                break
+            missing = count - len(taken)
+            taken += batch[:missing]
+            self.put(template, batch[missing:], generated=len(batch))
+        return taken
+
+    def put(self, template, questions, generated=None):
+        with self.lock:
+            self.generated += len(questions) if generated is None else generated
+            if template not in self.pools:
+                self.pools[template] = deque()
+            self.pools.move_to_end(template)
+            pool = self.pools[template]
+            pool.extend(questions[:max(0, self.max_per_template - len(pool))])
+            while len(self.pools) > self.max_templates:
+                self.pools.popitem(last=False)
+
+    def size(self, template):
+        with self.lock:
+            return len(self.pools.get(template, ()))
+
+    def request_refill(self, template):
+        with self.lock:
+            if template in self.pending or len(self.pools.get(template, ())) >= self.low_watermark:
+                return
+            self.pending.add(template)
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='question-pool', daemon=True)
+                self.worker.start()
+        self.requests.put(template)
+
+    def run(self):
+        while True:
+            template = self.requests.get()
+            try:
+                while self.size(template) < self.depth:
+                    batch = self.generate(template)
+                    if not batch:
+                        break
+                    self.put(template, batch)
+            except Exception:
+                self.failures += 1
+                app.logger.exception("question pool refill failed for template %s", template)
+            finally:
+                with self.lock:
+                    self.pending.discard(template)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "generated": self.generated,
+                "failures": self.failures,
+                "pending": len(self.pending),
+                "templates": {template: len(pool) for template, pool in self.pools.items()}
+            }
+
+
+QUESTION_POOL = QuestionPool(generate_questions, QUESTION_POOL_DEPTH, QUESTION_POOL_LOW_WATERMARK,
+                             QUESTION_POOL_MAX_PER_TEMPLATE, QUESTION_POOL_MAX_TEMPLATES)
+
+
+def take_questions(template):
+    if not QUESTION_POOL_ENABLED:
+        return generate_questions(template)
+    return QUESTION_POOL.take(template, QUESTIONS_TO_GENERATE)
+
+
+@app.route('/questionPoolStats')
+def questionPoolStats():
+    return jsonify(QUESTION_POOL.stats())
+
+
+@app.route('/generationTimeouts')
+def generationTimeouts():
+    return jsonify(list(GENERATION_TIMEOUTS))
+
+
+# Bounded LRU cache of the correct answers of the builders, keyed by (question type, p, c, b). The template
+# ranges are small, so the same parameters come up again and again and the symbolic work (sympy functions,
+# diff, solve, domains) is only done once per key. Only the correct answer is stored, the distractors are drawn
+# fresh for every question. Values are copied on the way out so a builder can not change a cached answer.
+# Every process keeps a cache of its own, behind it the optional store (see AnswerStore) is shared by all
+# processes and kept across restarts. The builds run in the generation workers, which send the hits and misses
+# of their caches back with every result (see run_generation_task), so stats() counts those too; size is the
+# number of answers this process keeps.
+class AnswerCache:
+
+    def __init__(self, max_size, store=None):
+        self.max_size = max_size
+        self.store = store
+        self.lock = threading.Lock()
+        self.answers = OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, keep=True):
+        with self.lock:
+            if key in self.answers:
+                self.hits += 1
+                self.answers.move_to_end(key)
+                return copy.deepcopy(self.answers[key])
+        if self.store is not None:
+            try:
+                answer = self.store.get(key)
+            except KeyError:
+                pass
+            else:
+                with self.lock:
+                    self.store_hits += 1
+                self.remember(key, answer)
+                return copy.deepcopy(answer)
+        with self.lock:
+            self.misses += 1
+        answer = compute()
+        if keep:
+            self.remember(key, answer)
+            if self.store is not None:
+                self.store.put(key, answer)
+        return answer
+
+    def counts(self):
+        with self.lock:
+            return self.hits, self.store_hits, self.misses
+
+    # adds the hits and misses a generation worker reports for its own cache
+    def record(self, hits, store_hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.store_hits += store_hits
+            self.misses += misses
+
+    def remember(self, key, answer):
+        with self.lock:
+            self.answers[key] = copy.deepcopy(answer)
+            while len(self.answers) > self.max_size:
+                self.answers.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.answers.clear()
+            self.hits = 0
+            self.store_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "store_hits": self.store_hits, "misses": self.misses,
+                    "size": len(self.answers), "max_size": self.max_size}
+
+
+# Correct answers in a local SQLite file, shared by the generation workers and kept across restarts. Every row
+# carries the ANSWER_STORE_VERSION it was computed with and only rows of the current version are read.
+# A store that can not be read or written only logs the error, the answers are then computed as usual.
+# The question tuples of the precomputed templates (see PrecomputedTemplate) are kept next to the answers.
+class AnswerStore:
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # a forked worker process must not use its parent's connection
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS answers (version INTEGER, key TEXT, answer BLOB, '
+                                    'PRIMARY KEY (version, key))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS questions (version INTEGER, template TEXT, '
+                                    'position INTEGER, question BLOB, PRIMARY KEY (version, template, position))')
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, key):
+        try:
+            with self.lock:
+                row = self.connect().execute('SELECT answer FROM answers WHERE version = ? AND key = ?',
+                                             (self.version, repr(key))).fetchone()
+        except sqlite3.Error:
+            app.logger.exception("could not read the answer store %s", self.path)
+            row = None
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def put(self, key, answer):
+        try:
+            with self.lock:
+                connection = self.connect()
+                connection.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?)',
+                                   (self.version, repr(key), pickle.dumps(answer)))
+                connection.commit()
+        except sqlite3.Error:
+            app.logger.exception("could not write the answer store %s", self.path)
+
+    # Replaces the stored questions of template, returns False if they could not be stored
+    def put_questions(self, template, questions):
+        try:
+            with self.lock:
+                connection = self.connect()
+                connection.execute('DELETE FROM questions WHERE version = ? AND template = ?',
+                                   (self.version, template))
+                connection.executemany('INSERT INTO questions VALUES (?, ?, ?, ?)',
+                                       [(self.version, template, position, pickle.dumps(question))
+                                        for position, question in enumerate(questions)])
+                connection.commit()
+        except sqlite3.Error:
+            app.logger.exception("could not write the answer store %s", self.path)
+            return False
+        return True
+
+    # How many questions of template are stored, 0 if the store can not be read
+    def question_count(self, template):
+        try:
+            with self.lock:
+                return self.connect().execute('SELECT COUNT(*) FROM questions WHERE version = ? AND template = ?',
+                                              (self.version, template)).fetchone()[0]
+        except sqlite3.Error:
+            app.logger.exception("could not read the answer store %s", self.path)
+            return 0
+
+    def question(self, template, position):
+        try:
+            with self.lock:
+                row = self.connect().execute('SELECT question FROM questions WHERE version = ? AND template = ? '
+                                             'AND position = ?', (self.version, template, position)).fetchone()
+        except sqlite3.Error:
+            app.logger.exception("could not read the answer store %s", self.path)
+            row = None
+        if row is None:
+            raise KeyError((template, position))
+        return pickle.loads(row[0])
+
+    # Deletes the answers and questions of all other versions, returns how many were deleted
+    def prune(self):
+        with self.lock:
+            connection = self.connect()
+            deleted = connection.execute('DELETE FROM answers WHERE version != ?', (self.version,)).rowcount
+            deleted += connection.execute('DELETE FROM questions WHERE version != ?', (self.version,)).rowcount
+            connection.commit()
+        return deleted
+
+
+ANSWER_CACHE = AnswerCache(ANSWER_CACHE_SIZE,
+                           AnswerStore(ANSWER_STORE_PATH, ANSWER_STORE_VERSION) if ANSWER_STORE_ENABLED else None)
+
+
+# Returns compute() through ANSWER_CACHE. keep=False only reads the cache, for answers that should not be
+# kept (the numeric fallback of generate_question).
+def cached_answer(question_type, p, c, b, compute, keep=True):
+    if not ANSWER_CACHE_ENABLED:
+        return compute()
+    return ANSWER_CACHE.get((question_type, tuple(p), c, float(b)), compute, keep)
+
+
+@app.route('/answerCacheStats')
+def answerCacheStats():
+    return jsonify(ANSWER_CACHE.stats())
+
+
+# Fills the answer store offline: builds every question type of every unit template once for every parameter
+# vector its ranges allow, so the workers find the answers in the store instead of computing them. Every build
+# runs under GENERATION_BUDGET, the ones that run over are left out.
+# Run with: MATHEMATIX_ANSWER_STORE=answers.sqlite flask --app app warm-answers
+@app.cli.command('warm-answers')
+@click.option('--max-per-template', default=0, help='Stop a template after this many parameter vectors (0: all).')
+@click.option('--limit', default=0, help='Stop after this many questions in all (0: all).')
+def warm_answers(max_per_template, limit):
+    if ANSWER_CACHE.store is None:
+        raise click.ClickException("the answer store is off, set MATHEMATIX_ANSWER_STORE to its file")
+    click.echo("pruned %d answers of older versions" % ANSWER_CACHE.store.prune())
+    with db_session:
+        templates = sorted(set(select(u.template for u in Unit)[:]))
+    total = 0
+    for template in templates:
+        count = max_per_template
+        if limit:
+            if total >= limit:
+                break
+            count = min(count or limit - total, limit - total)
+        built = warm_template(template, count)
+        total += built
+        click.echo("%s: %d questions" % (template, built))
+    click.echo(json.dumps(ANSWER_CACHE.stats()))
+
+
+# Builds every question type of template for every reachable parameter vector (the first max_per_template of them
+# if given), each under GENERATION_BUDGET. Returns how many were built.
+def warm_template(template, max_per_template=0):
+    built = 0
+    for question, b, c, p, integral_range in itertools.islice(template_questions(template), max_per_template or None):
+        start = time.monotonic()
+        try:
+            with generation_budget(GENERATION_BUDGET):
+                make_question(question, b, c, p, integral_range)
+        except GenerationTimeout:
+            record_generation_timeout(template, dict(question=question, c=c, b=b, p=p), time.monotonic() - start,
+                                      'skipped')
+        except Exception:
+            app.logger.exception("could not build %s for p=%s", question, p)
+        built += 1
+    return built
+
+
+def parse_template_ranges(template):
+    integral_range = []
+    if "definiteIntegral" in template:
+        question_type, function_types, params, integral_range = parse_template(template)
+    else:
+        question_type, function_types, params = parse_template(template)
+    return question_type, function_type_params(function_types), params, integral_range
+
+
+# Every (question, b, c, p, integral_range) a template can produce, nothing if its function type is unknown
+def template_questions(template):
+    question_type, function_type, params, integral_range = parse_template_ranges(template)
+    if function_type is None:
+        return
+    c, b = function_type
+    for question in question_type:
+        ranges = parameter_ranges(question, c, params)
+        for p in itertools.product(*[range(low, high + 1) for low, high in ranges]):
+            yield question, b, c, list(p), integral_range
+
+
+# How many different (question, p) pairs template_questions yields
+def template_size(template):
+    question_type, function_type, params, integral_range = parse_template_ranges(template)
+    if function_type is None:
+        return 0
+    c, b = function_type
+    return sum(math.prod(max(0, high - low + 1) for low, high in parameter_ranges(question, c, params))
+               for question in question_type)
+
+
+# The questions of a small template, built once for every (question, p) pair when the unit is opened. The pairs
+# are built by PRECOMPUTE_EXECUTOR (see precompute_question), the precompute thread only waits for them. The questions that came out usable are kept in store (every process on the machine then draws
+# from the same rows and a restarted one doesn't build them again), or in memory without one, and a draw reads
+# one of them by index. Pairs that fail to build, run over the budget, or whose correct answer is also one of
+# their distractors, are left out and listed in report().
+class PrecomputedTemplate:
+
+    def __init__(self, template, store=None):
+        self.template = template
+        self.store = store
+        self.questions = []
+        self.size = 0
+        self.degenerate = []
+        self.done = False
+
+    def compute(self):
+        if self.store is not None:
+            self.size = self.store.question_count(self.template)
+            if self.size:
+                self.done = True
+                return
+        pairs = list(template_questions(self.template))
+        try:
+            results = PRECOMPUTE_EXECUTOR.map(precompute_question, [(self.template,) + pair for pair in pairs],
+                                              self.template)
+        except TimeoutError:
+            app.logger.exception("could not precompute template %s", self.template)
+            return
+        questions = []
+        for (question, b, c, p, integral_range), (q, reason) in zip(pairs, results):
+            if q is None:
+                self.degenerate.append((question, p, reason))
+            else:
                 questions.append(q)
-            elif ('intersection' in question):
-                q = make_intersection_question(b, c, f, p)
-            elif ('minMaxPoints' in question):
-                q = make_extreme_question(b, c, p)
-            elif ('incDec' in question):
-                q = make_incDec_question(b, c, p)
-            elif ('deriveFunc' in question):
-                q = make_derive_question(b, c, p)
-            elif ('funcValue' in question):
-                domain = makeDomain(p, c)
-                q = func_value_question(domain, f, funcString(p, c, b))
-            elif ('domain' in question):
-                q = make_domain_question(b, c, p)
-            elif ('posNeg' in question):
-                q = make_pos_neg_question(b, c, p)
-            elif ('asym' in question):
-                preamble = "חשב מה האסימפטוטות של הפונקציה"
-                result1 = makeAsym(p, c, b)
-                if not len(result1[0]):
-                    result1[0] = "אין אסימפטוטות אנכיות"
-                if not len(result1[1]):
-                    result1[1] = "אין אסימפטוטות אופקיות"
-                result2 = randFillPair(2)
-                result3 = randFillPair(2)
-                result4 = randFillPair(2)
-                q = (
-                    preamble, funcString(p, c, b), result1, result2,
-                    result3,
-                    result4, 0)
-            elif ('symmetry' in question):
-                if c == 2:
-                    b = e
-                q = make_symmetry_question(b, c, p)
-            elif ('inflection' in question):
-                if c == 3 or c == 4 or c == 5 or c == 6:
-                    p = [random.randint(int(params[2 * i]), int(params[2 * i + 1])) for i in range(3)]
-                if c == 2:
-                    b = e
-                q = make_inflection_question(b, c, p)
-            elif ('convexConcave' in question):
-                if c == 3 or c == 4 or c == 5 or c == 6:
-                    p = [random.randint(int(params[2 * i]), int(params[2 * i + 1])) for i in range(3)]
-                if c == 2:
-                    b = e
-                q = make_convex_concave_question(b, c, p)
-            elif ('oddEven' in question):
-                if c == 2:
-                    b = e
-                q = make_odd_even_question(b, c, p)
-            questions.append(q)
-
-    return change_order(questions)
+        if self.store is None or not self.store.put_questions(self.template, questions):
+            self.questions = questions
+        self.size = len(questions)
+        self.done = True
+        if self.degenerate:
+            app.logger.warning("template %s: %d of %d questions are degenerate", self.template,
+                               len(self.degenerate), len(self.degenerate) + self.size)
+
+    # A random question of the table, None if the store lost it
+    def draw(self):
+        position = random.randrange(self.size)
+        if self.questions:
+            return self.questions[position]
+        try:
+            return self.store.question(self.template, position)
+        except KeyError:
+            return None
+
+    def report(self):
+        return {
+            "template": self.template,
+            "done": self.done,
+            "questions": self.size,
+            "degenerate": [{"question": question, "p": p, "reason": reason}
+                           for question, p, reason in self.degenerate]
+        }
+
+
+PRECOMPUTED_TEMPLATES = {}
+# the templates waiting for the precompute thread, which computes them one at a time
+PRECOMPUTE_QUEUE = queue.Queue()
+PRECOMPUTE_LOCK = threading.Lock()
+PRECOMPUTE_THREAD = None
+
+
+def run_precompute():
+    while True:
+        table = PRECOMPUTE_QUEUE.get()
+        try:
+            table.compute()
+        except Exception:
+            app.logger.exception("could not precompute template %s", table.template)
+
+
+# Queues template for the precompute thread if it has at most PRECOMPUTE_MAX_QUESTIONS (question, p) pairs
+def precompute_template(template):
+    global PRECOMPUTE_THREAD
+    if not PRECOMPUTE_ENABLED:
+        return
+    try:
+        size = template_size(template)
+    except (ValueError, IndexError):
+        return
+    if not 0 < size <= PRECOMPUTE_MAX_QUESTIONS:
+        return
+    with PRECOMPUTE_LOCK:
+        if template in PRECOMPUTED_TEMPLATES:
+            return
+        table = PrecomputedTemplate(template, ANSWER_CACHE.store)
+        PRECOMPUTED_TEMPLATES[template] = table
+        PRECOMPUTE_QUEUE.put(table)
+        if PRECOMPUTE_THREAD is None or not PRECOMPUTE_THREAD.is_alive():
+            PRECOMPUTE_THREAD = threading.Thread(target=run_precompute, name='precompute', daemon=True)
+            PRECOMPUTE_THREAD.start()
+
+
+@app.route('/templateReport')
+def templateReport():
+    template = request.args.get('template')
+    table = PRECOMPUTED_TEMPLATES.get(template)
+    if table is None:
+        return "template " + str(template) + " is not precomputed", 400
+    return jsonify(table.report())
 
 
 # generates a tuple that represents a question and its answer choices off odd and even
 
-def make_odd_even_question(b, c, p):
+def make_odd_even_question(b, c, p, numeric=False):
     domain = makeDomain(p, c)
     domain_to_use = []
     for dom in domain:
@@ -1993,8 +3541,11 @@ def make_odd_even_question(b, c, p):
             dom_to_add[1] = 100
         domain_to_use.append(tuple(dom_to_add))
 
-    expr, x = make_sympy_function(p, c, b)
-    ans = get_answers_for_odd_even(expr, x, domain_to_use)
+    def answer():
+        expr, x = make_sympy_function(p, c, b)
+        return get_answers_for_odd_even(expr, x, domain_to_use, numeric)
+
+    ans = cached_answer('oddEven', p, c, b, answer, keep=not numeric)
     fake_ans = generate_fake_answers_odd_even(ans)
     real = ' הפונקציה ' + ans
     answer_1 = ' הפונקציה ' + fake_ans[0]
@@ -2013,27 +3564,33 @@ def make_odd_even_question(b, c, p):
     return q
 
 
-# generates a tuple that represents a question and its answer choices related to the convexity and concavity of a function
-def make_convex_concave_question(b, c, p):
-    expr, x = make_sympy_function(p, c, b)
+# the domain the convexity, inflection and symmetry questions look at: one period for sin and cos
+def question_domain(p, c):
     if c == 3 or c == 4:
-        domain = [(-pi, pi)]
-    else:
-        domain = makeDomain(p, c)
-    domain_to_use = []
-    for dom in domain:
-        dom_to_add = list(dom)
-        if dom_to_add[0] == -inf:
-            dom_to_add[0] = -100
-        if dom_to_add[1] == inf:
-            dom_to_add[1] = 100
-        domain_to_use.append(tuple(dom_to_add))
-    diff_1 = diff(expr, x)
-    diff_2 = diff(diff_1, x)
+        return [(-pi, pi)]
+    return makeDomain(p, c)
 
 
-    points = get_possible_inflection_points(diff_2, x, domain_to_use)
-    ans = get_answers_for_concave_convex(points, domain_to_use, diff_2, x)
+# generates a tuple that represents a question and its answer choices related to the convexity and concavity of a function
+def make_convex_concave_question(b, c, p, numeric=False):
+    domain = question_domain(p, c)
+
+    def answer():
+        domain_to_use = []
+        for dom in domain:
+            dom_to_add = list(dom)
+            if dom_to_add[0] == -inf:
+                dom_to_add[0] = -100
+            if dom_to_add[1] == inf:
+                dom_to_add[1] = 100
+            domain_to_use.append(tuple(dom_to_add))
+        expr, x = make_sympy_function(p, c, b)
+        diff_1 = diff(expr, x)
+        diff_2 = diff(diff_1, x)
+        points = get_possible_inflection_points(diff_2, x, domain_to_use, numeric)
+        return get_answers_for_concave_convex(points, domain_to_use, diff_2, x)
+
+    ans = cached_answer('convexConcave', p, c, b, answer, keep=not numeric)
     real, answer_1, answer_2, answer_3 = generate_fake_answers_convex_concave(ans, domain)
 
     preamble = 'בחר בתחומי הקמירות והקעירות של הפונקציה'
@@ -2047,19 +3604,19 @@ def make_convex_concave_question(b, c, p):
     return q
 
 
-def make_inflection_question(b, c, p):
-    expr, x = make_sympy_function(p, c, b)
-    if c == 3 or c == 4:
-        domain = [(-pi, pi)]
-    else:
-        domain = makeDomain(p, c)
-    diff_1 = diff(expr, x)
-    diff_2 = diff(diff_1, x)
+def make_inflection_question(b, c, p, numeric=False):
+    domain = question_domain(p, c)
 
+    # the sympy expression is only built when the cache misses, the distractors use the compiled function
+    def answer():
+        expr, x = make_sympy_function(p, c, b)
+        diff_1 = diff(expr, x)
+        diff_2 = diff(diff_1, x)
+        points = get_possible_inflection_points(diff_2, x, domain, numeric)
+        return get_answers_for_inflection_points(points, domain, diff_2, x)
 
-    points = get_possible_inflection_points(diff_2, x, domain)
-    ans = get_answers_for_inflection_points(points, domain, diff_2, x)
-    real, answer_1, answer_2, answer_3 = generate_fake_answers_inflection(ans, expr, x, domain)
+    ans = cached_answer('inflection', p, c, b, answer, keep=not numeric)
+    real, answer_1, answer_2, answer_3 = generate_fake_answers_inflection(ans, makeFunc(p, c, b), domain)
 
     preamble = 'בחר בנקודת פיתול אפשרית של הפונקציה'
     q = (preamble,
@@ -2072,18 +3629,18 @@ def make_inflection_question(b, c, p):
     return q
 
 
-def make_symmetry_question(b, c, p):
-    expr, x = make_sympy_function(p, c, b)
-    if c == 3 or c == 4:
-        domain = [(-pi, pi)]
-    else:
-        domain = makeDomain(p, c)
-    c_symbol = symbols('c')
-
-    print(expr)
+def make_symmetry_question(b, c, p, numeric=False):
+    def answer():
+        expr, x = make_sympy_function(p, c, b)
+        print(expr)
+        return get_answers_for_symmetry_asymmetry(expr, x, symbols('c'), question_domain(p, c), numeric)
 
-    ans = get_answers_for_symmetry_asymmetry(expr, x, c_symbol, domain)
-    real, answer_1, answer_2, answer_3 = generate_fake_answers_symmetry(ans, expr, x)
+    # for sin the correct answer is randomly a symmetry or an asymmetry, so it is not cached
+    if c == 3:
+        ans = answer()
+    else:
+        ans = cached_answer('symmetry', p, c, b, answer, keep=not numeric)
+    real, answer_1, answer_2, answer_3 = generate_fake_answers_symmetry(ans)
 
     preamble = 'בחר בציר סימטריה אנכי אפשרי של הפונקציה'
     q = (preamble,
@@ -2097,7 +3654,7 @@ def make_symmetry_question(b, c, p):
 
 
 def make_pos_neg_question(b, c, p):
-    pos, neg = makePosNeg(p, c, b)
+    pos, neg = cached_answer('posNeg', p, c, b, lambda: makePosNeg(p, c, b))
     preamble = "מצא תחומי חיוביות שליליות"
     p1, n1 = randFillPair(len(pos) + len(neg))
     result2 = (" חיוביות: " + str(p1) + " שליליות: " + str(n1) + " ")
@@ -2130,7 +3687,10 @@ def definite_integral_question(b, c, f, integral_range, p):
 
     ans = 0
     for r in ranges:
-        ans += integrate(f, r[0], r[1], int((r[1] - r[0]) * 100))
+        value, error = integrateWithError(f, r[0], r[1])
+        if error > 1e-6:
+            app.logger.warning("integral of %s over %s is only accurate to %g", funcString(p, c, b), r, error)
+        ans += value
     string_range = str(integral_range[0]) + "," + str(integral_range[1])
     preamble = string_range + "מצא את האינטגרל בתחום: "
     ans2 = ans + random.randint(1, 5)
@@ -2144,20 +3704,7 @@ def make_intersection_question(b, c, f, p):
     if not any(p):
         points = "כל הנקודות"
     else:
-        dom = makeDomain(p, c)
-        points = makeIntersections(f, c, dom)
-
-        intersect_with_y_axis = False
-        for item in points:
-            if item[0] == 0:
-                intersect_with_y_axis = True
-        print("points:",points)
-        if (not f(0) is None):
-            if (abs(f(0)) >= 0.001) or (not intersect_with_y_axis):
-                points.append((0.0, float(round(f(0), 2))))
-        else:
-            if len(points) == 0:
-                points = "אין נקודות חיתוך"
+        points = cached_answer('intersection', p, c, b, lambda: intersection_points(f, c, p))
 
     preamble = "מצא את נקודות החיתוך עם הצירים:"
     ans2 = [(random.randint(-10000, 10000) / 1000, 0.0) for i in range(len(p) - 1)]
@@ -2170,6 +3717,24 @@ def make_intersection_question(b, c, f, p):
     return q
 
 
+def intersection_points(f, c, p):
+    dom = makeDomain(p, c)
+    points = makeIntersections(f, c, dom)
+
+    intersect_with_y_axis = False
+    for item in points:
+        if item[0] == 0:
+            intersect_with_y_axis = True
+    print("points:",points)
+    if (not f(0) is None):
+        if (abs(f(0)) >= 0.001) or (not intersect_with_y_axis):
+            points.append((0.0, float(round(f(0), 2))))
+    else:
+        if len(points) == 0:
+            points = "אין נקודות חיתוך"
+    return points
+
+
 def make_derive_question(b, c, p):
     preamble = "מצא מהי הנגזרת של הפונקציה"
     ans1 = deriveString(p, c, b)
@@ -2187,7 +3752,7 @@ def make_derive_question(b, c, p):
 
 
 def make_incDec_question(b, c, p):
-    inc, dec = makeIncDec(p, c, b)
+    inc, dec = cached_answer('incDec', p, c, b, lambda: makeIncDec(p, c, b))
     preamble = "מצא תחומי עלייה וירידה:"
     i1, d1 = randFillPair(len(inc) + len(dec))
     result2 = (" עלייה: " + str(i1) + " ירידה: " + str(d1) + " ")
@@ -2205,7 +3770,7 @@ def make_incDec_question(b, c, p):
 
 
 def make_extreme_question(b, c, p):
-    points = makeExtremes(p, c, b)
+    points = cached_answer('minMaxPoints', p, c, b, lambda: makeExtremes(p, c, b))
     if points == []:
         points = 'אין נקודות קיצון'
     to_put_no_extreme_points = 0
@@ -2232,7 +3797,7 @@ def make_domain_question(b, c, p):
     x2 = -x1
     ans2 = [(x1, x2)]
     if c in [2, 5, 6, 7, 8]:
-        ans1 = find_real_domain(p, c)
+        ans1 = cached_answer('domain', p, c, b, lambda: find_real_domain(p, c))
         if len(ans1) == 0:
             ans1 = "הפונקציה לא מוגדרת עבור אף x".format('x')
         flag = True
@@ -2283,24 +3848,49 @@ def randFillPair(n):
     return inc, dec
 
 
+# The latest attempt of user at unit, 0 if the unit was never started. A single MAX() that SQLite answers from
+# the end of the ActiveUnit primary key range (unit, student), so retries don't make it slower.
 def get_max_unit(unit, user):
-    maxAttempt = 0
-    for activeU in ActiveUnit.select(unit=unit, student=user):
-        if activeU.attempt > maxAttempt:
-            maxAttempt = activeU.attempt
-    return maxAttempt
+    name = user.name if isinstance(user, User) else user
+    return max(a.attempt for a in ActiveUnit if a.unit == unit and a.student.name == name) or 0
+
+
+QUESTION_COLUMNS = ('{Question.id}', '{Question.question_preamble}', '{Question.question}', '{Question.answer1}',
+                    '{Question.answer2}', '{Question.answer3}', '{Question.answer4}', '{Question.correct_ans}',
+                    '{Question.active_unit[0]}', '{Question.active_unit[1]}', '{Question.active_unit[2]}',
+                    '{Question.active_unit[3]}', '{Question.solve_time}')
+
+
+# Adds a batch of generated question tuples to the active unit, numbered from first_id, with a single
+# executemany instead of an ORM object and an INSERT per question. The pending ORM changes (e.g. a new
+# ActiveUnit) are flushed first so the rows go into the same transaction. The rows bypass Pony's identity map,
+# so active.questions, if it was loaded, is marked as partly loaded and the rest is read on its next use.
+# Must run inside a db_session.
+def insert_questions(active, first_id, questions):
+    rows = [(first_id + i, q[0], q[1], str(q[2]), str(q[3]), str(q[4]), str(q[5]), q[6],
+             active.unit.name, active.unit.cls.name, active.student.name, active.attempt, '')
+            for i, q in enumerate(questions)]
+    if not rows:
+        return 0
+    flush()
+    placeholder = '?' if DB.provider.paramstyle == 'qmark' else '%s'
+    statement = sql('INSERT INTO {Question} (%s) VALUES (%s)' % (', '.join(QUESTION_COLUMNS),
+                                                                  ', '.join([placeholder] * len(QUESTION_COLUMNS))))
+    DB.get_connection().cursor().executemany(statement, rows)
+    loaded = active._vals_.get(ActiveUnit.questions)
+    if loaded is not None:
+        loaded.is_fully_loaded = False
+        loaded.count = None
+    return len(rows)
 
 
 def addQuestions_buisness(className, unitName, username):
     try:
         with db_session:
             unit = Unit[unitName, Cls[className]]
-            c = 1
+            entry = lesson_entry(unit)
+            c = LessonUnit.select(lambda e: e.lesson == entry.lesson and e.position >= entry.position).count()
             print("AQB")
-            tu = unit
-            while tu.next:
-                c += 1
-                tu = Unit[tu.next, Cls[className]]
             user = User[username]
 
             print("step1")
@@ -2309,6 +3899,7 @@ def addQuestions_buisness(className, unitName, username):
                 ActiveUnit(inProgress=True, unit=unit, student=user, attempt=maxAttempt + 1, currentQuestion=0,
                            consecQues=0, quesAmount=0, totalCorrect=0, grade=0)
                 maxAttempt += 1
+                lesson_progress(user, unitName, className)
             active = ActiveUnit[unit, user, (maxAttempt)]
             print("step2")
             if not active.inProgress:
@@ -2321,13 +3912,7 @@ def addQuestions_buisness(className, unitName, username):
                 return jsonify(unit.maxTime,str(c))
             id = active.quesAmount + 1
             active.quesAmount += 10
-            for single_question in get_questions(unit):
-                Question(id=id, question_preamble=single_question[0], question=single_question[1],
-                         correct_ans=single_question[6], answer1=str(single_question[2]),
-                         answer2=str(single_question[3]), answer3=str(single_question[4]),
-                         answer4=str(single_question[5]),
-                         active_unit=ActiveUnit[unit, user, maxAttempt])
-                id += 1
+            insert_questions(active, id, take_questions(unit.template))
             print("step4")
 
             commit()
@@ -2338,6 +3923,128 @@ def addQuestions_buisness(className, unitName, username):
 
 
 
+# Appends batch number batch + 1 to an attempt once the student is within QUESTION_REFILL_AHEAD questions of the
+# end of batch number batch (the attempt then has batch * QUESTIONS_TO_GENERATE questions). Nothing is added when
+# the attempt is over, is not that close to the end yet, or has more batches already, so the refill of a batch
+# happens at most once however often it is asked for. The questions are generated before the write transaction
+# opens and the batch count is checked again before adding. Returns the number of questions added.
+def refillActiveUnit_buisness(className, unitName, username, attempt, batch):
+    amount = batch * QUESTIONS_TO_GENERATE
+    with db_session:
+        unit = Unit[unitName, Cls[className]]
+        active = ActiveUnit[unit, username, attempt]
+        if not active.inProgress or active.quesAmount != amount \
+                or active.quesAmount - active.currentQuestion > QUESTION_REFILL_AHEAD:
+            return 0
+        template = unit.template
+    questions = take_questions(template)
+    with db_session:
+        active = ActiveUnit[Unit[unitName, Cls[className]], username, attempt]
+        if active.quesAmount != amount:
+            return 0
+        active.quesAmount += QUESTIONS_TO_GENERATE
+        return insert_questions(active, amount + 1, questions)
+
+
+# Refills attempts in the background ahead of their last question, so a student doesn't wait on generation between
+# batches. The refills run on a pool of worker threads (the questions themselves are built by GENERATION_EXECUTOR),
+# so a slow template doesn't hold up the refills of other students. A refill is keyed by (class, unit, student,
+# attempt, batch) and requests for a key already waiting are dropped, wait() blocks until the pending refill of a
+# key (if any) is done. stats() reports the refills, the failures, what is pending, the lag between asking for a
+# refill and its questions being there (over the last lag_window refills) and the stalls, i.e. the times a student
+# got to the end of a batch while its refill was still pending.
+class QuestionRefiller:
+
+    def __init__(self, refill, workers, lag_window=200):
+        self.refill = refill
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pool = None
+        self.lags = deque(maxlen=lag_window)
+        self.refills = 0
+        self.failures = 0
+        self.stalls = 0
+
+    # Returns False if a refill of the key was pending already
+    def request(self, class_name, unit_name, username, attempt, batch):
+        key = (class_name, unit_name, username, attempt, batch)
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending[key] = (threading.Event(), time.monotonic())
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(self.workers,
+                                                                  thread_name_prefix='question-refiller')
+            pool = self.pool
+        pool.submit(self.run, key)
+        return True
+
+    def wait(self, class_name, unit_name, username, attempt, batch, timeout=None):
+        with self.lock:
+            pending = self.pending.get((class_name, unit_name, username, attempt, batch))
+        return pending is None or pending[0].wait(timeout)
+
+    def stalled(self):
+        with self.lock:
+            self.stalls += 1
+
+    def run(self, key):
+        try:
+            if self.refill(*key):
+                with self.lock:
+                    self.refills += 1
+                    self.lags.append(time.monotonic() - self.pending[key][1])
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            app.logger.exception("question refill failed for %s", key)
+        finally:
+            with self.lock:
+                self.pending.pop(key)[0].set()
+
+    def stats(self):
+        with self.lock:
+            lags = sorted(self.lags)
+            return {
+                "refills": self.refills,
+                "failures": self.failures,
+                "pending": len(self.pending),
+                "stalls": self.stalls,
+                "lag_ms": {
+                    "mean": round(1000 * sum(lags) / len(lags), 3) if lags else 0,
+                    "p95": round(1000 * lags[int(0.95 * (len(lags) - 1))], 3) if lags else 0,
+                    "max": round(1000 * lags[-1], 3) if lags else 0
+                }
+            }
+
+
+QUESTION_REFILLER = QuestionRefiller(refillActiveUnit_buisness, QUESTION_REFILL_WORKERS)
+
+
+@app.route('/questionRefillStats')
+def questionRefillStats():
+    return jsonify(QUESTION_REFILLER.stats())
+
+
+# Whether the latest attempt of the student is still waiting for its next batch. The refill of the batch is asked
+# for if there is none (the one asked for ahead failed), and waited on for up to QUESTION_REFILL_WAIT seconds. The
+# questions are never built here, on the read path. Reaching the end of the batch while its refill was pending
+# counts as a stall.
+def ensure_next_question(user, unit_name, class_name):
+    with db_session:
+        unit = Unit[unit_name, Cls[class_name]]
+        attempt = get_max_unit(unit, user)
+        if not attempt:
+            return False
+        active = ActiveUnit[unit, user, attempt]
+        if not active.inProgress or active.currentQuestion < active.quesAmount:
+            return False
+        batch = active.quesAmount // QUESTIONS_TO_GENERATE
+    if not QUESTION_REFILLER.request(class_name, unit_name, user, attempt, batch):
+        QUESTION_REFILLER.stalled()
+    return not QUESTION_REFILLER.wait(class_name, unit_name, user, attempt, batch, timeout=QUESTION_REFILL_WAIT)
+
 # now all this does is add 10 questions to the active unit
 @app.route('/startUnit')
 def startUnit():
@@ -2477,79 +4184,27 @@ def getAllActiveUnits_buisness(className, unitName):
         return f"Error: {str(e)}", 400
 
 
+# Sums up the correct and wrong answers of every student over the unit unitName and all the units after it in
+# its lesson, optionally only for one student. The lesson range and the ActiveUnit rows are grouped in a single
+# query, however many units and students there are. Students come in the order of the first unit they have an
+# ActiveUnit in.
 def getAllActiveUnits(className, unitName, student=None):
     try:
         with db_session:
-            unames = []
-            names = []
-            units = []
-            actives = []
-            students = []
-            u = Unit[unitName, className]
-            stop = False
-            while not stop:
-                unames.append(u.name)
-                units.append(u)
-                if student:
-                    instances = ActiveUnit.select(unit=u, student=student)
-                else:
-                    instances = ActiveUnit.select(unit=u)
-                for i in instances:
-                    if i.student.name not in names:
-                        names.append(i.student.name)
-                        single_obj = dict()
-                        single_obj["name"] = i.student.name
-                        single_obj["correct"] = i.totalCorrect
-                        single_obj["bad"] = (i.currentQuestion - i.totalCorrect)
-                        students.append(single_obj)
-                    else:
-                        item = itemByName(students, i.student.name)
-                        item["correct"] += i.totalCorrect
-                        item["bad"] += (i.currentQuestion - i.totalCorrect)
-                if u.next:
-                    u = Unit[u.next, className]
-                else:
-                    stop = True
-            return students
-    except Exception as e:
-        print(e)
-        return str(e), 400
-
-
-def getAllActiveUnits(className, unitName, student=None):
-    try:
-        with db_session:
-            unames = []
-            names = []
-            units = []
-            actives = []
-            students = []
-            u = Unit[unitName, className]
-            stop = False
-            while not stop:
-                unames.append(u.name)
-                units.append(u)
-                if student:
-                    instances = ActiveUnit.select(unit=u, student=student)
-                else:
-                    instances = ActiveUnit.select(unit=u)
-                for i in instances:
-                    if i.student.name not in names:
-                        names.append(i.student.name)
-                        single_obj = dict()
-                        single_obj["name"] = i.student.name
-                        single_obj["correct"] = i.totalCorrect
-                        single_obj["bad"] = (i.currentQuestion - i.totalCorrect)
-                        students.append(single_obj)
-                    else:
-                        item = itemByName(students, i.student.name)
-                        item["correct"] += i.totalCorrect
-                        item["bad"] += (i.currentQuestion - i.totalCorrect)
-                if u.next:
-                    u = Unit[u.next, className]
-                else:
-                    stop = True
-            return students
+            entry = lesson_entry(Unit[unitName, className])
+            lesson, position = entry.lesson.id, entry.position
+            rows = DB.select(sql("""
+                au.{ActiveUnit.student}, SUM(au.{ActiveUnit.totalCorrect}),
+                    SUM(au.{ActiveUnit.currentQuestion} - au.{ActiveUnit.totalCorrect})
+                FROM {LessonUnit} lu
+                JOIN {ActiveUnit} au ON au.{ActiveUnit.unit[0]} = lu.{LessonUnit.unit[0]}
+                    AND au.{ActiveUnit.unit[1]} = lu.{LessonUnit.unit[1]}
+                WHERE lu.{LessonUnit.lesson} = $lesson AND lu.{LessonUnit.position} >= $position
+                    AND ($student IS NULL OR au.{ActiveUnit.student} = $student)
+                GROUP BY au.{ActiveUnit.student}
+                ORDER BY MIN(lu.{LessonUnit.position}), au.{ActiveUnit.student}
+            """))
+            return [{"name": name, "correct": int(correct), "bad": int(bad)} for name, correct, bad in rows]
     except Exception as e:
         print(e)
         return str(e), 400
@@ -2593,27 +4248,76 @@ def getQuestion():
         return str(e), 400
 
 
+# Everything /getQuestion needs in one indexed query: the latest attempt of the student at the unit (walking the
+# ActiveUnit primary key backwards), its next question, the unit's Qnum and the LessonProgress row covering the
+# unit. None when any of them is missing, the caller then takes the slow path, which rebuilds the lesson
+# progress or reports what is missing.
+def current_question(user, unit_name, class_name):
+    rows = DB.select(sql("""
+        q.{Question.id}, q.{Question.question}, q.{Question.answer1}, q.{Question.answer2}, q.{Question.answer3},
+            q.{Question.answer4}, q.{Question.correct_ans}, q.{Question.question_preamble}, au.{ActiveUnit.consecQues},
+            un.{Unit.Qnum}, 1 + lu.{LessonUnit.position} - lp.{LessonProgress.first}, lp.{LessonProgress.units}
+        FROM {ActiveUnit} au
+        JOIN {Unit} un ON un.{Unit.name} = au.{ActiveUnit.unit[0]} AND un.{Unit.cls} = au.{ActiveUnit.unit[1]}
+        JOIN {Question} q ON q.{Question.active_unit[0]} = au.{ActiveUnit.unit[0]}
+            AND q.{Question.active_unit[1]} = au.{ActiveUnit.unit[1]}
+            AND q.{Question.active_unit[2]} = au.{ActiveUnit.student}
+            AND q.{Question.active_unit[3]} = au.{ActiveUnit.attempt}
+            AND q.{Question.id} = au.{ActiveUnit.currentQuestion} + 1
+        LEFT JOIN {LessonUnit} lu ON lu.{LessonUnit.unit[0]} = au.{ActiveUnit.unit[0]}
+            AND lu.{LessonUnit.unit[1]} = au.{ActiveUnit.unit[1]}
+        LEFT JOIN {LessonProgress} lp ON lp.{LessonProgress.student} = au.{ActiveUnit.student}
+            AND lp.{LessonProgress.lesson} = lu.{LessonUnit.lesson}
+            AND lu.{LessonUnit.position} >= lp.{LessonProgress.first}
+            AND lu.{LessonUnit.position} < lp.{LessonProgress.first} + lp.{LessonProgress.units}
+        WHERE au.{ActiveUnit.unit[0]} = $unit_name AND au.{ActiveUnit.unit[1]} = $class_name
+            AND au.{ActiveUnit.student} = $user
+            AND au.{ActiveUnit.attempt} = (SELECT MAX(latest.{ActiveUnit.attempt}) FROM {ActiveUnit} latest
+                                           WHERE latest.{ActiveUnit.unit[0]} = $unit_name
+                                               AND latest.{ActiveUnit.unit[1]} = $class_name
+                                               AND latest.{ActiveUnit.student} = $user)
+        LIMIT 1
+    """))
+    if not rows or rows[0][10] is None:
+        return None
+    return rows[0]
+
+
 def getQuestion_buisness(user, unit_name, class_name, question_number):
     try:
+        with db_session:
+            row = current_question(user, unit_name, class_name)
+        if row is None and ensure_next_question(user, unit_name, class_name):
+            # the last question of the batch was answered and its refill is still running
+            return "the next questions of unit " + unit_name + " are still being generated", 202, \
+                {'Retry-After': str(QUESTION_REFILL_WAIT)}
         with db_session:
             ret = []
-            unit = Unit[unit_name, Cls[class_name]]
-            attempt = get_max_unit(unit, user)
-            active = ActiveUnit[unit, user, attempt]
-            question = Question[active, active.currentQuestion + 1]
-            currentUnit, totalUnits = getLessonIndex(user, unit_name, class_name)
+            if row is None:
+                row = current_question(user, unit_name, class_name)
+            if row is None:
+                unit = Unit[unit_name, Cls[class_name]]
+                attempt = get_max_unit(unit, user)
+                active = ActiveUnit[unit, user, attempt]
+                question = Question[active, active.currentQuestion + 1]
+                currentUnit, totalUnits = getLessonIndex(user, unit_name, class_name)
+                row = (question.id, question.question, question.answer1, question.answer2, question.answer3,
+                       question.answer4, question.correct_ans, question.question_preamble, active.consecQues,
+                       unit.Qnum, currentUnit, totalUnits)
+            qid, primary, answer1, answer2, answer3, answer4, correct_ans, preamble, consecQues, Qnum, currentUnit, \
+                totalUnits = row
             single_question = dict()
-            single_question["id"] = question.id
+            single_question["id"] = qid
             # single_question["question_preamble"] = question.question_preamble
-            single_question["primary"] = question.question
-            single_question["answer1"] = question.answer1
-            single_question["answer2"] = question.answer2
-            single_question["answer3"] = question.answer3
-            single_question["answer4"] = question.answer4
-            single_question["correct_ans"] = question.correct_ans
-            single_question["preamble"] = question.question_preamble
-            single_question["currentQuestion"] = active.consecQues
-            single_question["questionsNeeded"] = unit.Qnum
+            single_question["primary"] = primary
+            single_question["answer1"] = answer1
+            single_question["answer2"] = answer2
+            single_question["answer3"] = answer3
+            single_question["answer4"] = answer4
+            single_question["correct_ans"] = correct_ans
+            single_question["preamble"] = preamble
+            single_question["currentQuestion"] = consecQues
+            single_question["questionsNeeded"] = Qnum
             single_question["currentUnit"] = currentUnit
             single_question["totalUnits"] = totalUnits
 
@@ -2644,48 +4348,102 @@ def submitQuestion():
         return str(e), 400
 
 
+# Records the answer to question in one short write: the question is claimed (only if it has no answer yet) and
+# the counters of the attempt are bumped with UPDATE ... SET x = x + 1, so concurrent requests can't lose
+# updates. Returns False, without changing anything, when the question was answered already.
+def record_answer(active, question, correct, date_string, solve_time):
+    unit_name, class_name, student, attempt = active.unit.name, active.unit.cls.name, active.student.name, active.attempt
+    question_id = question.id
+    solved = 1 if correct else 0
+    claimed = DB.execute(sql("""
+        UPDATE {Question} SET {Question.solve_time} = $solve_time, {Question.solved_correctly} = $correct
+        WHERE {Question.active_unit[0]} = $unit_name AND {Question.active_unit[1]} = $class_name
+            AND {Question.active_unit[2]} = $student AND {Question.active_unit[3]} = $attempt
+            AND {Question.id} = $question_id AND {Question.solve_time} = ''
+    """)).rowcount
+    if not claimed:
+        return False
+    DB.execute(sql("""
+        UPDATE {ActiveUnit} SET {ActiveUnit.currentQuestion} = {ActiveUnit.currentQuestion} + 1,
+            {ActiveUnit.totalCorrect} = {ActiveUnit.totalCorrect} + $solved,
+            {ActiveUnit.consecQues} = CASE WHEN $solved = 1 THEN {ActiveUnit.consecQues} + 1 ELSE 0 END,
+            {ActiveUnit.grade} = ({ActiveUnit.totalCorrect} + $solved) * 100 / ({ActiveUnit.currentQuestion} + 1),
+            {ActiveUnit.lastTimeAnswered} = $date_string
+        WHERE {ActiveUnit.unit[0]} = $unit_name AND {ActiveUnit.unit[1]} = $class_name
+            AND {ActiveUnit.student} = $student AND {ActiveUnit.attempt} = $attempt
+    """))
+    return True
+
+
+# The response to an answer, from the state of the attempt after it was recorded
+def answer_result(unit, question, correct, consecQues):
+    if not correct:
+        return "incorrect", (200 + question.correct_ans)
+    if consecQues >= int(unit.Qnum):
+        if unit.next:
+            return jsonify(unit.next), 206
+        return "answered enough consecutive questions", 205
+    return "correct"
+
+
 def submitQuestion_buisness(user, unit_name, class_name, question_number, ans_number):
     try:
         with db_session:
             now = datetime.now()
             date_string = now.strftime("%d.%m.%Y")
-            retValue = 200
             unit = Unit[unit_name, Cls[class_name]]
             attempt = get_max_unit(unit, user)
             activeUnit = ActiveUnit[unit, user, attempt]
             question = Question[activeUnit, question_number]
-            activeUnit.currentQuestion += 1
-            activeUnit.lastTimeAnswered = date_string
+            if question.solve_time:
+                # answered already, e.g. resent by a flaky connection: answer the same way without counting it again
+                return answer_result(unit, question, question.solved_correctly, activeUnit.consecQues)
+            correct = question.correct_ans == ans_number
+            # read before the counters below change, a rebuild would count this answer twice otherwise
+            progress = lesson_progress(user, unit_name, class_name) if attempt == 1 else None
+            flush()
             current_time = datetime.now()
             current_time_millis = int(current_time.timestamp() * 1000)
             current_time_millis_str = str(current_time_millis)
-            question.solve_time = current_time_millis_str
-
-            if (not activeUnit.currentQuestion < activeUnit.quesAmount):
-                addQuestions_buisness(class_name, unit_name, user)
-
-            if question.correct_ans == ans_number:
-                question.solved_correctly = True
-                activeUnit.consecQues += 1
-                activeUnit.totalCorrect += 1
-                activeUnit.grade = int(((activeUnit.totalCorrect / activeUnit.currentQuestion) * 100))
-
-            else:
-                question.solved_correctly = False
-                activeUnit.consecQues = 0
-                activeUnit.grade = int(((activeUnit.totalCorrect / activeUnit.currentQuestion) * 100))
-                return "incorrect", (200 + question.correct_ans)
-
-            if (activeUnit.consecQues == int(unit.Qnum) or activeUnit.consecQues > int(unit.Qnum)):
-                activeUnit.inProgress = False
-                if activeUnit.unit.next:
-                    return jsonify(activeUnit.unit.next), 206
-                else:
-                    return "answered enough consecutive questions", 205
-
-            return "correct"
-
-            return "question answered", retValue
+            if not record_answer(activeUnit, question, correct, date_string, current_time_millis_str):
+                # another request got there first, answer with what it stored
+                question_id = question.id
+                solved_correctly, consecQues = DB.select(sql("""
+                    q.{Question.solved_correctly}, au.{ActiveUnit.consecQues} FROM {Question} q JOIN {ActiveUnit} au
+                        ON au.{ActiveUnit.unit[0]} = q.{Question.active_unit[0]}
+                        AND au.{ActiveUnit.unit[1]} = q.{Question.active_unit[1]}
+                        AND au.{ActiveUnit.student} = q.{Question.active_unit[2]}
+                        AND au.{ActiveUnit.attempt} = q.{Question.active_unit[3]}
+                    WHERE q.{Question.active_unit[0]} = $unit_name AND q.{Question.active_unit[1]} = $class_name
+                        AND q.{Question.active_unit[2]} = $user AND q.{Question.active_unit[3]} = $attempt
+                        AND q.{Question.id} = $question_id
+                """))[0]
+                return answer_result(unit, question, solved_correctly, consecQues)
+            if progress:
+                lesson, solved = progress.lesson.id, 1 if correct else 0
+                DB.execute(sql("""
+                    UPDATE {LessonProgress} SET {LessonProgress.solved} = {LessonProgress.solved} + 1,
+                        {LessonProgress.correct} = {LessonProgress.correct} + $solved
+                    WHERE {LessonProgress.student} = $user AND {LessonProgress.lesson} = $lesson
+                """))
+            currentQuestion, quesAmount, consecQues = DB.select(sql("""
+                {ActiveUnit.currentQuestion}, {ActiveUnit.quesAmount}, {ActiveUnit.consecQues} FROM {ActiveUnit}
+                WHERE {ActiveUnit.unit[0]} = $unit_name AND {ActiveUnit.unit[1]} = $class_name
+                    AND {ActiveUnit.student} = $user AND {ActiveUnit.attempt} = $attempt
+            """))[0]
+            finished = correct and consecQues >= int(unit.Qnum)
+            if finished:
+                in_progress = False
+                DB.execute(sql("""
+                    UPDATE {ActiveUnit} SET {ActiveUnit.inProgress} = $in_progress
+                    WHERE {ActiveUnit.unit[0]} = $unit_name AND {ActiveUnit.unit[1]} = $class_name
+                        AND {ActiveUnit.student} = $user AND {ActiveUnit.attempt} = $attempt
+                """))
+            result = answer_result(unit, question, correct, consecQues)
+        # the next batch is generated in the background, outside this transaction, before the student gets there
+        if not finished and quesAmount - currentQuestion <= QUESTION_REFILL_AHEAD:
+            QUESTION_REFILLER.request(class_name, unit_name, user, attempt, quesAmount // QUESTIONS_TO_GENERATE)
+        return result
     except Exception as e:
         print(e)
         return str(e), 400
@@ -2717,11 +4475,7 @@ def quitActiveUnit_buisness(user, unit_name, class_name):
 
 
 def makePoly(p):
-    return (lambda x:
-            float(sum([
-                p[i] * (x ** (len(p) - i - 1))
-                for i in range(len(p))
-            ])))
+    return makeFunc(p, 0)
 
 
 def makeRationalOfTwoFuncs(f1, f2):
@@ -2745,99 +4499,137 @@ def makeNegateFunc(f):
             )
 
 
-def regulaFalsi(f1: callable, f2: callable, x1: float, x2: float, a: float, b: float, maxerr=0.0001) -> float:
-    max_amount_of_iteration_loop = 30
-    f_x1 = f1(x1) - f2(x1)
-    f_x2 = f1(x2) - f2(x2)
-    if f_x1 == f_x2:
-        return None
-    x = (x1 * f_x2 - x1 * f_x1) / (f_x2 - f_x1)
+# Walks from start towards stop in steps of step (step < 0 walks left) and returns the first point where both
+# f1 and f2 are defined, or the first point that is no longer before stop. The points are probed in chunks,
+# so compiled functions are evaluated with one numpy call per chunk instead of one call per point.
+# Chunks start small (the first point is usually defined) and double up to max_chunk.
+def firstDefinedPoint(f1: callable, f2: callable, start: float, stop: float, step: float, max_chunk=4096) -> float:
+    x = start
+    chunk = 8
+    while True:
+        xs = np.add.accumulate(np.concatenate(([x], np.full(chunk - 1, step))))
+        defined = ~np.isnan(evaluateMany(f1, xs)) & ~np.isnan(evaluateMany(f2, xs))
+        inside = xs < stop if step > 0 else xs > stop
+        done = defined | ~inside
+        if done.any():
+            return float(xs[np.argmax(done)])
+        x = xs[-1] + step
+        chunk = min(2 * chunk, max_chunk)
+
+
+# Real roots of the polynomial with the given coefficients inside [a, b] (which may be infinite), found from the
+# eigenvalues of its companion matrix (numpy.roots) instead of sampling. A repeated root comes back from
+# numpy.roots with a small imaginary part, so nearly real candidates are kept if the polynomial vanishes there
+# up to rounding. Repeated roots are reported once.
+def polyRoots(coefficients, a: float, b: float, maxerr=0.00001) -> np.ndarray:
+    roots = np.roots(coefficients)
+    roots = roots[np.abs(roots.imag) <= 1e-3 * np.maximum(1, np.abs(roots))].real
+    scale = hornerArray(np.abs(np.asarray(coefficients, dtype=float)), np.abs(roots))
+    roots = np.sort(roots[np.abs(hornerArray(coefficients, roots)) <= 1e-9 * scale])
+    roots = roots[(roots >= a) & (roots <= b)]
+    return dedupeRoots(roots, max(maxerr, 1e-4))
+
+
+# The real roots of the polynomial p over the whole line, and the sign of p on each of the len(roots) + 1
+# open intervals they split it into
+def polySigns(p):
+    roots = polyRoots(p, float('-inf'), float('inf'))
+    if len(roots) == 0:
+        probes = np.zeros(1)
+    else:
+        probes = np.concatenate(([roots[0] - 1], (roots[:-1] + roots[1:]) / 2, [roots[-1] + 1]))
+    return roots, np.sign(hornerArray(p, probes))
 
-    i = 0
-    while np.abs(f1(x) - f2(x)) >= maxerr and a - maxerr <= x <= b + maxerr and i < max_amount_of_iteration_loop:
 
-        x = (x1 * f_x2 - x2 * f_x1) / (f_x2 - f_x1)
+# Splits the line at the given points into (left, right) intervals and sorts them by the sign they have,
+# neighbouring intervals of the same sign are merged unless split is set
+def signIntervals(points, signs, split=True):
+    bounds = [float('-inf')] + [float(x) for x in points] + [float('inf')]
+    pos = []
+    neg = []
+    left = bounds[0]
+    for i in range(len(signs)):
+        if not split and i < len(signs) - 1 and signs[i] == signs[i + 1]:
+            continue
+        if signs[i] > 0:
+            pos.append((left, bounds[i + 1]))
+        elif signs[i] < 0:
+            neg.append((left, bounds[i + 1]))
+        left = bounds[i + 1]
+    return pos, neg
 
-        if f1(x) is None or f2(x) is None:
-            if x < a:
-                x = a + maxerr
-            elif x > b:
-                x = b - maxerr
 
-        if np.abs(f1(x) - f2(x)) <= maxerr:
-            break
-        elif f_x1 * (f1(x) - f2(x)) < 0:
-            x1 = x
-            f_x1 = f1(x1) - f2(x1)
-        else:
-            x2 = x
-            f_x2 = f1(x2) - f2(x2)
-        i += 1
-    if i > max_amount_of_iteration_loop or (x > b or x < a) or np.abs(f1(x) - f2(x)) > maxerr:
-        return None
-    return x
+# The extreme points of the polynomial p: the roots of p' where p' changes sign
+def polyExtremes(p):
+    roots, signs = polySigns(makeDer(p))
+    f = makeFunc(p)
+    points = [round(float(x), 2) for i, x in enumerate(roots) if signs[i] * signs[i + 1] < 0]
+    return [(x, round(f(x), 3)) for x in points]
 
 
-def helper(f1: callable, f2: callable, a: float, b: float, maxerr=0.001) -> Iterable:
-    diff = b - a
-    int_of_diff = int(diff)
+def dedupeRoots(xs: np.ndarray, maxerr: float) -> np.ndarray:
+    if len(xs) == 0:
+        return xs
+    return xs[np.concatenate(([True], np.diff(xs) > maxerr))]
 
-    max_amount_of_points = int_of_diff * 50
-    x1 = a
 
-    # check this if
+# Returns the coefficients of f1 - f2 if both are compiled polynomials, otherwise None
+def polyDifference(f1: callable, f2: callable):
+    if not (isinstance(f1, CompiledFunc) and isinstance(f2, CompiledFunc) and f1.c == 0 and f2.c == 0):
+        return None
+    size = max(len(f1.p), len(f2.p))
+    return [float(x) for x in np.pad(np.asarray(f1.p, dtype=float), (size - len(f1.p), 0)) -
+            np.pad(np.asarray(f2.p, dtype=float), (size - len(f2.p), 0))]
+
+
+# Refines all the brackets [x1[i], x2[i]] (where f1 - f2 changes sign) together with the Illinois variant of
+# regula falsi. A bracket is reported as a root only if |f1 - f2| <= maxerr at the end, so sign changes across
+# a pole (tan, cot, rational functions) are dropped.
+def refineBrackets(f1: callable, f2: callable, x1: np.ndarray, x2: np.ndarray, g1: np.ndarray, g2: np.ndarray,
+                   maxerr=0.00001, max_iterations=60) -> np.ndarray:
+    if len(x1) == 0:
+        return x1
+    x = x1
+    gx = g1
+    with np.errstate(all='ignore'):
+        for i in range(max_iterations):
+            x = (x1 * g2 - x2 * g1) / (g2 - g1)
+            gx = evaluateMany(f1, x) - evaluateMany(f2, x)
+            crossed = gx * g2 < 0
+            x1, g1 = np.where(crossed, x2, x1), np.where(crossed, g2, g1 / 2)
+            x2, g2 = x, gx
+            if np.all((np.abs(gx) <= maxerr * 1e-6) | (np.abs(x2 - x1) <= 1e-13 * (1 + np.abs(x))) | np.isnan(gx)):
+                break
+    return x[np.abs(gx) <= maxerr]
+
+
+# Finds the points in [a, b] where f1(x) == f2(x) by sampling f1 - f2 on the whole grid in one call.
+# Grid points where |f1 - f2| <= maxerr are reported as they are, every sign change between two neighbouring
+# grid points is refined by refineBrackets.
+def scanRoots(f1: callable, f2: callable, a: float, b: float, maxerr=0.00001) -> np.ndarray:
+    max_amount_of_points = int(b - a) * 50
     if max_amount_of_points == 0:
         max_amount_of_points = 50
-
-    delta = (b - a) / max_amount_of_points
-    x2 = x1
-    f_x1 = f1(x1) - f2(x1)
-    f_x2 = f1(x2) - f2(x2)
-    while x1 <= b + maxerr and x2 <= b + maxerr:
-
-        if abs(f_x1) <= maxerr:
-            yield x1
-            x1 += delta
-            x2 = x1 + delta
-            f_x1 = f1(x1) - f2(x1)
-        elif abs(f_x2) <= maxerr:
-            yield x2
-            x1 = x2 + delta
-            x2 = x1 + delta
-            f_x1 = f1(x1) - f2(x1)
-        elif f_x1 * f_x2 < 0 and f_x1 != f_x2:
-            x = regulaFalsi(f1, f2, x1, x2, a, b, maxerr)
-            if x is not None:
-                yield x
-            x1 = x2 + delta
-            x2 = x2 + delta
-            if f1(x1) is None or f2(x1) is None:
-                return
-            f_x1 = f1(x1) - f2(x1)
-        else:
-            x1 = x2
-            x2 += delta
-        if x2 < b and x2 > a:
-            f_x2 = f1(x2) - f2(x2)
-        elif x2 > b:
-            f_x2 = f1(b - 0.01) - f2(b - 0.01)
-        else:
-            f_x2 = f1(a + 0.01) - f2(a + 0.01)
+    xs = np.linspace(a, b, max_amount_of_points + 1)
+    with np.errstate(all='ignore'):
+        g = evaluateMany(f1, xs) - evaluateMany(f2, xs)
+        near = np.abs(g) <= maxerr
+        # like the old point by point scan, b itself only counts if the point before it was not a root already
+        near[-1] = near[-1] and not near[-2]
+        brackets = np.nonzero((g[:-1] * g[1:] < 0) & ~near[:-1] & ~near[1:])[0]
+    roots = refineBrackets(f1, f2, xs[brackets], xs[brackets + 1], g[brackets], g[brackets + 1], maxerr)
+    return dedupeRoots(np.sort(np.concatenate((xs[near], roots))), maxerr)
 
 
 def intersections(f1: callable, f2: callable, a: float, b: float, maxerr=0.00001) -> Iterable:
-    while (f1(a) is None or f2(a) is None) and a < b:
-        a += 100 * maxerr
-    while (f1(b) is None or f2(b) is None) and a < b:
-        b -= 100 * maxerr
+    a = firstDefinedPoint(f1, f2, a, b, 100 * maxerr)
+    b = firstDefinedPoint(f1, f2, b, a, -100 * maxerr)
     if a >= b:
         return []
-    iterator = helper(f1, f2, a, b, maxerr)
-    arr = np.array([])
-    for x in iterator:
-        if len(arr) == 0 or abs(x - arr[len(arr) - 1]) > maxerr:
-            arr = np.append(arr, [x])
-    return arr
+    coefficients = polyDifference(f1, f2)
+    if coefficients is not None and any(coefficients):
+        return polyRoots(coefficients, a, b, maxerr)
+    return scanRoots(f1, f2, a, b, maxerr)
 
 
 def makeDomain(params, c=0):
@@ -2848,10 +4640,11 @@ def makeDomain(params, c=0):
         r = []
         coefficient = params[:-1]
         f = makeFunc(coefficient)
-        inters = [x for x in intersections(f, lambda x: 0, -100, 100)]
+        inters = [x for x in intersections(f, ZERO_FUNC, -100, 100)]
         inters.append(float('-inf'))
         inters.append(float('inf'))
         inters = sorted([round(x, 3) for x in inters])
+        mids = []
         for i in range(len(inters) - 1):
             it = inters[i]
             it2 = inters[i + 1]
@@ -2865,15 +4658,16 @@ def makeDomain(params, c=0):
             if it2 == float('-inf'):
                 it2 = -100
 
-            a = (it + it2) / 2
-            if f(a) > 0:
+            mids.append((it + it2) / 2)
+        for i, y in enumerate(f.evaluate(mids)):
+            if y > 0:
                 r.append((inters[i], inters[i + 1]))
         return r
     elif c in [5, 6]:
         r = []
         coefficient = params[:-1] + [0]
         f = makeFunc(coefficient, 3 if c == 6 else 4)
-        inters = sorted(intersections(lambda x: 0, f, -3, 3))
+        inters = sorted(intersections(ZERO_FUNC, f, -3, 3))
         if len(inters) == 0:
             return [(float('-inf'), float('inf'))]
         for i in range(len(inters) - 1):
@@ -2905,6 +4699,7 @@ def makeDomain(params, c=0):
         zeroes.append(float('-inf'))
         zeroes.append(float('inf'))
         zeroes = sorted(zeroes)
+        mids = []
         for i in range(len(zeroes) - 1):
             it = zeroes[i]
             it2 = zeroes[i + 1]
@@ -2918,13 +4713,17 @@ def makeDomain(params, c=0):
             if it2 == float('-inf'):
                 it2 = -100
 
-            z = (it + it2) / 2
-            if poly(z) >= 0:
+            mids.append((it + it2) / 2)
+        for i, y in enumerate(poly.evaluate(mids)):
+            if y >= 0:
                 r.append((zeroes[i], zeroes[i + 1]))
         return r
 
 
 def makeIntersections(poly, c=0, r=[(-100, 100)]):
+    if c == 0 and isinstance(poly, CompiledFunc) and poly.c == 0 and any(poly.p):
+        xs = polyRoots(poly.p, float('-inf'), float('inf'))
+        return [(float(round(i, 2)), 0.0) if abs(round(i, 2)) > 0.01 else (0.0, 0.0) for i in xs]
     if c == 0:
         r = [(-100, 100)]
     elif c in [1, 3, 4]:
@@ -2933,7 +4732,7 @@ def makeIntersections(poly, c=0, r=[(-100, 100)]):
         r = [(d[0] if d[0] not in [float('-inf')] else -100, d[1] if d[1] not in [float('inf')] else 100) for d in r]
     xs = []
     for i in r:
-        inters = (intersections(poly, lambda x: 0, i[0], i[1]))
+        inters = (intersections(poly, ZERO_FUNC, i[0], i[1]))
         for x in inters:
             xs.append(x)
 
@@ -3085,6 +4884,8 @@ def makeExtremes(params, c=0, b=math.e):
     # Calculate the derivative of the polynomial
     if not any(params):
         return "אין נקודות קיצון"
+    if c == 0:
+        return polyExtremes(params)
 
     realDerive = derive(params, c, b)
     dom = makeDomain(params, c)
@@ -3161,6 +4962,9 @@ def getSymmetry(p, c=0, b=math.e):
 def makeIncDec(p, c=0, b=math.e):
     if not any(p[:-1]):
         return [], []
+    if c == 0:
+        roots, signs = polySigns(makeDer(p))
+        return signIntervals(np.round(roots, 2), signs, split=False)
     extremes = makeExtremes(p, c, b)
     dom = makeDomain(p, c)
     if dom == []:
@@ -3225,6 +5029,9 @@ def makeIncDec(p, c=0, b=math.e):
 def makePosNeg(p, c=0, b=math.e):
     if not any(p[:-1]):
         return [], []
+    if c == 0:
+        roots, signs = polySigns(p)
+        return signIntervals(np.round(roots, 2), signs)
     dom = makeDomain(p, c)
     if dom == []:
         return [], []
@@ -3356,7 +5163,13 @@ def makeAsym(p, c=0, b=math.e):
     else:
         s = set()
         dom = makeDomain(p, c)
-        f = makeFunc(p, c, b)
+        probes = [10000, -10000]
+        for i in dom:
+            for end in i:
+                if end not in [float('-inf'), float('inf')]:
+                    probes += [end + 0.0005, end - 0.0005]
+        values = {x: None if np.isnan(y) else float(y) for x, y in zip(probes, makeFunc(p, c, b).evaluate(probes))}
+        f = values.get
         for i in dom:
             if i[0] not in [float('-inf'), float('inf')]:
                 if f(i[0] + 0.0005):
@@ -3436,96 +5249,146 @@ def polySrting(params):
     return ret
 
 
-def makeExpo(p, base=math.e):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-        return lambda x: math.pow(base, makePoly(p[:-1])(x)) + p[-1]
-
-
-def makeLog(p, base=math.e):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-
-        def func(x):
-            temp = makePoly(p[:-1])(x)
-            if temp > 0:
-                return math.log(makePoly(p[:-1])(x), base) + p[-1]
-            else:
-                print("LOGNONE", funcString(p, 2, base), x)
+# A function y=f(x) of family c (same codes as makeFunc) with parameters p and base b, "compiled" once so it can be
+# evaluated on a whole numpy array in a single call instead of point by point.
+# Calling it with a number keeps the old makeFunc behaviour (a float, or None where f is not defined),
+# calling it with an array returns an array with NaN where f is not defined.
+class CompiledFunc:
+
+    def __init__(self, p, c=0, b=math.e):
+        self.p = list(p)
+        self.c = c
+        self.b = b
+        if c == 7:
+            self.numerator = self.p[:int(len(self.p) / 2)]
+            self.denominator = self.p[int(len(self.p) / 2):]
+        elif c == 0:
+            self.inner = self.p
+            self.shift = 0
+        else:
+            self.inner = self.p[:-1]
+            self.shift = self.p[-1] if len(self.p) else 0
+
+    def __call__(self, x):
+        if isinstance(x, (int, float)) or np.ndim(x) == 0:
+            return self.value(x)
+        return self.evaluate(x)
+
+    # Evaluates f on a single point, returns None where f is not defined
+    def value(self, x):
+        c = self.c
+        if c == 0:
+            return hornerValue(self.inner, x)
+        if len(self.p) < 1:
+            return 0
+        if c == 7:
+            den = hornerValue(self.denominator, x)
+            if den == 0:
                 return None
+            return hornerValue(self.numerator, x) / den
+        inner = hornerValue(self.inner, x)
+        if c == 1:
+            try:
+                return math.pow(self.b, inner) + self.shift
+            except OverflowError:
+                return float('inf')
+        elif c == 2:
+            if inner > 0:
+                return math.log(inner, self.b) + self.shift
+            return None
+        elif c == 3:
+            return math.sin(inner) + self.shift
+        elif c == 4:
+            return math.cos(inner) + self.shift
+        elif c == 5:
+            return math.tan(inner) + self.shift
+        elif c == 6:
+            t = math.tan(inner)
+            if t == 0:
+                return None
+            return 1 / t + self.shift
+        elif c == 8:
+            if inner < 0:
+                return None
+            return math.pow(inner, 1 / self.b) + self.shift
+        return None
 
-        return func
-
-
-def makeSin(p):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-        return lambda x: math.sin(makePoly(p[:-1])(x)) + p[-1]
-
-
-def makeCos(p):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-        return lambda x: math.cos(makePoly(p[:-1])(x)) + p[-1]
-
-
-def makeTan(p):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-        return lambda x: math.tan(makePoly(p[:-1])(x)) + p[-1]
+    # Evaluates f on every point of xs at once, returns a float array with NaN where f is not defined
+    def evaluate(self, xs):
+        xs = np.asarray(xs, dtype=float)
+        c = self.c
+        if c == 0:
+            return hornerArray(self.inner, xs)
+        if len(self.p) < 1:
+            return np.zeros_like(xs)
+        with np.errstate(all='ignore'):
+            if c == 7:
+                den = hornerArray(self.denominator, xs)
+                num = hornerArray(self.numerator, xs)
+                return np.where(den == 0, np.nan, num / np.where(den == 0, 1, den))
+            inner = hornerArray(self.inner, xs)
+            if c == 1:
+                return np.power(float(self.b), inner) + self.shift
+            elif c == 2:
+                return np.where(inner > 0, np.log(np.where(inner > 0, inner, 1)) / math.log(self.b) + self.shift,
+                                np.nan)
+            elif c == 3:
+                return np.sin(inner) + self.shift
+            elif c == 4:
+                return np.cos(inner) + self.shift
+            elif c == 5:
+                return np.tan(inner) + self.shift
+            elif c == 6:
+                t = np.tan(inner)
+                return np.where(t == 0, np.nan, 1 / np.where(t == 0, 1, t) + self.shift)
+            elif c == 8:
+                return np.where(inner < 0, np.nan, np.power(np.where(inner < 0, 0, inner), 1 / self.b) + self.shift)
+        return np.full_like(xs, np.nan)
+
+
+def hornerValue(coefficients, x):
+    ret = 0.0
+    for a in coefficients:
+        ret = ret * x + a
+    return float(ret)
+
+
+def hornerArray(coefficients, xs):
+    ret = np.zeros_like(xs)
+    for a in coefficients:
+        ret = ret * xs + a
+    return ret
 
 
-def makeTan(p):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-        return lambda x: math.tan(makePoly(p[:-1])(x)) + p[-1]
+# Evaluates any function of x on all of xs: compiled and lambdified functions are evaluated in one numpy call,
+# plain python callables point by point. None (undefined) becomes NaN either way.
+def evaluateMany(f, xs):
+    xs = np.asarray(xs, dtype=float)
+    if isinstance(f, (CompiledFunc, SympyFunc)):
+        return f.evaluate(xs)
+    return np.array([safeValue(f, float(x)) for x in xs], dtype=float)
 
 
-def makeCot(p):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-        return lambda x: 1 / math.tan(makePoly(p[:-1])(x)) + p[-1]
+def safeValue(f, x):
+    try:
+        y = f(x)
+    except (ZeroDivisionError, ValueError, OverflowError):
+        return np.nan
+    return np.nan if y is None else y
 
 
-def makeRational(p):
-    p1 = p[:int(len(p) / 2)]
-    p2 = p[int(len(p) / 2):]
-    return lambda x: None if makePoly(p2)(x) == 0 else makePoly(p1)(x) / makePoly(p2)(x)
+@functools.lru_cache(maxsize=1024)
+def compileFunc(p, c=0, b=math.e):
+    return CompiledFunc(p, c, b)
 
 
-def makeRoot(p, b):
-    if len(p) < 1:
-        return lambda x: 0
-    else:
-        return lambda x: None if makePoly(p[:-1])(x) < 0 else math.pow(makePoly(p[:-1])(x), 1 / b) + p[-1]
+def makeFunc(p, c=0, b=math.e):
+    if c not in range(9):
+        return None
+    return compileFunc(tuple(p), c, b)
 
 
-def makeFunc(p, c=0, b=math.e):
-    if c == 0:
-        return makePoly(p)
-    elif c == 1:
-        return makeExpo(p, b)
-    elif c == 2:
-        return makeLog(p, b)
-    elif c == 3:
-        return makeSin(p)
-    elif c == 4:
-        return makeCos(p)
-    elif c == 5:
-        return makeTan(p)
-    elif c == 6:
-        return makeCot(p)
-    elif c == 7:
-        return makeRational(p)
-    elif c == 8:
-        return makeRoot(p, b)
+ZERO_FUNC = makeFunc([0])
 
 
 @app.route('/getAllLessonQuestions')
@@ -3544,9 +5407,7 @@ def getAllLessonQuestionsB(className, unitName):
             units = []
             actives = []
             questions = {}
-            u = Unit[unitName, className]
-            stop = False
-            while not stop:
+            for u in lesson_units(Unit[unitName, className]):
                 names.append(u.name)
                 units.append(u)
                 instances = ActiveUnit.select(unit=u)
@@ -3571,10 +5432,6 @@ def getAllLessonQuestionsB(className, unitName):
                             if i.student.name not in questions.keys():
                                 questions[i.student.name] = []
                             questions[i.student.name].append(question_data)
-                if u.next:
-                    u = Unit[u.next, className]
-                else:
-                    stop = True
 
             for s, qs in questions.items():
                 questions[s] = sorted(qs, key=lambda x: x['solve_time'], reverse=False)
@@ -3601,9 +5458,7 @@ def getStudentLessonQuestionsB(className, student, unitName):
             units = []
             actives = []
             questions = []
-            u = Unit[unitName, className]
-            stop = False
-            while not stop:
+            for u in lesson_units(Unit[unitName, className]):
                 names.append(u.name)
                 units.append(u)
                 instances = ActiveUnit.select(unit=u)
@@ -3626,10 +5481,6 @@ def getStudentLessonQuestionsB(className, student, unitName):
                                     "solve_time": q.solve_time
                                 }
                                 questions.append(question_data)
-                if u.next:
-                    u = Unit[u.next, className]
-                else:
-                    stop = True
             return questions, 200
     except Exception as e:
         print(e)
@@ -3640,59 +5491,121 @@ def getStudentLessonQuestionsB(className, student, unitName):
 
 
 
-def getLessonIndex(user, unit_name, class_name):
-    try:
-        with db_session:
-            unitsAbove = 0
-            unitsBelow = 0
-            try:
-                unit_name_n = unit_name
-                unit_name_n += "n"
-                while (True):
-                    unit = Unit[unit_name_n, Cls[class_name]]
-                    activeUnit = ActiveUnit[unit, user, 1]
-                    unitsAbove += 1
-                    unit_name_n += "n"
-            except Exception as e:
-                a = 8
+# The stored LessonProgress covering unit, None if there is none (yet). One indexed read.
+def stored_lesson_progress(student, unit):
+    entry = lesson_entry(unit)
+    progress = LessonProgress.get(student=student, lesson=entry.lesson)
+    if progress and progress.first <= entry.position < progress.first + progress.units:
+        return progress
+    return None
 
-            try:
-                unit_name_n = unit_name
-                unit_name_n = unit_name_n[:-1]
-                while (True):
-                    unit = Unit[unit_name_n, Cls[class_name]]
-                    activeUnit = ActiveUnit[unit, user, 1]
-                    unitsBelow += 1
-                    unit_name_n = unit_name_n[:-1]
 
-            except Exception as e:
-                a = 8
+# The LessonProgress of the lesson unit_name is in, None if the student didn't start the unit. Rebuilt from the
+# ActiveUnits and stored when the student got to a unit it doesn't cover yet (or it is missing, e.g. progress from
+# before the table existed). Writes, so only for the paths that write anyway: opening a unit and answering.
+def lesson_progress(user, unit_name, class_name):
+    student = User[user] if isinstance(user, str) else user
+    unit = Unit[unit_name, Cls[class_name]]
+    return stored_lesson_progress(student, unit) or rebuild_lesson_progress(student, unit)
+
+
+# (first, units, correct, solved) of the lesson unit_name is in, for the readers: from the stored row, or counted
+# from the ActiveUnits without storing it if there is none. None if the student didn't start the unit.
+def read_lesson_progress(user, unit_name, class_name):
+    student = User[user] if isinstance(user, str) else user
+    unit = Unit[unit_name, Cls[class_name]]
+    progress = stored_lesson_progress(student, unit)
+    if progress:
+        return progress.first, progress.units, progress.correct, progress.solved
+    counted = count_lesson_progress(student, unit)
+    return counted and counted[1:]
+
+
+# the first attempts of student at the units of lesson, by their position in it
+def first_attempts(student, lesson):
+    return dict(select((a.unit.lesson_unit.position, a) for a in ActiveUnit
+                       if a.student == student and a.attempt == 1 and a.unit.lesson_unit.lesson == lesson)[:])
 
-            return (1 + unitsBelow, 1 + unitsAbove + unitsBelow)
+
+# (lesson, first, units, correct, solved) of the run of started lesson units unit is in, None if the student
+# didn't start unit
+def count_lesson_progress(student, unit):
+    entry = lesson_entry(unit)
+    started = first_attempts(student, entry.lesson)
+    if entry.position not in started:
+        return None
+    first = entry.position
+    while first - 1 in started:
+        first -= 1
+    units = correct = solved = 0
+    while first + units in started:
+        active = started[first + units]
+        correct += active.totalCorrect
+        solved += active.currentQuestion
+        units += 1
+    return entry.lesson, first, units, correct, solved
+
+
+def rebuild_lesson_progress(student, unit):
+    counted = count_lesson_progress(student, unit)
+    if counted is None:
+        return None
+    lesson, first, units, correct, solved = counted
+    progress = LessonProgress.get(student=student, lesson=lesson)
+    if progress:
+        progress.set(first=first, units=units, correct=correct, solved=solved)
+    else:
+        progress = LessonProgress(student=student, lesson=lesson, first=first, units=units, correct=correct,
+                                  solved=solved)
+    return progress
+
+
+# drops the progress rows of lesson after its units moved, they are rebuilt on demand
+def forget_lesson_progress(lesson):
+    LessonProgress.select(lambda p: p.lesson == lesson).delete(bulk=True)
+
+
+# First-attempt (correct, solved) of unit_name and the lesson units after it. The stored sums are the ones of the
+# whole run, for a unit further in it its units are summed in one query.
+def lesson_sums_from(user, unit_name, class_name):
+    progress = read_lesson_progress(user, unit_name, class_name)
+    if not progress:
+        return 0, 0
+    first, units, correct, solved = progress
+    entry = lesson_entry(Unit[unit_name, Cls[class_name]])
+    if entry.position == first:
+        return correct, solved
+    lesson, last = entry.lesson, first + units - 1
+    correct = solved = 0
+    for active in ActiveUnit.select(lambda a: a.student.name == user and a.attempt == 1
+                                    and a.unit.lesson_unit.lesson == lesson
+                                    and a.unit.lesson_unit.position >= entry.position
+                                    and a.unit.lesson_unit.position <= last):
+        correct += active.totalCorrect
+        solved += active.currentQuestion
+    return correct, solved
+
+
+# (index of unit_name in its lesson, number of lesson units the student started)
+def getLessonIndex(user, unit_name, class_name):
+    try:
+        with db_session:
+            progress = read_lesson_progress(user, unit_name, class_name)
+            if not progress:
+                return (1, 1)
+            first, units, correct, solved = progress
+            return (1 + lesson_entry(Unit[unit_name, Cls[class_name]]).position - first, units)
 
     except Exception as e:
         print(e)
         return str(e)
 
 
+# the grade of the first attempts of unit_name and the lesson units after it
 def getLessonGrade(user, unit_name, class_name):
     try:
         with db_session:
-            unit_name_n = unit_name
-            total_correct = 0
-            total_solved = 0
-            try:
-                while (True):
-                    unit = Unit[unit_name_n, Cls[class_name]]
-                    activeUnit = ActiveUnit[unit, user, 1]
-                    total_correct += activeUnit.totalCorrect
-                    total_solved += activeUnit.currentQuestion
-
-                    unit_name_n += "n"
-            except Exception as e:
-                a = 8
-                # print("does not exists " + str(e))
-
+            total_correct, total_solved = lesson_sums_from(user, unit_name, class_name)
             grade = int(((total_correct / total_solved) * 100))
             return grade
 
@@ -3702,23 +5615,11 @@ def getLessonGrade(user, unit_name, class_name):
         return str(e)
 
 
+# (correct, incorrect) of the first attempts of unit_name and the lesson units after it
 def getLessonCorrectIncorrect(user, unit_name, class_name):
     try:
         with db_session:
-            unit_name_n = unit_name
-            total_correct = 0
-            total_solved = 0
-            try:
-                while (True):
-                    unit = Unit[unit_name_n, Cls[class_name]]
-                    activeUnit = ActiveUnit[unit, user, 1]
-                    total_correct += activeUnit.totalCorrect
-                    total_solved += activeUnit.currentQuestion
-
-                    unit_name_n += "n"
-            except Exception as e:
-                a = 8
-
+            total_correct, total_solved = lesson_sums_from(user, unit_name, class_name)
             return (total_correct, total_solved - total_correct)
 
 
@@ -3740,14 +5641,12 @@ def getLessonCorrectIncorrectQuestions():
 
     try:
         with db_session:
-            unit_name_n = unit_name
             total_correct = 0
             total_solved = 0
             ret = []
             try:
                 id = 1
-                while (True):
-                    unit = Unit[unit_name_n, Cls[class_name]]
+                for unit in lesson_units(Unit[unit_name, Cls[class_name]]):
                     activeUnit = ActiveUnit[unit, user, 1]
                     for question in Question.select(active_unit=activeUnit, solved_correctly=correctBool):
                         singleQuestion = dict()
@@ -3756,8 +5655,6 @@ def getLessonCorrectIncorrectQuestions():
                         singleQuestion["id"] = id
                         id += 1
                         ret.append(singleQuestion)
-
-                    unit_name_n += "n"
             except Exception as e:
                 a = 8
             return jsonify(ret), 200
@@ -3827,5 +5724,83 @@ class teacherCont(userCont):
         return "openClass", Cname
 
 
+# ASGI entry point for app, on a2wsgi's WSGIMiddleware (pip install a2wsgi uvicorn), which streams the responses
+# of the flask app and runs it on a thread pool of its own. The routes in generation_routes, the ones that can wait
+# on question generation (itself done on the GenerationExecutor processes), get a middleware, and so a pool, of
+# their own. Everything else runs on the read pool, /getQuestion included (it answers pending rather than generate,
+# see ensure_next_question), so a read never queues behind a unit being generated.
+# Serve with e.g. uvicorn flaskProject.app:asgi_app --port 5000. stats() reports the requests served and in flight
+# per pool.
+class AsgiApp:
+
+    def __init__(self, wsgi_app, read_workers, generation_workers, generation_routes):
+        self.wsgi_app = wsgi_app
+        self.workers = {'read': read_workers, 'generation': generation_workers}
+        self.generation_routes = frozenset(generation_routes)
+        self.lock = threading.Lock()
+        self.middlewares = None
+        self.served = {pool: 0 for pool in self.workers}
+        self.in_flight = {pool: 0 for pool in self.workers}
+
+    # the WSGIMiddleware of every pool, made on the first request so a2wsgi is only needed to serve ASGI
+    def pools(self):
+        with self.lock:
+            if self.middlewares is None:
+                from a2wsgi import WSGIMiddleware
+                self.middlewares = {pool: WSGIMiddleware(functools.partial(self.call_app, pool), workers=workers)
+                                    for pool, workers in self.workers.items()}
+            return self.middlewares
+
+    def call_app(self, pool, environ, start_response):
+        environ['mathematix.pool'] = pool
+        return self.wsgi_app(environ, start_response)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError("unsupported ASGI scope type " + scope['type'])
+        pool = 'generation' if scope['path'] in self.generation_routes else 'read'
+        middleware = self.pools()[pool]
+        with self.lock:
+            self.in_flight[pool] += 1
+        try:
+            await middleware(scope, receive, send)
+        finally:
+            with self.lock:
+                self.in_flight[pool] -= 1
+                self.served[pool] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "served": dict(self.served),
+                "in_flight": dict(self.in_flight)
+            }
+
+
+asgi_app = AsgiApp(app, ASGI_READ_WORKERS, ASGI_GENERATION_WORKERS, ASGI_GENERATION_ROUTES)
+
+
+# How this request is served, so load test reports show which mode they ran against
+@app.route('/servingStats')
+def servingStats():
+    pool = request.environ.get('mathematix.pool')
+    stats = {"mode": 'asgi' if pool else 'wsgi', "pool": pool}
+    if pool:
+        stats.update(asgi_app.stats())
+    return jsonify(stats)
+
+
 if __name__ == '__main__':
-    app.run()
+    if SERVING_MODE == 'asgi':
+        import uvicorn
+        uvicorn.run(asgi_app, port=5000)
+    else:
+        app.run()